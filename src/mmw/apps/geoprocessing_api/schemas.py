@@ -3,7 +3,8 @@ from drf_yasg.openapi import (
     Parameter, Schema,
     IN_PATH,
     FORMAT_DATETIME, FORMAT_UUID,
-    TYPE_ARRAY, TYPE_BOOLEAN, TYPE_NUMBER, TYPE_OBJECT, TYPE_STRING
+    TYPE_ARRAY, TYPE_BOOLEAN, TYPE_INTEGER, TYPE_NUMBER, TYPE_OBJECT,
+    TYPE_STRING
 )
 
 from django.conf import settings
@@ -309,6 +310,83 @@ GWLFE_REQUEST = Schema(
     },
 )
 
+GWLFE_SWEEP_REQUEST = Schema(
+    title='GWLF-E Sweep Request',
+    type=TYPE_OBJECT,
+    properties={
+        'input': Schema(
+            type=TYPE_OBJECT,
+            description='The result of modeling/gwlf-e/prepare/',
+        ),
+        'job_uuid': Schema(
+            type=TYPE_STRING,
+            format=FORMAT_UUID,
+            example='6e514e69-f46b-47e7-9476-c1f5be0bac01',
+            description='The job uuid of modeling/gwlf-e/prepare/',
+        ),
+        'modifications': GWLFE_MODIFICATIONS,
+        'variants': Schema(
+            type=TYPE_OBJECT,
+            additional_properties=GWLFE_MODIFICATIONS,
+            description='An object of up to 50 variant names to lists of '
+                        'modifications, in the same format as '
+                        '`modifications`, which are applied after them. '
+                        'e.g. { "no-till": [{ "n26": 88.8 }], '
+                        '"reforested": [{ "Area__1": 0, "Area__9": 120.5 }] }'
+        ),
+        'inputmod_hash': INPUTMOD_HASH,
+    },
+    required=['variants'],
+)
+
+GWLFE_SENSITIVITY_REQUEST = Schema(
+    title='GWLF-E Sensitivity Request',
+    type=TYPE_OBJECT,
+    properties={
+        'input': Schema(
+            type=TYPE_OBJECT,
+            description='The result of modeling/gwlf-e/prepare/',
+        ),
+        'job_uuid': Schema(
+            type=TYPE_STRING,
+            format=FORMAT_UUID,
+            example='6e514e69-f46b-47e7-9476-c1f5be0bac01',
+            description='The job uuid of modeling/gwlf-e/prepare/',
+        ),
+        'modifications': GWLFE_MODIFICATIONS,
+        'parameters': Schema(
+            type=TYPE_OBJECT,
+            additional_properties=Schema(type=TYPE_OBJECT),
+            description='An object of parameter keys, in the same format as '
+                        'those of `modifications`, to the distributions to '
+                        'sample them from. Each has a `distribution` of '
+                        '`uniform` (`low`, `high`), `normal` (`loc`, '
+                        '`scale`), `lognormal` (`mean`, `sigma`) or '
+                        '`triangular` (`left`, `mode`, `right`). If '
+                        '`relative` is true, the samples multiply the '
+                        'parameter instead of replacing it, which can scale '
+                        'whole arrays. e.g. { "RecessionCoef": { '
+                        '"distribution": "uniform", "low": 0.05, "high": 0.1 '
+                        '}, "KF": { "distribution": "normal", "loc": 1, '
+                        '"scale": 0.1, "relative": true } }'
+        ),
+        'samples': Schema(
+            type=TYPE_INTEGER,
+            example=100,
+            description='The number of samples to run, up to 1000',
+        ),
+        'seed': Schema(
+            type=TYPE_INTEGER,
+            example=42,
+            description='The seed to draw the samples with. The same seed '
+                        'gives the same samples and results. If not '
+                        'specified, one is chosen and returned in the result',
+        ),
+        'inputmod_hash': INPUTMOD_HASH,
+    },
+    required=['parameters', 'samples'],
+)
+
 SUBBASIN_REQUEST = Schema(
     title='Subbasin Request',
     type=TYPE_OBJECT,
@@ -4,7 +4,6 @@ import json
 import logging
 from urllib.parse import urlencode
 
-from ast import literal_eval as make_tuple
 from calendar import month_name
 from functools import reduce
 
@@ -25,6 +24,8 @@ from apps.modeling.tasks import run_gwlfe
 
 from apps.modeling.mapshed.calcs import streams
 from apps.modeling.mapshed.tasks import (NOCACHE,
+                                         QUERY_POOL_SIZE,
+                                         QueryPool,
                                          collect_data,
                                          convert_data,
                                          nlcd_streams,
@@ -261,9 +262,8 @@ def analyze_soil(result, area_of_interest=None):
     categories = []
 
     # Convert results to histogram, calculate total
-    for key, count in result.items():
+    for s, count in parse(result).items():  # Change {"List(1)":5} to {1:5}
         total_count += count
-        s = make_tuple(key[4:])  # Change {"List(1)":5} to {1:5}
         s = s if s != settings.NODATA else 3  # Map NODATA to 3
         histogram[s] = count + histogram.get(s, 0)
 
@@ -509,24 +509,26 @@ def collect_worksheet_wkaois(result, shapes):
 
     collection = {}
 
-    for shape in shapes:
-        wkaoi = shape['id']
-        geojson = shape['shape']
+    with QueryPool(QUERY_POOL_SIZE) as pool:
+        for shape in shapes:
+            wkaoi = shape['id']
+            geojson = shape['shape']
 
-        converted = convert_data(result, wkaoi)
+            converted = convert_data(result, wkaoi)
 
-        histogram = converted[0]['n_count']
+            histogram = converted[0]['n_count']
 
-        collected = collect_data(converted, geojson)
-        modeled = run_gwlfe(collected, None, None)
+            collected = collect_data(converted, geojson, wkaoi=wkaoi,
+                                     pool=pool)
+            modeled = run_gwlfe(collected, None, None)
 
-        collection[wkaoi] = {
-            'mapshed': collected,
-            'gwlfe': modeled,
-            'nlcd': collect_nlcd(histogram, geojson),
-            'streams': stream_data(nlcd_streams(result[wkaoi]['nlcd_streams']),
-                                   geojson)
-        }
+            collection[wkaoi] = {
+                'mapshed': collected,
+                'gwlfe': modeled,
+                'nlcd': collect_nlcd(histogram, geojson),
+                'streams': stream_data(
+                    nlcd_streams(result[wkaoi]['nlcd_streams']), geojson)
+            }
 
     return collection
 
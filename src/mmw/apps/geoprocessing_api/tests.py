@@ -16,7 +16,8 @@ from django.utils.timezone import now
 
 from apps.core.models import Job, JobStatus
 from apps.geoprocessing_api import (tasks, calcs)
-from apps.modeling.calcs import apply_gwlfe_modifications
+from apps.modeling.calcs import (apply_gwlfe_modifications,
+                                 SHARED_WEATHER)
 
 
 class ExerciseManageApiToken(TestCase):
@@ -1521,6 +1522,132 @@ class ExerciseModeling(TestCase):
         })
         self.assertEqual(response.status_code, 412)
 
+    def send_gwlfe_sweep(self, data):
+        return self.send_request(
+            reverse('geoprocessing_api:start_modeling_gwlfe_sweep'), data)
+
+    def test_modeling_gwlfe_sweep_invalid_variants(self):
+        job_uuid = 'cbed307e-4046-4889-b6fb-658080186ae6'
+        Job.objects.create(uuid=job_uuid, created_at=now(),
+                           result=json.dumps({'WxYrs': 30}),
+                           status=JobStatus.COMPLETE)
+
+        for variants in [None, {}, [[{'n26': 88.8}]],
+                         {'no-till': {'n26': 88.8}},
+                         {'no-till': ['n26']},
+                         {str(i): [] for i in range(51)}]:
+            response = self.send_gwlfe_sweep({
+                'job_uuid': job_uuid,
+                'variants': variants,
+            })
+            self.assertEqual(response.status_code, 400, variants)
+
+    def test_modeling_gwlfe_sweep_nonready_jobs(self):
+        job_uuid = 'cbed307e-4046-4889-b6fb-658080186ae6'
+        variants = {'no-till': [{'n26': 88.8}]}
+        response = self.send_gwlfe_sweep({
+            'job_uuid': job_uuid,
+            'variants': variants,
+        })
+        self.assertEqual(response.status_code, 404)
+
+        Job.objects.create(uuid=job_uuid, created_at=now(),
+                           status=JobStatus.STARTED)
+
+        response = self.send_gwlfe_sweep({
+            'job_uuid': job_uuid,
+            'variants': variants,
+        })
+        self.assertEqual(response.status_code, 428)
+
+    def send_gwlfe_sensitivity(self, data):
+        return self.send_request(
+            reverse('geoprocessing_api:start_modeling_gwlfe_sensitivity'),
+            data)
+
+    def test_modeling_gwlfe_sensitivity_invalid_parameters(self):
+        gms_json = join(dirname(abspath(__file__)),
+                        'tests/gwlfe-prepare-huc12__55174.json')
+        with open(gms_json) as f:
+            job_result = f.read()
+
+        job_uuid = 'cbed307e-4046-4889-b6fb-658080186ae6'
+        Job.objects.create(uuid=job_uuid, created_at=now(),
+                           result=job_result,
+                           status=JobStatus.COMPLETE)
+
+        uniform = {'distribution': 'uniform', 'low': 0.9, 'high': 1.1}
+        for parameters, samples, seed in [
+                (None, 10, 1),
+                ({}, 10, 1),
+                ({'RecessionCoef': {'distribution': 'poisson', 'lam': 1}},
+                 10, 1),
+                ({'RecessionCoef': {'distribution': 'uniform', 'low': 1}},
+                 10, 1),
+                ({'RecessionCoef': {'distribution': 'uniform',
+                                    'low': 0.9, 'high': float('nan')}},
+                 10, 1),
+                ({'RecessionCoef': {'distribution': 'uniform',
+                                    'low': 1.1, 'high': 0.9}},
+                 10, 1),
+                ({'RecessionCoef': {'distribution': 'uniform',
+                                    'low': 1, 'high': 1}},
+                 10, 1),
+                ({'RecessionCoef': {'distribution': 'normal',
+                                    'loc': 1, 'scale': 0}},
+                 10, 1),
+                ({'RecessionCoef': {'distribution': 'lognormal',
+                                    'mean': 0, 'sigma': -0.1}},
+                 10, 1),
+                ({'RecessionCoef': {'distribution': 'triangular',
+                                    'left': 0.9, 'mode': 1.2, 'right': 1.1}},
+                 10, 1),
+                ({'RecessionCoef': {'distribution': 'triangular',
+                                    'left': 1, 'mode': 1, 'right': 1}},
+                 10, 1),
+                ({'Missing': uniform}, 10, 1),
+                ({'CN__99': uniform}, 10, 1),
+                ({'KF': uniform}, 10, 1),
+                ({'RecessionCoef': uniform}, 0, 1),
+                ({'RecessionCoef': uniform}, 1001, 1),
+                ({'RecessionCoef': uniform}, '10', 1),
+                ({'RecessionCoef': uniform}, 10, -1),
+                ({'RecessionCoef': uniform}, 10, 1.5)]:
+            response = self.send_gwlfe_sensitivity({
+                'job_uuid': job_uuid,
+                'parameters': parameters,
+                'samples': samples,
+                'seed': seed,
+            })
+            self.assertEqual(response.status_code, 400,
+                             (parameters, samples, seed))
+
+    def test_modeling_gwlfe_sweep_sensitivity_subbasin_rejected(self):
+        job_uuid = 'cbed307e-4046-4889-b6fb-658080186ae6'
+        job = Job.objects.create(uuid=job_uuid, created_at=now(),
+                                 status=JobStatus.COMPLETE)
+
+        for result in [
+                {'huc12__1': {'WxYrs': 30}},
+                {'huc12__1': {'WxYrs': 30, 'WeatherKey': '1'},
+                 SHARED_WEATHER: {'1': {'Temp': [], 'Prec': []}}}]:
+            job.result = json.dumps(result)
+            job.save()
+
+            response = self.send_gwlfe_sweep({
+                'job_uuid': job_uuid,
+                'variants': {'no-till': [{'n26': 88.8}]},
+            })
+            self.assertEqual(response.status_code, 400, result)
+
+            response = self.send_gwlfe_sensitivity({
+                'job_uuid': job_uuid,
+                'parameters': {'RecessionCoef': {
+                    'distribution': 'uniform', 'low': 0.9, 'high': 1.1}},
+                'samples': 10,
+            })
+            self.assertEqual(response.status_code, 400, result)
+
     def send_subbasin_prepare(self, data):
         return self.send_request(
             reverse('geoprocessing_api:start_modeling_subbasin_prepare'), data)
@@ -1656,6 +1783,29 @@ class ExerciseModelingModifications(TestCase):
         # Changed indirectly
         self.assertEqual(modded_input['n24b'], 2639.642634937583)
 
+    def test_modifications_copy_only_what_they_change(self):
+        gms_json = join(dirname(abspath(__file__)),
+                        'tests/gwlfe-prepare-huc12__55174.json')
+        with open(gms_json) as f:
+            gwlfe_input = json.load(f)
+        with open(gms_json) as f:
+            original_input = json.load(f)
+
+        modded_input = apply_gwlfe_modifications(gwlfe_input, [
+            {'Area__1': 10.0, 'CN__1': 80.0},
+            {'CN__2': 75.0, 'n73': 0.29},
+        ])
+
+        self.assertEqual(gwlfe_input, original_input)
+        self.assertEqual(modded_input['Area'][1], 10.0)
+        self.assertEqual(modded_input['CN'][1:3], [80.0, 75.0])
+        self.assertEqual(modded_input['n73'], 0.29)
+        self.assertEqual(modded_input['n23'], 10.0)
+
+        # Unmodified arrays are shared
+        self.assertIs(modded_input['Temp'], gwlfe_input['Temp'])
+        self.assertIsNot(modded_input['CN'], gwlfe_input['CN'])
+
 
 class ExerciseRWD(TestCase):
     def setUp(self):
@@ -61,6 +61,11 @@ urlpatterns = [
             name='start_modeling_gwlfe_prepare'),
     re_path(r'modeling/gwlf-e/run/$', views.start_modeling_gwlfe_run,
             name='start_modeling_gwlfe_run'),
+    re_path(r'modeling/gwlf-e/sweep/$', views.start_modeling_gwlfe_sweep,
+            name='start_modeling_gwlfe_sweep'),
+    re_path(r'modeling/gwlf-e/sensitivity/$',
+            views.start_modeling_gwlfe_sensitivity,
+            name='start_modeling_gwlfe_sensitivity'),
     re_path(r'modeling/subbasin/prepare/$',
             views.start_modeling_subbasin_prepare,
             name='start_modeling_subbasin_prepare'),
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from math import isfinite
 from numbers import Number
 from uuid import UUID
 
@@ -7,6 +8,8 @@ from django.contrib.gis.geos import Point
 
 from rest_framework.exceptions import ValidationError
 
+from apps.modeling.calcs import SAMPLE_DISTRIBUTIONS
+
 
 def validate_rwd(location, data_source, snapping, simplify):
     if not check_location_format(location):
@@ -126,6 +129,101 @@ def validate_gwlfe_run(input):
         raise ValidationError(f'Provided `input` is missing: {missing_keys}')
 
 
+def validate_gwlfe_prepared(input):
+    if not isinstance(input, dict) or 'WxYrs' not in input:
+        raise ValidationError('Provided `job_uuid` must be of a '
+                              'gwlf-e/prepare job. Results of '
+                              'subbasin/prepare jobs can only be run with '
+                              'subbasin/run')
+
+
+def validate_gwlfe_sweep(variants):
+    if not isinstance(variants, dict) or not variants:
+        raise ValidationError('Provided `variants` must be a non-empty object '
+                              'of variant names to lists of modifications')
+
+    if len(variants) > GWLFE_SWEEP_MAX_VARIANTS:
+        raise ValidationError(f'Provided `variants` has {len(variants)} '
+                              f'variants, more than the maximum of '
+                              f'{GWLFE_SWEEP_MAX_VARIANTS}')
+
+    invalid = [name for name, mods in variants.items()
+               if not isinstance(mods, list) or
+               not all(isinstance(mod, dict) for mod in mods)]
+    if invalid:
+        raise ValidationError(f'Provided `variants` have modifications that '
+                              f'are not lists of objects: {invalid}')
+
+
+def validate_gwlfe_sensitivity(input, parameters, samples, seed):
+    if not isinstance(parameters, dict) or not parameters:
+        raise ValidationError('Provided `parameters` must be a non-empty '
+                              'object of parameter keys to distributions')
+
+    for key, spec in parameters.items():
+        check_gwlfe_sensitivity_parameter(input, key, spec)
+
+    if (type(samples) is not int or
+            not 0 < samples <= GWLFE_SENSITIVITY_MAX_SAMPLES):
+        raise ValidationError(f'Invalid `samples` value `{samples}`. Must be '
+                              f'an integer from 1 to '
+                              f'{GWLFE_SENSITIVITY_MAX_SAMPLES}')
+
+    if seed is not None and (type(seed) is not int or seed < 0):
+        raise ValidationError(f'Invalid `seed` value `{seed}`. Must be a '
+                              f'non-negative integer')
+
+
+def check_gwlfe_sensitivity_parameter(input, key, spec):
+    if not isinstance(spec, dict) or \
+       spec.get('distribution') not in SAMPLE_DISTRIBUTIONS:
+        raise ValidationError(f'Invalid distribution for parameter `{key}`. '
+                              f'Must be an object with a `distribution` of '
+                              f'{list(SAMPLE_DISTRIBUTIONS.keys())}')
+
+    args = SAMPLE_DISTRIBUTIONS[spec['distribution']]
+    if not all(isinstance(spec.get(arg), Number) and
+               type(spec.get(arg)) is not bool and
+               isfinite(spec.get(arg)) for arg in args):
+        raise ValidationError(f'Invalid distribution for parameter `{key}`. '
+                              f'A {spec["distribution"]} distribution must '
+                              f'have finite numeric {args}')
+
+    if not check_gwlfe_sensitivity_distribution_range(spec):
+        ranges = SAMPLE_DISTRIBUTION_RANGES[spec['distribution']]
+        raise ValidationError(f'Invalid distribution for parameter `{key}`. '
+                              f'A {spec["distribution"]} distribution must '
+                              f'have {ranges}')
+
+    gmskey, _, i = key.partition('__')
+    value = input.get(gmskey)
+    if i:
+        value = (value[int(i)]
+                 if isinstance(value, list) and i.isdigit() and
+                 int(i) < len(value) else None)
+
+    if not (isinstance(value, Number) or
+            isinstance(value, list) and spec.get('relative') and
+            all(isinstance(v, Number) for v in value)):
+        raise ValidationError(f'Invalid parameter `{key}`. Must be a number '
+                              f'in the input, or an array of them if '
+                              f'`relative` is true')
+
+
+def check_gwlfe_sensitivity_distribution_range(spec):
+    name = spec['distribution']
+    if name == 'uniform':
+        return spec['low'] < spec['high']
+    if name == 'normal':
+        return spec['scale'] > 0
+    if name == 'lognormal':
+        return spec['sigma'] > 0
+    if name == 'triangular':
+        return (spec['left'] <= spec['mode'] <= spec['right'] and
+                spec['left'] < spec['right'])
+    return True
+
+
 def check_exactly_one_provided(one_of: list, params: dict):
     # Dictionary for just the keys of which we want one of
     one_of_params = {k: params.get(k) for k in one_of}
@@ -186,3 +284,17 @@ GWLFE_INPUT_KEYS = list(settings.GWLFE_DEFAULTS.keys()) + [
     'Temp', 'TotArea', 'UrbAreaTotal', 'UrbLength', 'WeatherStations',
     'WxYrBeg', 'WxYrEnd', 'WxYrs', 'n23', 'n23b', 'n24', 'n24b', 'n41', 'n41j',
     'n41k', 'n41l', 'n42', 'n42b', 'n46e', 'n46f']
+
+# Most variants a gwlf-e/sweep request may run
+GWLFE_SWEEP_MAX_VARIANTS = 50
+
+# Conditions the arguments of each of SAMPLE_DISTRIBUTIONS must meet
+SAMPLE_DISTRIBUTION_RANGES = {
+    'uniform': '`low` < `high`',
+    'normal': '`scale` > 0',
+    'lognormal': '`sigma` > 0',
+    'triangular': '`left` <= `mode` <= `right` and `left` < `right`',
+}
+
+# Most samples a gwlf-e/sensitivity request may run
+GWLFE_SENSITIVITY_MAX_SAMPLES = 1000
@@ -2,8 +2,9 @@
 import json
 
 from operator import itemgetter
+from secrets import randbelow
 
-from celery import chain
+from celery import chain, group
 
 from rest_framework.response import Response
 from rest_framework import decorators, status
@@ -25,8 +26,16 @@ from apps.core.tasks import (save_job_error,
                              save_job_result)
 from apps.core.decorators import log_request
 from apps.modeling import geoprocessing
-from apps.modeling.calcs import apply_gwlfe_modifications
-from apps.modeling.tasks import run_gwlfe, subbasin_results_to_dict
+from apps.modeling.calcs import (apply_gwlfe_modifications,
+                                 gwlfe_chunks,
+                                 gwlfe_samples,
+                                 resolve_subbasin_weather)
+from apps.modeling.tasks import (merge_gwlfe_variants,
+                                 run_gwlfe,
+                                 run_gwlfe_variants,
+                                 store_subbasin_mapshed_artifacts,
+                                 subbasin_results_to_dict,
+                                 summarize_gwlfe_samples)
 from apps.modeling.mapshed.calcs import streams
 from apps.modeling.mapshed.tasks import (collect_data,
                                          collect_subbasin,
@@ -48,7 +57,10 @@ from apps.geoprocessing_api.validation import (check_exactly_one_provided,
                                                validate_global_rwd,
                                                validate_uuid,
                                                validate_gwlfe_prepare,
-                                               validate_gwlfe_run)
+                                               validate_gwlfe_prepared,
+                                               validate_gwlfe_run,
+                                               validate_gwlfe_sensitivity,
+                                               validate_gwlfe_sweep)
 
 
 @swagger_auto_schema(method='post',
@@ -2027,7 +2039,7 @@ def start_analyze_drainage_area(request, format=None):
     return start_celery_job([
         multi_mapshed(huc12_geojson, huc12_wkaoi),
         convert_data.s(huc12_wkaoi),
-        collect_data.s(huc12_geojson),
+        collect_data.s(huc12_geojson, wkaoi=huc12_wkaoi),
         run_gwlfe.s(inputmod_hash=''),
         # TODO Scale results to Drainage Area
     ], area_of_interest, user)
@@ -2097,7 +2109,8 @@ def start_modeling_gwlfe_prepare(request, format=None):
     return start_celery_job([
         multi_mapshed(area_of_interest, wkaoi, layer_overrides),
         convert_data.s(wkaoi),
-        collect_data.s(area_of_interest, layer_overrides=layer_overrides),
+        collect_data.s(area_of_interest, layer_overrides=layer_overrides,
+                       wkaoi=wkaoi),
     ], area_of_interest, user)
 
 
@@ -2135,6 +2148,95 @@ def start_modeling_gwlfe_run(request, format=None):
     ], model_input, user)
 
 
+@swagger_auto_schema(method='post',
+                     request_body=schemas.GWLFE_SWEEP_REQUEST,
+                     responses={200: schemas.JOB_STARTED_RESPONSE})
+@decorators.api_view(['POST'])
+@decorators.authentication_classes((SessionAuthentication,
+                                    TokenAuthentication, ))
+@decorators.permission_classes((IsAuthenticated, ))
+@decorators.throttle_classes([BurstRateThrottle, SustainedRateThrottle])
+@log_request
+def start_modeling_gwlfe_sweep(request, format=None):
+    """
+    Starts a job to run GWLF-E for many variants of a given prepared input.
+
+    Given an `input` JSON of the gwlf-e/prepare endpoint's `result`, or a
+    `job_uuid` of a gwlf-e/prepare job, and an object of `variants`, each a
+    list of modifications, runs GWLF-E on the input with each variant's
+    modifications, applied after the common `modifications`, if any.
+
+    The result is an object of the variant names to their results, which are
+    the same as those of the gwlf-e/run endpoint. This is much faster than
+    starting a gwlf-e/run job for each variant, as the input is read once,
+    and the variants are run in parallel.
+
+    If the specified `job_uuid` is not ready or has failed, returns an error.
+    """
+    user = request.user if request.user.is_authenticated else None
+    model_input, job_uuid, mods, hash = _parse_gwlfe_input(request)
+    validate_gwlfe_prepared(model_input)
+
+    variants = request.data.get('variants')
+    validate_gwlfe_sweep(variants)
+
+    return _start_gwlfe_variants_job(user, model_input, mods, variants, hash,
+                                     merge_gwlfe_variants.s(), job_uuid)
+
+
+@swagger_auto_schema(method='post',
+                     request_body=schemas.GWLFE_SENSITIVITY_REQUEST,
+                     responses={200: schemas.JOB_STARTED_RESPONSE})
+@decorators.api_view(['POST'])
+@decorators.authentication_classes((SessionAuthentication,
+                                    TokenAuthentication, ))
+@decorators.permission_classes((IsAuthenticated, ))
+@decorators.throttle_classes([BurstRateThrottle, SustainedRateThrottle])
+@log_request
+def start_modeling_gwlfe_sensitivity(request, format=None):
+    """
+    Starts a job to analyze the sensitivity of GWLF-E to some parameters of a
+    given prepared input.
+
+    Given an `input` JSON of the gwlf-e/prepare endpoint's `result`, or a
+    `job_uuid` of a gwlf-e/prepare job, an object of `parameters` to the
+    distributions to sample them from, and a number of `samples`, draws that
+    many samples of the parameters and runs GWLF-E on the input with each,
+    after applying the common `modifications`, if any.
+
+    The result has the same shape as that of the gwlf-e/run endpoint, with
+    each number replaced by its 5th, 25th, 50th, 75th and 95th percentiles
+    across the samples, as listed in `percentiles`. It also has the `seed`
+    the samples were drawn with, which can be given to repeat the analysis
+    with the same samples and results.
+
+    If the specified `job_uuid` is not ready or has failed, returns an error.
+    """
+    user = request.user if request.user.is_authenticated else None
+    model_input, job_uuid, mods, hash = _parse_gwlfe_input(request)
+    validate_gwlfe_prepared(model_input)
+
+    parameters = request.data.get('parameters')
+    samples = request.data.get('samples')
+    seed = request.data.get('seed')
+
+    # Relative parameters multiply their values after the common modifications
+    base_input = apply_gwlfe_modifications(model_input, mods)
+    validate_gwlfe_sensitivity(base_input, parameters, samples, seed)
+
+    if seed is None:
+        seed = randbelow(2 ** 32)
+
+    # Samples are run as variants named by their index, so that they can be
+    # summarized in the order they were drawn
+    variants = {str(i): [sample] for i, sample in enumerate(
+        gwlfe_samples(base_input, parameters, samples, seed))}
+
+    return _start_gwlfe_variants_job(user, model_input, mods, variants, hash,
+                                     summarize_gwlfe_samples.s(seed),
+                                     job_uuid, samples=True)
+
+
 @swagger_auto_schema(method='post',
                      request_body=schemas.SUBBASIN_REQUEST,
                      responses={200: schemas.JOB_STARTED_RESPONSE})
@@ -2180,7 +2282,7 @@ def start_modeling_subbasin_prepare(request, format=None):
         multi_subbasin(area_of_interest, huc12s, layer_overrides),
         collect_subbasin.s(huc12s, layer_overrides),
         subbasin_results_to_dict.s()
-    ], request.data, user)
+    ], request.data, user, after_save=store_subbasin_mapshed_artifacts)
 
 
 @swagger_auto_schema(method='post',
@@ -2286,7 +2388,7 @@ def _initiate_rwd_job_chain(location, snapping, simplify, data_source,
 
 
 def start_celery_job(task_list, job_input, user=None, link_error=True,
-                     messages=list()):
+                     messages=list(), after_save=None):
     """
     Given a list of Celery tasks and it's input, starts a Celery async job with
     those tasks, adds save_job_result and save_job_error handlers, and returns
@@ -2298,6 +2400,8 @@ def start_celery_job(task_list, job_input, user=None, link_error=True,
     :param link_error: Whether or not to apply error handler to entire chain
     :param messages: A list of messages to include in the output
                      (e.g. deprecations)
+    :param after_save: A task to run with the job's id once its result is
+                       saved. Optional.
     :return: A Response contianing the job id, marked as JobStatus.STARTED
     """
     created = now()
@@ -2308,6 +2412,9 @@ def start_celery_job(task_list, job_input, user=None, link_error=True,
     success = save_job_result.s(job.id, job_input)
     error = save_job_error.s(job.id)
 
+    if after_save is not None:
+        success.set(link=after_save.si(job.id))
+
     task_list.append(success)
     if link_error:
         task_chain = chain(task_list).apply_async(link_error=error)
@@ -2461,6 +2568,57 @@ def _parse_gwlfe_input(request, raw_input=True):
         raise exceptions.JobFailedError(
             f'The prepare job {job_uuid} has failed.')
 
-    model_input = json.loads(input_job.result)
+    model_input = resolve_subbasin_weather(json.loads(input_job.result))
 
     return model_input, job_uuid, mods, hash
+
+
+def _start_gwlfe_variants_job(user, model_input, mods, variants, hash,
+                              callback, job_uuid=None, samples=False):
+    """
+    Starts a job running GWLF-E on the model_input with each of the variants,
+    a dictionary of names to lists of modifications applied after the common
+    mods, in chunks spread over the workers. The callback is given the
+    results of the chunks, and its result is saved as the job's. If samples
+    is True, the variants are random samples, run as `run_gwlfe_variants`
+    runs them with samples=True.
+
+    As with start_modeling_subbasin_run, the job and its chain are made
+    manually, since error handlers cannot be added to groups.
+    """
+    job = Job.objects.create(created_at=now(), result='', error='',
+                             traceback='', user=user,
+                             status=JobStatus.STARTED)
+    errback = save_job_error.s(job.id)
+
+    # Each chunk of variants is sent the input once
+    variant_chunks = gwlfe_chunks(list(variants.keys()), model_input['WxYrs'])
+
+    task_chain = chain(
+        group([
+            run_gwlfe_variants.s(model_input, mods,
+                                 {name: variants[name] for name in names},
+                                 hash, samples)
+            .set(link_error=errback)
+            for names in variant_chunks]) |
+        callback.set(link_error=errback) |
+        save_job_result.s(job.id, job_uuid or model_input)
+    ).apply_async()
+
+    job.uuid = task_chain.id
+    job.save()
+
+    return Response(
+        {
+            'job': task_chain.id,
+            'job_uuid': task_chain.id,
+            'status': JobStatus.STARTED,
+            # TODO Remove this message when `job` is deprecated
+            'messages': [
+                'The `job` field will be deprecated in an upcoming release. '
+                'Please switch to using `job_uuid` instead.'
+            ],
+        },
+        headers={'Location': reverse('geoprocessing_api:get_job',
+                                     args=[task_chain.id])}
+    )
@@ -1,28 +1,56 @@
 # -*- coding: utf-8 -*-
 import csv
 import json
+import os
 import requests
+import zlib
+
+import numpy as np
 
 from contextlib import closing
+from math import ceil
 from copy import deepcopy
 from datetime import datetime, timedelta
 
+from celery import current_app
 from rest_framework.exceptions import NotFound, ValidationError
 
 from django.conf import settings
-from django.db import connection
+from django.core.cache import cache
+from django.db import connection, transaction
 
 from apps.modeling.mapshed.calcs import (area_calculations,
                                          nearest_weather_stations,
                                          average_weather_data
                                          )
-from apps.modeling.models import WeatherType
+from apps.core.models import Job
+from apps.modeling.models import SubbasinArtifact, WeatherType
 
 
 NODATA = -999.0
 HECTARES_PER_SQM = 0.0001
 DATE_FORMAT = '%m/%d/%Y'
 MAX_ERRORS = 10  # Number of maximum errors reported while parsing weather data
+# Key of the weather series shared by subbasins in their MapShed results.
+# See `share_subbasin_weather` below.
+SHARED_WEATHER = 'shared_weather'
+# Cache keys of the measured GWLF-E seconds per weather year of an input, of
+# the number of worker processes and the processes each runs a chunk in, and
+# of whether they have been counted recently. See `gwlfe_chunks` below.
+SECONDS_PER_YEAR_KEY = 'subbasin_gwlfe_seconds_per_year'
+WORKER_CONCURRENCY_KEY = 'subbasin_gwlfe_worker_concurrency'
+WORKER_PROCESSES_KEY = 'subbasin_gwlfe_worker_processes'
+WORKERS_COUNTED_KEY = 'subbasin_gwlfe_workers_counted'
+# Weight of each new measurement of the seconds per weather year
+SECONDS_PER_YEAR_WEIGHT = 0.2
+# Distributions GWLF-E parameters may be sampled from, as the names of
+# numpy.random.Generator methods, to the names of their arguments
+SAMPLE_DISTRIBUTIONS = {
+    'uniform': ['low', 'high'],
+    'normal': ['loc', 'scale'],
+    'lognormal': ['mean', 'sigma'],
+    'triangular': ['left', 'mode', 'right'],
+}
 
 
 def get_weather_modifications(csv_file):
@@ -324,7 +352,20 @@ def apply_gwlfe_modifications(gms, modifications):
     # can be used by simply updating modified_gms.
     array_mods = []
     key_mods = []
-    modified_gms = deepcopy(gms)
+
+    # Copy on write: modified_gms starts out sharing every value with gms,
+    # including the large Temp and Prec arrays, and only the arrays that
+    # are modified are copied, the first time they are. Neither gms nor its
+    # values are changed.
+    modified_gms = dict(gms)
+    copied_arrays = set()
+
+    def modify_array(key, value):
+        gmskey, i = key.split('__')
+        if gmskey not in copied_arrays:
+            modified_gms[gmskey] = list(modified_gms[gmskey])
+            copied_arrays.add(gmskey)
+        modified_gms[gmskey][int(i)] = value
 
     for mod in modifications:
         for key, value in mod.items():
@@ -332,21 +373,20 @@ def apply_gwlfe_modifications(gms, modifications):
                 if key[:6] == 'Area__':
                     # Extract area modifications early, since we need them to
                     # derive other modifications
-                    gmskey, i = key.split('__')
-                    modified_gms[gmskey][int(i)] = value
+                    modify_array(key, value)
                 else:
                     array_mods.append({key: value})
             else:
                 key_mods.append({key: value})
 
-    # Apply modifications derived from area first, so they can be overridden
+    # Apply modifications derived from area first, so they can be overridden.
+    # This replaces the values it derives, rather than changing them in place.
     modified_gms = area_calculations(modified_gms['Area'], modified_gms)
 
     # Now apply user specified modifications, which take final precedence
     for mod in array_mods:
         for key, value in mod.items():
-            gmskey, i = key.split('__')
-            modified_gms[gmskey][int(i)] = value
+            modify_array(key, value)
 
     for mod in key_mods:
         modified_gms.update(mod)
@@ -397,6 +437,318 @@ def sum_subbasin_stream_lengths(gmss):
     }
 
 
+def share_subbasin_weather(gmss):
+    """
+    Given a dictionary of subbasin ids to their MapShed data, moves the
+    Temp and Prec arrays, which are the bulk of it, and are the same for the
+    many subbasins that share weather stations, to a dictionary of distinct
+    series under the SHARED_WEATHER key. Each subbasin refers to its series
+    by WeatherKey:
+
+        {
+            '{{ subbasin_id }}': { ..., 'WeatherKey': '0' },
+            ...
+            SHARED_WEATHER: { '0': { 'Temp': [...], 'Prec': [...] } },
+        }
+
+    Use `resolve_subbasin_weather` to restore it.
+    """
+    shared = {}
+    keys_by_stations = {}
+    compact = {}
+
+    for subbasin_id, gms in gmss.items():
+        weather = {'Temp': gms['Temp'], 'Prec': gms['Prec']}
+        stations = tuple(ws['station'] for ws in gms['WeatherStations'])
+        keys = keys_by_stations.setdefault(stations, [])
+
+        # Subbasins with the same stations almost always have the same
+        # series, but the series are compared to be sure
+        key = next((k for k in keys if shared[k] == weather), None)
+        if key is None:
+            key = str(len(shared))
+            shared[key] = weather
+            keys.append(key)
+
+        compact[subbasin_id] = {k: v for k, v in gms.items()
+                                if k not in weather}
+        compact[subbasin_id]['WeatherKey'] = key
+
+    compact[SHARED_WEATHER] = shared
+
+    return compact
+
+
+def resolve_subbasin_weather(gmss):
+    """
+    Given the result of `share_subbasin_weather`, returns the dictionary of
+    subbasin ids to their MapShed data with their Temp and Prec arrays. The
+    arrays are shared, not copied, between subbasins. Anything else is
+    returned as is.
+    """
+    if not isinstance(gmss, dict) or SHARED_WEATHER not in gmss:
+        return gmss
+
+    shared = gmss[SHARED_WEATHER]
+    resolved = {}
+
+    for subbasin_id, gms in gmss.items():
+        if subbasin_id == SHARED_WEATHER:
+            continue
+
+        resolved[subbasin_id] = {k: v for k, v in gms.items()
+                                 if k != 'WeatherKey'}
+        resolved[subbasin_id].update(shared[gms['WeatherKey']])
+
+    return resolved
+
+
+def store_subbasin_artifacts(mapshed_job_uuid, gmss):
+    """
+    Given the uuid of a subbasin MapShed job and its resolved result, stores
+    the MapShed data of each subbasin, and each weather series they share, as
+    a SubbasinArtifact, unless they already have been. This lets subbasin
+    GWLF-E tasks read only their chunk with `load_subbasin_gmss`, instead of
+    parsing the whole result.
+    """
+    if SubbasinArtifact.objects.filter(job_id=mapshed_job_uuid).exists():
+        return
+
+    compact = share_subbasin_weather(gmss)
+    shared = compact.pop(SHARED_WEATHER)
+
+    def artifact(key, data):
+        return SubbasinArtifact(job_id=mapshed_job_uuid, key=key,
+                                data=zlib.compress(json.dumps(data).encode()))
+
+    artifacts = [artifact(subbasin_id, gms)
+                 for subbasin_id, gms in compact.items()]
+    artifacts += [artifact(f'{SHARED_WEATHER}__{key}', weather)
+                  for key, weather in shared.items()]
+
+    # Concurrent runs of the same job store the same artifacts
+    with transaction.atomic():
+        SubbasinArtifact.objects.bulk_create(artifacts, ignore_conflicts=True)
+
+
+def load_subbasin_gmss(mapshed_job_uuid, subbasin_ids=None, weather=True):
+    """
+    Returns the resolved MapShed data of the given subbasins, or of all of
+    them, of a subbasin MapShed job. If weather is False, their Temp and
+    Prec arrays are not read, and each refers to its series by WeatherKey.
+
+    Falls back to the job's result for jobs without SubbasinArtifacts.
+    """
+    artifacts = SubbasinArtifact.objects.filter(job_id=mapshed_job_uuid)
+    if subbasin_ids is None:
+        artifacts = artifacts.exclude(key__startswith=SHARED_WEATHER)
+    else:
+        artifacts = artifacts.filter(key__in=subbasin_ids)
+
+    gmss = {a.key: json.loads(zlib.decompress(a.data))
+            for a in artifacts.only('key', 'data')}
+
+    if not gmss:
+        mapshed_job = Job.objects.get(uuid=mapshed_job_uuid)
+        gmss = resolve_subbasin_weather(json.loads(mapshed_job.result))
+        if subbasin_ids is not None:
+            gmss = {subbasin_id: gmss[subbasin_id]
+                    for subbasin_id in subbasin_ids}
+        return gmss
+
+    if not weather:
+        return gmss
+
+    keys = {f'{SHARED_WEATHER}__{gms["WeatherKey"]}': gms['WeatherKey']
+            for gms in gmss.values()}
+    gmss[SHARED_WEATHER] = {
+        keys[a.key]: json.loads(zlib.decompress(a.data))
+        for a in SubbasinArtifact.objects.filter(job_id=mapshed_job_uuid,
+                                                 key__in=keys)
+    }
+
+    return resolve_subbasin_weather(gmss)
+
+
+def worker_concurrency():
+    """
+    Returns the number of worker processes, and the processes each of them
+    runs the subbasins of a chunk in, as last counted by the workers with
+    `count_workers`, or from settings.SUBBASIN_GWLFE until they have been.
+
+    Only reads the cache, so that requests do not wait for workers to reply.
+    """
+    config = settings.SUBBASIN_GWLFE
+    counted = cache.get_many([WORKER_CONCURRENCY_KEY, WORKER_PROCESSES_KEY])
+
+    return (counted.get(WORKER_CONCURRENCY_KEY) or config['concurrency'],
+            counted.get(WORKER_PROCESSES_KEY) or config['pool_processes'] or 1)
+
+
+def count_workers():
+    """
+    Counts the worker processes from the running workers, waiting up to
+    settings.SUBBASIN_GWLFE['inspect_timeout'] seconds for them to reply, and
+    caches their number, and that of the processes each runs a chunk in, for
+    `worker_concurrency`. Called by the workers themselves, at most once
+    every 'concurrency_timeout' seconds. If none reply, or inspect_timeout
+    is 0, 'concurrency' is cached instead.
+    """
+    config = settings.SUBBASIN_GWLFE
+
+    if not cache.add(WORKERS_COUNTED_KEY, True,
+                     timeout=config['concurrency_timeout']):
+        return
+
+    concurrency = 0
+    if config['inspect_timeout']:
+        inspect = current_app.control.inspect(
+            timeout=config['inspect_timeout'])
+        try:
+            stats = inspect.stats() or {}
+            concurrency = sum(s['pool']['max-concurrency']
+                              for s in stats.values())
+        except Exception:
+            pass
+
+    # Kept until counted again, rather than falling back to the settings
+    cache.set_many({
+        WORKER_CONCURRENCY_KEY: concurrency or config['concurrency'],
+        WORKER_PROCESSES_KEY: subbasin_pool_processes(),
+    }, timeout=None)
+
+
+def subbasin_chunk_size(subbasin_count, subbasin_seconds, concurrency,
+                        processes=1):
+    """
+    Given the number of subbasins, the seconds GWLF-E takes for each, the
+    number of worker processes, and the processes each runs the subbasins of
+    a chunk in, returns how many subbasins to run per chunk.
+
+    Subbasins are spread over every worker process, in chunks no longer than
+    settings.SUBBASIN_GWLFE['max_chunk_seconds'], so that no chunk keeps the
+    job waiting long after the others. There are never more chunks than
+    'max_chunks', as the request waits for all of them to be submitted.
+    """
+    config = settings.SUBBASIN_GWLFE
+
+    size = ceil(subbasin_count / max(concurrency, 1))
+    size = min(size, max(int(config['max_chunk_seconds'] * processes //
+                             max(subbasin_seconds, 1e-6)), 1))
+    size = max(size, ceil(subbasin_count / config['max_chunks']), 1)
+
+    # Even out the chunks, so that the last is not much shorter
+    return ceil(subbasin_count / ceil(subbasin_count / size))
+
+
+def subbasin_pool_processes(run_count=None):
+    """
+    Given the number of GWLF-E runs in a chunk, or None for any number,
+    returns how many processes to run them in, from
+    settings.SUBBASIN_GWLFE['pool_processes'], or if that is 0, from the CPUs
+    of this host left to each of the 'concurrency' worker processes.
+    """
+    config = settings.SUBBASIN_GWLFE
+
+    processes = (config['pool_processes'] or
+                 (os.cpu_count() or 1) // max(config['concurrency'], 1))
+
+    if run_count is not None:
+        processes = min(processes, run_count)
+
+    return max(processes, 1)
+
+
+def subbasin_gwlfe_chunks(gmss):
+    """
+    Given a dictionary of subbasin ids to their MapShed data, splits the ids
+    into chunks with `gwlfe_chunks`.
+    """
+    if not gmss:
+        return []
+
+    return gwlfe_chunks(list(gmss.keys()),
+                        max(gms['WxYrs'] for gms in gmss.values()))
+
+
+def gwlfe_chunks(run_ids, weather_years):
+    """
+    Given the ids of GWLF-E runs with the given number of weather years,
+    splits them into chunks sized by `subbasin_chunk_size`, from the GWLF-E
+    runtime measured by `record_gwlfe_seconds`, and the workers counted by
+    `count_workers`.
+    """
+    seconds_per_year = (cache.get(SECONDS_PER_YEAR_KEY) or
+                        settings.SUBBASIN_GWLFE['seconds_per_year'])
+    concurrency, processes = worker_concurrency()
+
+    size = subbasin_chunk_size(len(run_ids),
+                               seconds_per_year * weather_years,
+                               concurrency, processes)
+
+    return [run_ids[x:x + size] for x in range(0, len(run_ids), size)]
+
+
+def record_gwlfe_seconds(seconds, weather_years):
+    """
+    Given the seconds GWLF-E took to run an input with the given number of
+    weather years, in one process, updates the moving average of the seconds
+    per year read by `gwlfe_chunks`.
+    """
+    measured = seconds / max(weather_years, 1)
+    average = cache.get(SECONDS_PER_YEAR_KEY)
+
+    if average is not None:
+        measured = (SECONDS_PER_YEAR_WEIGHT * measured +
+                    (1 - SECONDS_PER_YEAR_WEIGHT) * average)
+
+    cache.set(SECONDS_PER_YEAR_KEY, measured, timeout=None)
+
+
+def gwlfe_samples(gms, parameters, count, seed):
+    """
+    Given MapShed data, a dictionary of parameter keys to the distributions
+    to sample them from, the number of samples and a seed, returns a list of
+    modifications, one per sample, in the format of
+    `apply_gwlfe_modifications`.
+
+    Parameter keys are those of modifications, e.g. `RecessionCoef` or
+    `CN__1`. Each distribution has a `distribution` name from
+    SAMPLE_DISTRIBUTIONS and its arguments. If `relative` is true, the
+    sampled values multiply the parameter's value in gms instead of replacing
+    it, which allows whole arrays like `KF` to be scaled.
+
+    The samples are the same for the same seed.
+    """
+    rng = np.random.default_rng(seed)
+    modifications = [{} for _ in range(count)]
+
+    # Parameters are sampled in a fixed order, so that each is given the same
+    # values regardless of the order they were specified in
+    for key in sorted(parameters):
+        spec = parameters[key]
+        name = spec['distribution']
+        values = getattr(rng, name)(
+            *[spec[arg] for arg in SAMPLE_DISTRIBUTIONS[name]], size=count)
+
+        if spec.get('relative'):
+            if '__' in key:
+                gmskey, i = key.split('__')
+                base = gms[gmskey][int(i)]
+            else:
+                base = gms[key]
+        else:
+            base = 1
+
+        for mod, value in zip(modifications, values.tolist()):
+            if isinstance(base, list):
+                mod[key] = [v * value for v in base]
+            else:
+                mod[key] = base * value
+
+    return modifications
+
+
 def get_layer_shape(table_code, id):
     """
     Fetch shape of well known area of interest.
@@ -1,20 +1,102 @@
 # -*- coding: utf-8 -*-
+import gzip
+import logging
+import math
+import os
+import random
 import requests
 import json
+import time
+
+import numpy as np
 
 from ast import literal_eval as make_tuple
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from functools import partial
+from hashlib import blake2b
+from uuid import uuid4
 
 from celery import shared_task
 from celery.exceptions import Retry
 
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, Timeout
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 from django.core.cache import cache
 from django.conf import settings
 
+from django_redis import get_redis_connection
+
+from apps.modeling.calcs import split_into_huc12s
+from apps.modeling.tiling import (aoi_area, merge_tiles, split_into_tiles,
+                                  tile_operations)
+
+logger = logging.getLogger(__name__)
+
+
+class GeoprocessingError(Exception):
+    """
+    An error response from the geoprocessing service.
+    """
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GeoprocessingUnavailable(Exception):
+    """
+    Raised instead of making requests while the circuit breaker is open.
+    """
+    pass
+
+
 NOCACHE = 'nocache'
 
+# Decimal places of coordinates, ~10cm in degrees, considered when hashing
+# geometries for caching. See `geometry_hash` below.
+SHAPE_HASH_PRECISION = 6
+
+# Prefix of the cache keys registering the layers of each cache namespace,
+# and the namespaces registered by this process. See `cache_namespace` below.
+NAMESPACE_PREFIX = 'geop_namespace_'
+_registered_namespaces = set()
+
+# Operation types of /run requests that can be batched into /multi requests,
+# and the seconds a batch leader may take past the window before another
+# task takes over. See `batched_run` below.
+BATCHABLE_OPERATIONS = {'RasterGroupedCount', 'RasterGroupedAverage'}
+BATCH_LEADER_GRACE = 5
+
+# Cache key of the time the circuit breaker was opened, if it is open, and of
+# the half-open probe. See `breaker_admit` below.
+BREAKER_KEY = 'geop_breaker'
+BREAKER_PROBE_KEY = 'geop_breaker_probe'
+
+# Well-known areas of interest, and operations over them, whose results are
+# summed from those of their HUC-12s. See `rollup` below.
+ROLLUP_CODES = {'huc8', 'huc10'}
+ROLLUP_OPERATIONS = {'RasterGroupedCount'}
+
+# Seconds between checks for a result being computed by another task
+LEASE_POLL_INTERVAL = 0.25
+
+# Process-wide HTTP session for the geoprocessing service, and the id of
+# the process it was created in. See `get_session` below.
+_session = None
+_session_pid = None
+
+# Per-endpoint request counters for this process. See `client_stats` below.
+_client_stats = defaultdict(lambda: {
+    'requests': 0,
+    'errors': 0,
+    'bytes_sent': 0,
+    'total_seconds': 0.0,
+    'max_seconds': 0.0,
+})
+
 
 @shared_task(bind=True, default_retry_delay=1, max_retries=6)
 def run(self, opname, input_data, wkaoi=None, cache_key='',
@@ -33,7 +115,13 @@ def run(self, opname, input_data, wkaoi=None, cache_key='',
     If a well-known area of interest id is specified in wkaoi, checks to see
     if there is a cached result for that wkaoi and operation. If so, returns
     that immediately. If not, starts the geoprocessing operation, and saves the
-    results to they key before passing them on.
+    results to they key before passing them on. Other areas of interest are
+    cached the same way, for GEOP['shape_cache_timeout'] seconds, under an id
+    derived from their content. See `content_id`. While one task is computing
+    an uncached result, others that need the same one wait for it to be
+    published instead of submitting duplicate requests. See `acquire_lease`.
+    If it is not published within GEOP['lease_wait'] seconds, they are
+    retried, rather than computing it with what is left of their time limit.
 
     When using a parameterizable operation, such as 'ppt' or 'tmean', a special
     cache_key can be provided which will be used for caching instead of the
@@ -43,7 +131,11 @@ def run(self, opname, input_data, wkaoi=None, cache_key='',
     should be overridden, they may be specified in layer_overrides.
 
     To be used for single operation requests. Uses the /run endpoint of the
-    geoprocessing service.
+    geoprocessing service, unless GEOP['batch_window'] is set and the
+    operation can be batched with others into a /multi request. See
+    `batched_run`. Such operations over shapes larger than
+    GEOP['tile_threshold'] are split into tiles. See `tiled_multi`. Counts
+    over HUC-8s and HUC-10s are summed from their HUC-12s. See `rollup`.
 
     :param opname: Name of operation. Must exist in settings.GEOP['json']
     :param input_data: Dictionary of values to extend base operation JSON with
@@ -63,14 +155,58 @@ def run(self, opname, input_data, wkaoi=None, cache_key='',
         }
 
     key = ''
+    timeout = None
+    owner = None
 
-    if wkaoi and settings.GEOP['cache']:
-        layers_cache_key = '__'.join(layer_overrides.values())
-        key = f'geop_{wkaoi}__{opname}{layers_cache_key}{cache_key}'
+    if settings.GEOP['cache'] and (wkaoi or input_data.get('polygon')):
+        namespace = cache_namespace(settings.GEOP['json'][opname]['input'],
+                                    layer_overrides)
+
+        if wkaoi:
+            key = f'geop_{namespace}__{wkaoi}__{opname}{cache_key}'
+        else:
+            # Other areas of interest are cached by their content
+            other_input = {k: v for k, v in input_data.items()
+                           if k != 'polygon'}
+            shape_id = content_id(input_data['polygon'], other_input)
+            key = f'geop_{namespace}__{shape_id}__{opname}{cache_key}'
+            timeout = settings.GEOP['shape_cache_timeout']
+
+    if key:
         cached = cache.get(key)
         if cached:
             return cached
 
+        owner = self.request.id or str(uuid4())
+
+    try:
+        # Only one task computes a given uncached result at a time. Others
+        # wait for it to be published, and are retried if it is not, to
+        # compute it themselves if the lease holder failed.
+        if owner and not acquire_lease(key, owner):
+            owner = None
+            published = await_results([key])
+            if key not in published:
+                _retry_unpublished(self.retry, [key])
+            return published[key]
+
+        return _run(opname, input_data, key, timeout, layer_overrides,
+                    self.retry, wkaoi)
+    except Retry:
+        # The retried task has the same id, so it resumes holding the lease
+        owner = None
+        raise
+    except Exception as x:
+        return {
+            'error': str(x)
+        }
+    finally:
+        if owner:
+            release_lease(key, owner)
+
+
+def _run(opname, input_data, key, timeout, layer_overrides, retry,
+         wkaoi=None):
     data = deepcopy(settings.GEOP['json'][opname])
     data['input'].update(input_data)
 
@@ -94,13 +230,31 @@ def run(self, opname, input_data, wkaoi=None, cache_key='',
     if 'vector' in data['input'] and data['input']['vector'] == [None]:
         result = {}
         if key:
-            cache.set(key, result, None)
+            cache.set(key, result, timeout)
         return result
 
     try:
-        result = geoprocess('run', data, self.retry)
+        rolled = None
+        if (key and is_batchable(data['input']) and
+                can_rollup(wkaoi, data['input']['operationType'])):
+            operation = multi_operation(opname, data['input'])
+            rolled = rollup(wkaoi, [operation], {opname: key}, retry)
+
+        if rolled is not None:
+            result = run_result(operation, rolled[opname])
+        elif (is_batchable(data['input']) and
+                needs_tiling(data['input']['polygon'][0])):
+            operation = multi_operation(opname, data['input'])
+            shape = {'id': opname, 'shape': data['input']['polygon'][0]}
+            result = run_result(operation, tiled_multi(
+                {'operations': [operation]}, shape, [opname], retry)[opname])
+        elif settings.GEOP['batch_window'] and is_batchable(data['input']):
+            result = batched_run(opname, data['input'], retry)
+        else:
+            result = geoprocess('run', data, retry)
+
         if key:
-            cache.set(key, result, None)
+            cache.set(key, result, timeout)
         return result
     except Retry as r:
         raise r
@@ -175,21 +329,29 @@ def multi(self, opname, shapes, stream_lines, layer_overrides={}):
 
     Each `operation_results` is cached with the key:
 
-        {{ shape_id }}__{{ operation_label }}{{ layers_cache_key }}
+        geop_{{ namespace }}__{{ shape_id }}__{{ operation_label }}
 
-    where `layers_cache_key` is a string of optional layers provided.
+    where `namespace` identifies the layers used by the operation, including
+    any overrides. See `cache_namespace`.
 
     Before running the geoprocessing service, we inspect the cache to see
-    if all the requested operations are already cached for this shape. If so,
-    we remove that shape from the payload.
-
-    If not found in the cache, the specified operations are run for that shape
-    as part of the payload. Once we have the results back, we cache them. Since
-    we are using the same cache naming scheme as run, any operation cached via
-    `multi` can be reused by `run`.
+    which of the requested operations are already cached for each shape. Only
+    the uncached ones are run, with one request for each set of shapes that
+    need the same operations, and shapes with everything cached are left out.
+
+    Once we have the results back, we cache them and merge them with the
+    cached ones. Since we are using the same cache naming scheme as run, any
+    operation cached via `multi` can be reused by `run`.
+
+    As in `run`, operations that are being computed by other tasks are not
+    submitted again. Their results are awaited after our own requests, for
+    what is left of GEOP['lease_wait'] seconds from the start of the task,
+    which is retried if they are not published by then. Counts over HUC-8s
+    and HUC-10s are summed from their HUC-12s, as in `run`. See `rollup`.
     """
+    started = time.monotonic()
+
     data = deepcopy(settings.GEOP['json'][opname])
-    data['shapes'] = []
 
     # Don't include the RasterLinesJoin operation if the AoI does
     # not contain streams
@@ -199,12 +361,10 @@ def multi(self, opname, shapes, stream_lines, layer_overrides={}):
         data['operations'] = [o for o in data['operations']
                               if not (o.get('name') == 'RasterLinesJoin')]
 
-    operation_count = len(data['operations'])
     output = {}
 
     # Populate layers
     layer_config = dict(settings.GEOP['layers'], **layer_overrides)
-    layers_cache_key = '__'.join(layer_overrides.values())
 
     try:
         for oidx, operation in enumerate(data['operations']):
@@ -220,39 +380,70 @@ def multi(self, opname, shapes, stream_lines, layer_overrides={}):
             'error': str(x)
         }
 
+    owner = self.request.id or str(uuid4())
+    leased = []
+    awaited = {}
+    pending = {}
+    cache_keys = multi_cache_keys(opname, shapes, data, layer_overrides)
+
     # Get cached results
     for shape in shapes:
-        cached_operations = 0
-        if not shape['id'].startswith(NOCACHE):
-            output[shape['id']] = {}
-            for op in data['operations']:
-                key = f'geop_{shape["id"]}__{op["label"]}{layers_cache_key}'
-                cached = cache.get(key)
-                if cached:
-                    output[shape['id']][op['label']] = cached
-                    cached_operations += 1
-
-        if cached_operations != operation_count:
-            data['shapes'].append(shape)
-
-    # If no un-cached shapes, return cached output
-    if not data['shapes']:
+        if shape['id'] not in cache_keys:
+            pending[shape['id']] = [op['label'] for op in data['operations']]
+            continue
+
+        keys, _ = cache_keys[shape['id']]
+        cached = cache.get_many(list(keys.values()))
+
+        output[shape['id']] = {label: cached[key]
+                               for label, key in keys.items()
+                               if cached.get(key)}
+
+        # Compute the missing results we get leases for, and wait for the
+        # ones being computed by other tasks
+        for label, key in keys.items():
+            if label in output[shape['id']]:
+                continue
+            if acquire_lease(key, owner):
+                leased.append(key)
+                pending.setdefault(shape['id'], []).append(label)
+            else:
+                awaited.setdefault(shape['id'], {})[label] = key
+
+    # If no un-cached operations, return cached output
+    if not pending and not awaited:
         return output
 
     try:
-        result = geoprocess('multi', data, self.retry)
-
-        # Set cached results
-        for shape_id, operation_results in result.items():
-            if not shape_id.startswith(NOCACHE):
-                for op_label, value in operation_results.items():
-                    key = f'geop_{shape_id}__{op_label}{layers_cache_key}'
-                    cache.set(key, value, None)
-
-        output.update(result)
+        if pending:
+            _multi(data, shapes, pending, cache_keys, output, self.retry)
+
+            # Our results are published, and a retry need not hold them
+            for key in leased:
+                release_lease(key, owner)
+            leased = []
+
+        if awaited:
+            keys = [key for missing in awaited.values()
+                    for key in missing.values()]
+            published = await_results(
+                keys, started + settings.GEOP['lease_wait'])
+
+            # Results whose lease holders failed, or are taking too long,
+            # are computed by the retried task, which has the ones we have
+            # computed and been given in the cache
+            unpublished = [key for key in keys if key not in published]
+            if unpublished:
+                _retry_unpublished(self.retry, unpublished)
+
+            for shape_id, missing in awaited.items():
+                for label, key in missing.items():
+                    output[shape_id][label] = published[key]
 
         return output
     except Retry as r:
+        # The retried task has the same id, so it resumes holding the leases
+        leased = []
         raise r
     except ConnectionError:
         return {
@@ -262,37 +453,964 @@ def multi(self, opname, shapes, stream_lines, layer_overrides={}):
         return {
             'error': str(x)
         }
+    finally:
+        for key in leased:
+            release_lease(key, owner)
+
+
+def _multi(data, shapes, pending, cache_keys, output, retry):
+    """
+    Submit the pending operations of each shape, with one request per group
+    of shapes that need the same operations, and merge the results into
+    output. See `group_pending_operations`.
+
+    Counts over HUC-8s and HUC-10s are summed from those of their HUC-12s
+    where enough of them are cached. See `rollup`. Shapes larger than
+    GEOP['tile_threshold'] are split into tiles and submitted separately.
+    See `tiled_multi`.
+    """
+    shapes_by_id = {shape['id']: shape for shape in shapes}
+    operations = {op['label']: op for op in data['operations']}
+    pending = dict(pending)
+    results = defaultdict(dict)
+
+    for shape_id in list(pending):
+        rolled = None
+        if shape_id in cache_keys:
+            keys, _ = cache_keys[shape_id]
+            labels = [label for label in pending[shape_id]
+                      if can_rollup(shape_id, operations[label]['name'])]
+            if labels:
+                rolled = rollup(shape_id,
+                                [operations[label] for label in labels],
+                                {label: keys[label] for label in labels},
+                                retry)
+
+        if rolled is not None:
+            results[shape_id].update(rolled)
+            pending[shape_id] = [label for label in pending[shape_id]
+                                 if label not in rolled]
+            if not pending[shape_id]:
+                del pending[shape_id]
+
+    for shape_id in list(pending):
+        if needs_tiling(shapes_by_id[shape_id]['shape']):
+            results[shape_id].update(tiled_multi(
+                data, shapes_by_id[shape_id], pending.pop(shape_id), retry))
+
+    for labels, shape_ids in group_pending_operations(pending):
+        payload = dict(data,
+                       shapes=[shapes_by_id[sid] for sid in shape_ids],
+                       operations=[operations[label] for label in labels])
+
+        if not any(op.get('name') == 'RasterLinesJoin'
+                   for op in payload['operations']):
+            payload['streamLines'] = []
+
+        for shape_id, operation_results in geoprocess('multi', payload,
+                                                      retry).items():
+            results[shape_id].update(operation_results)
+
+    # Set cached results
+    for shape_id, operation_results in results.items():
+        if shape_id in cache_keys:
+            keys, timeout = cache_keys[shape_id]
+            for op_label, value in operation_results.items():
+                cache.set(keys[op_label], value, timeout)
+
+        output.setdefault(shape_id, {}).update(operation_results)
+
+
+def needs_tiling(geojson):
+    """
+    Returns True if tiling is enabled and the shape is larger than
+    GEOP['tile_threshold'] square meters.
+    """
+    threshold = settings.GEOP['tile_threshold']
+
+    return bool(threshold) and aoi_area(geojson) > threshold
+
+
+def tiled_multi(data, shape, labels, retry=None):
+    """
+    Compute the operations of the `multi` payload data with the given labels
+    over a large shape, by splitting it into grid-aligned tiles of
+    GEOP['tile_size'] meters and merging their results. Returns a dictionary
+    of labels to results, like those of `multi` for one shape.
+
+    Tiles are submitted GEOP['tile_batch_size'] at a time as the shapes of
+    /multi requests, up to GEOP['tile_concurrency'] of them in parallel, so
+    that no single request has to cover the whole shape.
+
+    Count histograms are summed exactly. Averages are weighted by the counts
+    of a companion operation, or tile areas. See `apps.modeling.tiling`.
+
+    All the tiles are computed within the calling task, so within the same
+    CELERY_TASK_TIME_LIMIT as one request over the whole shape. Tiling
+    bounds the size of each request and spreads them over the service, but
+    does not give a shape more time, which is why it is off by default.
+    """
+    tiles = split_into_tiles(shape['shape'], settings.GEOP['tile_size'])
+    by_label = {op['label']: op for op in data['operations']}
+    operations = [by_label[label] for label in labels]
+    tiled_operations = tile_operations(operations)
+
+    lines = any(op['name'] == 'RasterLinesJoin' for op in operations)
+    size = settings.GEOP['tile_batch_size']
+
+    payloads = [{
+        'shapes': [{'id': str(idx), 'shape': tile}
+                   for idx, (tile, _) in enumerate(tiles[start:start + size],
+                                                   start)],
+        'streamLines': data.get('streamLines', []) if lines else [],
+        'operations': tiled_operations,
+    } for start in range(0, len(tiles), size)]
+
+    # Tasks can only be retried from their own thread, so errors are retried
+    # here rather than by the threads making the requests
+    try:
+        with ThreadPoolExecutor(settings.GEOP['tile_concurrency']) as pool:
+            tile_results = {}
+            for result in pool.map(partial(geoprocess, 'multi'), payloads):
+                tile_results.update(result)
+    except (ConnectionError, GeoprocessingError) as exc:
+        if retry is not None and (isinstance(exc, ConnectionError) or
+                                  exc.status_code >= 500):
+            _retry_later(retry, exc)
+        raise
+
+    tile_results = [tile_results.get(str(idx), {})
+                    for idx in range(len(tiles))]
+    areas = [area for _, area in tiles]
+
+    logger.debug(f'Geoprocessing {len(tiles)} tiles in {len(payloads)} '
+                 f'requests for {", ".join(labels)}')
+
+    return {op['label']: merge_tiles(op, tile_results, areas)
+            for op in operations}
+
+
+def can_rollup(wkaoi, operation_name):
+    """
+    Returns True if roll-up is enabled with GEOP['rollup'] and the results of
+    the operation over the well-known area of interest may be summed from
+    those of its HUC-12s. See `rollup`.
+    """
+    return (settings.GEOP['rollup'] and
+            bool(wkaoi) and
+            wkaoi.split('__')[0] in ROLLUP_CODES and
+            operation_name in ROLLUP_OPERATIONS)
+
+
+def rollup(wkaoi, operations, keys, retry=None):
+    """
+    Compute additive operations, given as those of a `multi` payload, over a
+    HUC-8 or HUC-10 by summing their results over its HUC-12s, which are
+    often already cached from subbasin runs. Returns a dictionary of labels
+    to results, like those of `multi` for one shape, or None if fewer than
+    GEOP['rollup_min_cached'] of the HUC-12 results are cached, in which
+    case the whole shape is cheaper to submit.
+
+    keys are the cache keys of each operation over the wkaoi. The HUC-12s'
+    results are cached under the same keys with their own wkaoi in its place,
+    and the missing ones are submitted and cached along the way.
+
+    HUC-12s nest in their HUC-8s and HUC-10s, so each cell is counted in
+    exactly one of them, and the sums match the counts over the whole shape
+    up to differences in how the boundaries of each level were simplified.
+    As the HUC-12s' shapes are the detailed ones, rather than those the
+    HUC-8s and HUC-10s are otherwise computed over, roll-up is opt-in.
+    """
+    code, id = wkaoi.split('__')
+    children = split_into_huc12s(code, id)
+    if not children:
+        return None
+
+    return rollup_children(wkaoi, children, operations, keys, retry)
+
+
+def rollup_children(wkaoi, children, operations, keys, retry=None):
+    """
+    Sum the results of the operations over the HUC-12 children of wkaoi, as
+    (wkaoi, huc12, geojson) tuples, for `rollup`.
+
+    The results of the HUC-12s are cached as `run` would cache them, with
+    counts as integers, since both `run` and `multi` read them.
+    """
+    child_keys = {child: {label: key.replace(f'__{wkaoi}__',
+                                             f'__{child}__', 1)
+                          for label, key in keys.items()}
+                  for child, _, _ in children}
+    cached = cache.get_many([key for child in child_keys.values()
+                             for key in child.values()])
+
+    total = len(children) * len(keys)
+    if len(cached) < settings.GEOP['rollup_min_cached'] * total:
+        return None
+
+    by_label = {op['label']: op for op in operations}
+    child_results = {}
+    pending = {}
+    for child, labels in child_keys.items():
+        child_results[child] = {label: cached[key]
+                                for label, key in labels.items()
+                                if cached.get(key)}
+        missing = [label for label in labels
+                   if label not in child_results[child]]
+        if missing:
+            pending[child] = missing
+
+    if pending:
+        shapes = [{'id': child, 'shape': geojson}
+                  for child, _, geojson in children if child in pending]
+        computed = {}
+        _multi({'shapes': [], 'streamLines': [], 'operations': operations},
+               shapes, pending, {}, computed, retry)
+
+        for child, results in computed.items():
+            for label, value in results.items():
+                value = run_result(by_label[label], value)
+                cache.set(child_keys[child][label], value, None)
+                child_results[child][label] = value
+
+    logger.debug(f'Rolled up {wkaoi} from {len(children)} HUC-12s, '
+                 f'{len(pending)} of them not cached')
+
+    # Summed the same way as the histograms of tiles, as integers like the
+    # results of the HUC-12s
+    return {op['label']: run_result(op, merge_tiles(
+                op, list(child_results.values()), None))
+            for op in operations}
+
+
+def multi_cache_keys(opname, shapes, data, layer_overrides):
+    """
+    Returns the cache keys of each operation in the `multi` payload data for
+    each shape that can be cached, and the timeout to cache them with:
+
+        {
+            '{{ shape_id }}': ({'{{ operation_label }}': '{{ key }}'}, None),
+            ...
+        }
+
+    Shapes with a well-known area of interest id are cached indefinitely, as
+    they always have been. Shapes with a NOCACHE id are cached by their
+    content for GEOP['shape_cache_timeout'] seconds, if caching is enabled.
+    Since the streams sent along affect the RasterLinesJoin operation, they
+    are part of its content key.
+    """
+    namespaces = {op['label']: cache_namespace(op, layer_overrides)
+                  for op in settings.GEOP['json'][opname]['operations']}
+    lines_cache_key = None
+
+    cache_keys = {}
+
+    for shape in shapes:
+        if not shape['id'].startswith(NOCACHE):
+            cache_keys[shape['id']] = ({
+                op['label']: f'geop_{namespaces[op["label"]]}__{shape["id"]}'
+                             f'__{op["label"]}'
+                for op in data['operations']
+            }, None)
+        elif settings.GEOP['cache']:
+            if lines_cache_key is None:
+                lines_cache_key = f'__{digest(data.get("streamLines"))}'
+
+            shape_id = content_id([shape['shape']])
+            keys = {}
+            for op in data['operations']:
+                key = (f'geop_{namespaces[op["label"]]}__{shape_id}'
+                       f'__{op["label"]}')
+                if op.get('name') == 'RasterLinesJoin':
+                    key += lines_cache_key
+                keys[op['label']] = key
+
+            cache_keys[shape['id']] = (keys,
+                                       settings.GEOP['shape_cache_timeout'])
+
+    return cache_keys
+
+
+def content_id(geometries, other_input=None):
+    """
+    Returns a cache id for an area of interest that is not well-known, given
+    its list of GeoJSON geometries and any other input the results depend on.
+
+    The id is made from the `geometry_hash` of each geometry, in order, so
+    the same shapes get the same id even if they were drawn with a different
+    vertex order or orientation, or serialized with more precision.
+    """
+    hashes = [geometry_hash(geometry) for geometry in geometries]
+    if other_input:
+        hashes.append(digest(other_input))
+
+    return f'shape_{digest(hashes)}'
+
+
+def geometry_hash(geojson):
+    """
+    Returns a compact hash of a GeoJSON geometry, given as a string or a
+    dictionary, that is stable across equivalent representations of it.
+
+    Coordinates are rounded to SHAPE_HASH_PRECISION decimal places, repeated
+    and closing vertices are dropped, exterior rings are oriented counter-
+    clockwise and holes clockwise, each ring starts from its smallest vertex,
+    and holes and polygons are sorted. A Polygon hashes the same as a
+    MultiPolygon containing only it. Other geometry types are hashed as is.
+    """
+    geometry = json.loads(geojson) if isinstance(geojson, str) else geojson
+
+    if geometry.get('type') == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        return digest(geometry)
+
+    canonical = sorted(
+        [_canonical_ring(polygon[0], exterior=True)] +
+        sorted(_canonical_ring(hole, exterior=False) for hole in polygon[1:])
+        for polygon in polygons
+    )
+
+    return digest(canonical)
+
+
+def _canonical_ring(ring, exterior):
+    points = []
+    for x, y, *_ in ring:
+        # Adding 0.0 turns -0.0 into 0.0
+        point = (round(x, SHAPE_HASH_PRECISION) + 0.0,
+                 round(y, SHAPE_HASH_PRECISION) + 0.0)
+        if not points or points[-1] != point:
+            points.append(point)
+
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+
+    # Twice the signed area, which is positive for counter-clockwise rings
+    area = sum(x0 * y1 - x1 * y0
+               for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]))
+
+    if (area < 0) == exterior:
+        points.reverse()
+
+    start = points.index(min(points)) if points else 0
+
+    return points[start:] + points[:start]
+
+
+def cache_namespace(operation, layer_overrides):
+    """
+    Returns the cache namespace for results of the given operation config,
+    from settings.GEOP['json'], with the given layer overrides.
+
+    The namespace is a digest of the layer each of the operation's rasters,
+    and each override, resolves to, along with its version from
+    GEOP['layer_versions']. Changing the layer config, or bumping a layer's
+    version when its data changes in place, moves the operations using it to
+    a new namespace. Entries in namespaces that are no longer current can be
+    evicted with the `geop_cache` management command.
+
+    Each namespace is registered in the cache the first time this process
+    uses it, along with the layers it was made from, as a dictionary of
+    tokens to their layer, version and whether it was overridden.
+    """
+    tokens = set(operation.get('rasters', [])) | set(layer_overrides)
+    if 'targetRaster' in operation:
+        tokens.add(operation['targetRaster'])
+
+    layer_config = dict(settings.GEOP['layers'], **layer_overrides)
+    versions = settings.GEOP['layer_versions']
+
+    layers = {token: [layer_config.get(token, token),
+                      versions.get(token, 0),
+                      token in layer_overrides]
+              for token in tokens}
+
+    namespace = digest(layers)[:12]
+
+    if namespace not in _registered_namespaces:
+        cache.add(f'{NAMESPACE_PREFIX}{namespace}', layers, None)
+        _registered_namespaces.add(namespace)
+
+    return namespace
+
+
+def digest(value):
+    """
+    Returns a short hex digest of a JSON serializable value.
+    """
+    serialized = json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+    return blake2b(serialized.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def group_pending_operations(pending):
+    """
+    Group shapes by the operations that need to be computed for them, so
+    that each group can be submitted as one `multi` request.
+
+    Given a dictionary of shape ids to lists of operation labels, like:
+
+        {
+            'huc12__1': ['nlcd_soil', 'gwn'],
+            'huc12__2': ['gwn'],
+            'huc12__3': ['gwn', 'nlcd_soil'],
+        }
+
+    returns a list of operation labels and shape ids, in the order they were
+    first seen:
+
+        [
+            (('nlcd_soil', 'gwn'), ['huc12__1', 'huc12__3']),
+            (('gwn',), ['huc12__2']),
+        ]
+    """
+    groups = {}
+
+    for shape_id, labels in pending.items():
+        group = groups.setdefault(frozenset(labels), (tuple(labels), []))
+        group[1].append(shape_id)
+
+    return list(groups.values())
+
+
+def acquire_lease(key, owner):
+    """
+    Try to take the lease for computing the result to be cached at key.
+
+    Leases are kept in the cache next to the key, and expire after
+    GEOP['lease_timeout'] seconds so that one held by a task that died does
+    not block others for long. Returns True if the lease was taken, or is
+    already held, by owner, which should be the id of the calling task.
+    Since a retried Celery task keeps its id, it resumes holding any leases
+    it had before the retry.
+    """
+    lease = f'{key}__lease'
+
+    if cache.add(lease, owner, settings.GEOP['lease_timeout']):
+        return True
+
+    return cache.get(lease) == owner
+
+
+def release_lease(key, owner):
+    """
+    Release the lease for key if it is held by owner.
+    """
+    lease = f'{key}__lease'
+
+    if cache.get(lease) == owner:
+        cache.delete(lease)
+
+
+def await_results(keys, deadline=None):
+    """
+    Wait for the results to be cached at the given keys by the tasks holding
+    their leases, until the deadline, a `time.monotonic()` time, which is
+    GEOP['lease_wait'] seconds from now by default. Returns a dictionary of
+    keys to the results that were published. Keys whose lease is released or
+    expires without a result, or that are still being computed at the
+    deadline, are left out. See `_retry_unpublished`.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + settings.GEOP['lease_wait']
+
+    pending = set(keys)
+    published = {}
+
+    while pending and time.monotonic() < deadline:
+        time.sleep(min(LEASE_POLL_INTERVAL,
+                       max(0, deadline - time.monotonic())))
+
+        cached = cache.get_many(list(pending))
+        published.update({k: v for k, v in cached.items() if v})
+        pending -= published.keys()
+
+        leases = cache.get_many([f'{k}__lease' for k in pending])
+        dropped = {k for k in pending if f'{k}__lease' not in leases}
+        pending -= dropped
+
+        # A result may have been published just before its lease was released
+        if dropped:
+            cached = cache.get_many(list(dropped))
+            published.update({k: v for k, v in cached.items() if v})
+
+    # At the deadline, take what has been published since the last check
+    if pending:
+        cached = cache.get_many(list(pending))
+        published.update({k: v for k, v in cached.items() if v})
+
+    return published
+
+
+def _retry_unpublished(retry, keys):
+    """
+    Retries the task of `retry` in place of computing results that other
+    tasks did not publish in time with what is left of its time limit. The
+    retried task computes those whose leases have been released or expired,
+    and waits again for the others. Raises an error once it is out of
+    retries.
+    """
+    exc = Exception(f'Timed out waiting for {len(keys)} geoprocessing '
+                    f'results computed by other tasks')
+    _retry_later(retry, exc)
+    raise exc
+
+
+def is_batchable(run_input):
+    """
+    Returns True if the input of a /run request can be submitted as an
+    operation of a /multi request, i.e. it is a raster operation supported by
+    /multi over a single LatLng polygon.
+    """
+    return (run_input.get('operationType') in BATCHABLE_OPERATIONS and
+            len(run_input.get('polygon', [])) == 1 and
+            'vector' not in run_input and
+            run_input.get('polygonCRS') == 'LatLng' and
+            run_input.get('rasterCRS') == 'ConusAlbers' and
+            run_input.get('zoom', 0) == 0)
+
+
+def multi_operation(label, run_input):
+    """
+    Converts the input of a /run request to an operation of a /multi request.
+    """
+    operation = {
+        'name': run_input['operationType'],
+        'label': label,
+        'rasters': run_input['rasters'],
+    }
+
+    for optional in ['targetRaster', 'pixelIsArea']:
+        if optional in run_input:
+            operation[optional] = run_input[optional]
+
+    return operation
+
+
+def run_result(operation, value):
+    """
+    Converts the result of a /multi operation to the /run result it was
+    converted from with `multi_operation`. /multi returns counts as doubles,
+    where /run has integers.
+    """
+    if operation['name'] == 'RasterGroupedCount':
+        return {k: int(v) for k, v in value.items()}
+
+    return value
+
+
+def batched_run(opname, run_input, retry=None):
+    """
+    Submit a batchable /run request as part of a /multi request with the
+    same operation over the shapes of other tasks that submit it within
+    GEOP['batch_window'] seconds. Returns the result for this shape.
+
+    Tasks join a batch by pushing their shape onto a list in Redis. The first
+    one to join becomes its leader: after the window it takes the whole list,
+    submits it, and pushes each task's result, or error, onto a list for that
+    task, on which the others block for as long as the leader may take: the
+    window, its grace period, and its request, but no longer than their own
+    time limit allows. See `batch_wait_budget`. If no result arrives by then,
+    because the leader died, a task removes its shape from the batch if it
+    is still there, and fails as a timed out request would, rather than
+    making a request of its own that would outlast its time limit.
+
+    Errors reaching the service are raised as ConnectionErrors in each task,
+    and retried with `retry` if given, like those of `geoprocess`.
+    """
+    operation = multi_operation(opname, run_input)
+    batch = f'geop_batch_{digest(operation)[:12]}'
+    queue = f'{batch}__queue'
+    member = str(uuid4())
+    entry = json.dumps([member, run_input['polygon'][0]])
+    window = settings.GEOP['batch_window']
+
+    conn = get_redis_connection('default')
+
+    pipeline = conn.pipeline()
+    pipeline.rpush(queue, entry)
+    pipeline.set(f'{batch}__leader', member, nx=True,
+                 px=int((window + BATCH_LEADER_GRACE) * 1000))
+    _, leader = pipeline.execute()
+
+    outcome = None
+
+    if leader:
+        time.sleep(window)
+
+        # Take the batch, and let the next task to arrive start a new one
+        pipeline = conn.pipeline()
+        pipeline.lrange(queue, 0, -1)
+        pipeline.delete(queue)
+        pipeline.delete(f'{batch}__leader')
+        entries = [json.loads(e) for e in pipeline.execute()[0]]
+
+        # Our own shape may have been taken by the previous leader
+        outcome = _submit_batch(conn, operation, entries).get(member)
+
+    if outcome is None:
+        # Waiting is capped to leave the task time to clean up and fail
+        # before it reaches its time limit
+        wait = min(window + BATCH_LEADER_GRACE + settings.TASK_REQUEST_TIMEOUT,
+                   batch_wait_budget(window))
+        popped = conn.blpop(f'geop_batch_result_{member}',
+                            timeout=max(1, math.floor(wait)))
+        if not popped:
+            conn.lrem(queue, 1, entry)
+            raise Exception('Geoprocessing service timed out.')
+        outcome = json.loads(popped[1])
+
+    if 'error' not in outcome:
+        return outcome['result']
+
+    if outcome.get('unreachable'):
+        exc = ConnectionError(outcome['error'])
+        if retry is not None:
+            _retry_later(retry, exc)
+        raise exc
+
+    raise Exception(outcome['error'])
+
+
+def batch_wait_budget(window):
+    """
+    Returns the most seconds a task that joined a batch with the given window
+    may wait for its result, keeping GEOP['batch_margin'] seconds of its time
+    limit to clean up and fail.
+    """
+    return (settings.CELERY_TASK_TIME_LIMIT - window -
+            settings.GEOP['batch_margin'])
+
+
+def _submit_batch(conn, operation, entries):
+    """
+    Submit the shapes of a batch with its operation to /multi, publish the
+    outcome for each task in the batch, and return them by member id.
+    """
+    data = {
+        'shapes': [{'id': member, 'shape': shape}
+                   for member, shape in entries],
+        'streamLines': [],
+        'operations': [operation],
+    }
+
+    try:
+        result = geoprocess('multi', data)
+
+        outcomes = {}
+        for member, _ in entries:
+            value = result.get(member, {}).get(operation['label'], {})
+            outcomes[member] = {'result': run_result(operation, value)}
+    except ConnectionError as x:
+        outcomes = {member: {'error': str(x), 'unreachable': True}
+                    for member, _ in entries}
+    except Exception as x:
+        outcomes = {member: {'error': str(x)} for member, _ in entries}
+
+    pipeline = conn.pipeline(transaction=False)
+    for member, outcome in outcomes.items():
+        result_key = f'geop_batch_result_{member}'
+        pipeline.rpush(result_key, json.dumps(outcome))
+        pipeline.expire(result_key, settings.TASK_REQUEST_TIMEOUT)
+    pipeline.execute()
+
+    logger.debug(f'Geoprocessing batch of {len(entries)} shapes for '
+                 f'{operation["label"]}')
+
+    return outcomes
 
 
 def geoprocess(endpoint, data, retry=None):
     """
     Submit a request to the specified endpoint of the geoprocessing service.
     Returns its result.
+
+    Requests go through the process-wide session from `get_session`, so
+    connections to the service are pooled and kept alive between operations.
+    The payload is serialized compactly, and gzipped if GEOP['gzip'] is set,
+    and the response is decoded directly from the (decompressed) stream.
+
+    If the service cannot be reached, or fails with a server error, and a
+    `retry` callable is given, such as a bound task's `self.retry`, it is
+    called with the error and an exponential backoff countdown. Otherwise the
+    error is raised.
+
+    Requests go through a circuit breaker shared by all workers. If too many
+    of them fail or time out, it opens, and requests fail fast with a
+    GeoprocessingUnavailable error instead of adding to the service's load.
+    See `breaker_admit`.
     """
     host = settings.GEOP['host']
     port = settings.GEOP['port']
 
     geop_url = f'http://{host}:{port}/{endpoint}'
 
+    body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    headers = {
+        'Content-Type': 'application/json',
+        'Accept-Encoding': 'gzip',
+    }
+
+    if settings.GEOP['gzip']:
+        body = gzip.compress(body, compresslevel=1)
+        headers['Content-Encoding'] = 'gzip'
+
+    probe = breaker_admit()
+    started = time.monotonic()
+
     try:
-        response = requests.post(geop_url,
-                                 data=json.dumps(data),
-                                 headers={'Content-Type': 'application/json'},
-                                 timeout=settings.TASK_REQUEST_TIMEOUT)
+        result = _post(geop_url, body, headers)
+        _record_request(endpoint, len(body), started)
+        breaker_record(probe, failed=False)
     except ConnectionError as exc:
+        _record_request(endpoint, len(body), started, failed=True)
+        breaker_record(probe, failed=True)
         if retry is not None:
-            retry(exc=exc)
+            _retry_later(retry, exc)
+        raise
     except Timeout:
+        _record_request(endpoint, len(body), started, failed=True)
+        breaker_record(probe, failed=True)
         raise Exception('Geoprocessing service timed out.')
+    except GeoprocessingError as exc:
+        _record_request(endpoint, len(body), started, failed=True)
+        # Client errors are ours, and say nothing about the service's health,
+        # but a probe only closes the breaker if it succeeds
+        breaker_record(probe, failed=probe or exc.status_code >= 500)
+        if exc.status_code >= 500 and retry is not None:
+            _retry_later(retry, exc)
+        raise
+    except Exception:
+        _record_request(endpoint, len(body), started, failed=True)
+        breaker_record(probe, failed=probe)
+        raise
+
+    if 'result' in result:
+        return result['result']
+    else:
+        return result
 
-    if response.ok:
-        result = response.json()
-        if 'result' in result:
-            return result['result']
+
+def _retry_later(retry, exc):
+    """
+    Calls a bound task's `retry` with the exception and a countdown that
+    doubles with each retry of the task, from GEOP['retry_backoff'] up to
+    GEOP['retry_backoff_max'] seconds, with jitter so that tasks that failed
+    together do not all retry together.
+    """
+    task = getattr(retry, '__self__', None)
+    retries = task.request.retries if task is not None else 0
+
+    delay = min(settings.GEOP['retry_backoff_max'],
+                settings.GEOP['retry_backoff'] * 2 ** retries)
+
+    retry(exc=exc, countdown=delay / 2 + random.uniform(0, delay / 2))
+
+
+def breaker_admit():
+    """
+    Checks the circuit breaker before a request to the geoprocessing service.
+
+    When the breaker is closed, requests are let through. When it is open,
+    they fail fast with a GeoprocessingUnavailable error, until it has been
+    open for GEOP['breaker_cooldown'] seconds. Then it is half-open: one
+    request at a time is let through as a probe, and the others fail fast.
+    A successful probe closes the breaker, and a failed one opens it again.
+
+    Returns True if the request is a probe. Its outcome must be recorded with
+    `breaker_record`, as must that of every other request.
+    """
+    opened_at = cache.get(BREAKER_KEY)
+
+    if opened_at is None:
+        return False
+
+    if (time.time() - opened_at >= settings.GEOP['breaker_cooldown'] and
+            cache.add(BREAKER_PROBE_KEY, True, settings.TASK_REQUEST_TIMEOUT)):
+        return True
+
+    raise GeoprocessingUnavailable(
+        'The geoprocessing service is unavailable. Please try again later.')
+
+
+def breaker_record(probe, failed):
+    """
+    Records the outcome of a request admitted by `breaker_admit`.
+
+    Requests and failures, including timeouts, are counted across workers in
+    windows of GEOP['breaker_window'] seconds. Once a window has at least
+    GEOP['breaker_min_requests'] requests, of which at least
+    GEOP['breaker_failure_rate'] failed, the breaker opens.
+    """
+    window = settings.GEOP['breaker_window']
+    bucket = int(time.time() // window)
+    requests_key = f'{BREAKER_KEY}_{bucket}_requests'
+    failures_key = f'{BREAKER_KEY}_{bucket}_failures'
+
+    if probe:
+        if failed:
+            cache.set(BREAKER_KEY, time.time(), None)
         else:
-            return result
+            # Start counting afresh, so that the failures that opened the
+            # breaker do not open it again
+            cache.delete_many([BREAKER_KEY, requests_key, failures_key])
+        cache.delete(BREAKER_PROBE_KEY)
+        return
+
+    try:
+        cache.add(requests_key, 0, window * 2)
+        requests = cache.incr(requests_key)
+
+        if not failed:
+            return
+
+        cache.add(failures_key, 0, window * 2)
+        failures = cache.incr(failures_key)
+    except ValueError:
+        # The counter expired between add and incr, or the cache is a dummy
+        return
+
+    if (requests >= settings.GEOP['breaker_min_requests'] and
+            failures / requests >= settings.GEOP['breaker_failure_rate']):
+        if cache.add(BREAKER_KEY, time.time(), None):
+            logger.warning(f'Geoprocessing circuit breaker opened after '
+                           f'{failures} of {requests} requests failed')
+
+
+def breaker_status():
+    """
+    Returns the state of the circuit breaker, and the number of requests and
+    failures in the current window, in the shape:
+
+        {
+            'state': 'closed' | 'open' | 'half-open',
+            'opened_at': None | {{ timestamp }},
+            'requests': 0,
+            'failures': 0,
+        }
+    """
+    opened_at = cache.get(BREAKER_KEY)
+    bucket = int(time.time() // settings.GEOP['breaker_window'])
+    counts = cache.get_many([f'{BREAKER_KEY}_{bucket}_requests',
+                             f'{BREAKER_KEY}_{bucket}_failures'])
+
+    if opened_at is None:
+        state = 'closed'
+    elif time.time() - opened_at < settings.GEOP['breaker_cooldown']:
+        state = 'open'
     else:
-        raise Exception(f'Geoprocessing Error.\nDetails: {response.text}')
+        state = 'half-open'
+
+    return {
+        'state': state,
+        'opened_at': opened_at,
+        'requests': counts.get(f'{BREAKER_KEY}_{bucket}_requests', 0),
+        'failures': counts.get(f'{BREAKER_KEY}_{bucket}_failures', 0),
+    }
+
+
+def _post(url, body, headers):
+    """
+    POST the body to the url and return the decoded JSON response.
+
+    Read errors that surface while streaming the response are raised as their
+    requests equivalents, so callers only need to handle ConnectionError and
+    Timeout, as they would for a buffered response.
+    """
+    with get_session().post(url,
+                            data=body,
+                            headers=headers,
+                            timeout=settings.TASK_REQUEST_TIMEOUT,
+                            stream=True) as response:
+        if not response.ok:
+            raise GeoprocessingError(
+                f'Geoprocessing Error.\nDetails: {response.text}',
+                response.status_code)
+
+        response.raw.decode_content = True
+
+        try:
+            return json.load(response.raw)
+        except ReadTimeoutError as exc:
+            raise Timeout(exc)
+        except ProtocolError as exc:
+            raise ConnectionError(exc)
+
+
+def get_session():
+    """
+    Returns the process-wide requests Session for the geoprocessing service.
+
+    The session keeps a pool of up to GEOP['pool_size'] keep-alive connections
+    so that consecutive operations, and concurrent ones from threads, reuse
+    TCP connections instead of opening a new one per request.
+
+    Connections cannot be shared between processes, so a new session is made
+    whenever it is used from a different process than the one it was made in,
+    such as a Celery prefork child after the parent has used it.
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+
+    if _session is None or _session_pid != pid:
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=settings.GEOP['pool_size'])
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        _session = session
+        _session_pid = pid
+
+    return _session
+
+
+def _record_request(endpoint, bytes_sent, started, failed=False):
+    elapsed = time.monotonic() - started
+
+    stats = _client_stats[endpoint]
+    stats['requests'] += 1
+    stats['bytes_sent'] += bytes_sent
+    stats['total_seconds'] += elapsed
+    stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+    if failed:
+        stats['errors'] += 1
+
+    logger.debug(f'Geoprocessing /{endpoint} sent {bytes_sent} bytes in '
+                 f'{elapsed:.3f}s{" and failed" if failed else ""}')
+
+    interval = settings.GEOP['stats_log_interval']
+    if interval and stats['requests'] % interval == 0:
+        logger.info(f'Geoprocessing /{endpoint} client stats: '
+                    f'{stats["requests"]} requests, '
+                    f'{stats["errors"]} errors, '
+                    f'{stats["bytes_sent"]} bytes sent, '
+                    f'{stats["total_seconds"] / stats["requests"]:.3f}s '
+                    f'average, {stats["max_seconds"]:.3f}s max')
+
+
+def client_stats():
+    """
+    Returns the per-endpoint geoprocessing request counters of this process,
+    which are also logged every GEOP['stats_log_interval'] requests to an
+    endpoint, in the shape:
+
+        {
+            '{{ endpoint }}': {
+                'requests': 0,
+                'errors': 0,
+                'bytes_sent': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0,
+            },
+            ...
+        }
+    """
+    return {endpoint: dict(stats) for endpoint, stats in _client_stats.items()}
 
 
 def parse(result):
@@ -313,10 +1431,72 @@ def parse(result):
             (4, 5): 6
         }
 
+    Keys with a single value, like 'List(1)', become plain ints. The keys are
+    parsed in bulk by `parse_histogram`, falling back to parsing them one at
+    a time if they are not all lists of the same number of integers.
+
     :param result: Dictionary mapping strings like 'List(a,b,c)' to ints
     :return: Dictionary mapping tuples of ints to ints
     """
-    return {make_tuple(key[4:]): val for key, val in result.items()}
+    try:
+        classes, _ = parse_histogram(result, values=False)
+    except ValueError:
+        return {make_tuple(key[4:]): val for key, val in result.items()}
+
+    if classes.shape[1] == 1:
+        keys = classes[:, 0].tolist()
+    else:
+        keys = map(tuple, classes.tolist())
+
+    return dict(zip(keys, result.values()))
+
+
+def parse_histogram(result, values=True):
+    """
+    Converts raw JSON results from Spark JobServer to NumPy arrays
+
+    If the input is this:
+
+        {
+            'List(1,2)': 3,
+            'List(4,5)': 6
+        }
+
+    The output will be:
+
+        (array([[1, 2],
+                [4, 5]]), array([3, 6]))
+
+    All keys are parsed in one pass, rather than one at a time, which adds up
+    for results with thousands of class combinations.
+
+    Raises a ValueError if the keys are not all lists of the same number of
+    integers.
+
+    :param result: Dictionary mapping strings like 'List(a,b,c)' to numbers
+    :param values: Whether to return the values as an array, or None
+    :return: Tuple of a 2D array of ints with a row of classes for each key,
+             and an array of the values in the same order
+    """
+    counts = np.array(list(result.values())) if values else None
+
+    if not result:
+        return np.empty((0, 0), dtype=np.int64), counts
+
+    inner = [key[5:-1] for key in result]
+    width = inner[0].count(',') + 1 if inner[0].strip() else 0
+
+    if width == 0:
+        if any(i.strip() for i in inner):
+            raise ValueError('Result keys are of different lengths')
+        return np.empty((len(inner), 0), dtype=np.int64), counts
+
+    if any(i.count(',') != width - 1 for i in inner):
+        raise ValueError('Result keys are of different lengths')
+
+    classes = np.array(','.join(inner).split(','), dtype=np.int64)
+
+    return classes.reshape(len(inner), width), counts
 
 
 def use_layer(token, config):
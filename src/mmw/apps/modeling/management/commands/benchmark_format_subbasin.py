@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import random
+import timeit
+
+from functools import reduce
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.modeling.tasks import format_subbasin
+
+# Loads SRAT does not return, as format_for_srat does not send them
+NO_SEDIMENT_SOURCES = ['farman', 'subsurface', 'septics', 'pointsource']
+
+
+def synthetic_subbasin(huc12_count, catchment_count, seed=0):
+    """
+    Returns GWLF-E results, SRAT Catchment API results and MapShed data of a
+    subbasin run with the given numbers of HUC-12s and catchments in each,
+    filled with random loads and areas
+    """
+    rng = random.Random(seed)
+    gwlfe_results = {}
+    srat_huc12s = {}
+    gmss = {}
+
+    for h in range(huc12_count):
+        huc12_id = f'0204020{h:05d}'
+        gmss[huc12_id] = {'Area': [rng.uniform(0, 5000) for _ in range(16)]}
+        gwlfe_results[huc12_id] = {'AreaTotal': sum(gmss[huc12_id]['Area']),
+                                   'inputmod_hash': 'synthetic'}
+
+        srat_huc12 = {'huc12': huc12_id, 'catchments': {}}
+        for key in settings.SRAT_KEYS.values():
+            srat_huc12[f'tnload_{key}'] = rng.uniform(0, 1e5)
+            srat_huc12[f'tpload_{key}'] = rng.uniform(0, 1e4)
+            if key not in NO_SEDIMENT_SOURCES:
+                srat_huc12[f'tssload_{key}'] = rng.uniform(0, 1e7)
+
+        for c in range(catchment_count):
+            catchment = {f'{load}_{key}': rng.uniform(0, 1e3)
+                         for load in ['tnload', 'tpload', 'tssload',
+                                      'tn_conc', 'tp_conc', 'tss_conc']
+                         for key in settings.SRAT_KEYS.values()}
+            for load in ['tnloadrate', 'tploadrate', 'tssloadrate']:
+                catchment[f'{load}_total'] = rng.uniform(0, 1e4)
+                catchment[f'{load}_conc'] = rng.uniform(0, 100)
+            srat_huc12['catchments'][str(4781000 + h * catchment_count + c)] \
+                = catchment
+
+        srat_huc12s[huc12_id] = srat_huc12
+
+    return gwlfe_results, {'huc12s': srat_huc12s}, gmss
+
+
+def format_subbasin_loops(huc12_gwlfe_results, srat_catchment_results,
+                          gmss):
+    """
+    format_subbasin as it used to be, with loops over every HUC-12, source
+    and catchment
+    """
+    def empty_source(s):
+        return {'Source': s,
+                'TotalN': 0, 'TotalP': 0, 'Sediment': 0,
+                'Area': 0}
+
+    def add_huc12_source(source, srat_huc12, source_areas, total_area):
+        source_name = source['Source']
+        source_key = settings.SRAT_KEYS[source_name]
+        total_n = srat_huc12.get('tnload_' + source_key, 0)
+        total_p = srat_huc12.get('tpload_' + source_key, 0)
+        sediment = srat_huc12.get('tssload_' + source_key, 0)
+
+        normalizing_areas = settings.SUBBASIN_SOURCE_NORMALIZING_AREAS
+        source_area_idxs = normalizing_areas.get(source_name, None)
+        area = sum([source_areas[i] for i in source_area_idxs]) \
+            if source_area_idxs else total_area
+
+        source['TotalN'] += total_n
+        source['TotalP'] += total_p
+        source['Sediment'] += sediment
+        source['Area'] += area
+
+        return {
+            'Source': source_name,
+            'TotalN': total_n,
+            'TotalP': total_p,
+            'Sediment': sediment,
+            'Area': area,
+        }
+
+    def format_catchment(srat_catchment, loads_template):
+        for key, value in srat_catchment.items():
+            # A sample load source key is 'tnload_hp'.
+            # The first half 'tnload' indicates which kinds of loads
+            # The second half 'hp' is the acronym of the source of loads
+            # Sometimes the first half has underscores, like 'tn_conc_ptsource'
+            split_at = key.rfind('_')
+            if split_at > -1:
+                load_type = key[0:split_at]
+                load_source = key[split_at:]
+                for load in loads_template:
+                    if load_source == settings.SRAT_KEYS[load['Source']]:
+                        add_load_by_key(load_type, value, load)
+
+        return {
+            'TotalLoadingRates': {
+                'TotalN': srat_catchment['tnloadrate_total'],
+                'TotalP': srat_catchment['tploadrate_total'],
+                'Sediment': srat_catchment['tssloadrate_total'],
+            },
+            'LoadingRateConcentrations': {
+                'TotalN': srat_catchment['tnloadrate_conc'],
+                'TotalP': srat_catchment['tploadrate_conc'],
+                'Sediment': srat_catchment['tssloadrate_conc'],
+            },
+            'Loads': loads_template
+        }
+
+    def add_load_by_key(load_type, value, load):
+        type_mapping = {
+            'tpload': 'TotalP',
+            'tnload': 'TotalN',
+            'tssload': 'Sediment'
+        }
+
+        if load_type in type_mapping:
+            load[type_mapping[load_type]] = value
+
+        return load
+
+    def catchment_template(keys_template):
+        return [{
+            'Source': key_name,
+            'TotalN': 0,
+            'TotalP': 0,
+            'Sediment': 0
+        } for key_name in keys_template.keys()]
+
+    def sum_loads(loads):
+        def add_load(sums, load):
+            (sediment_sum,
+             nitrogen_sum,
+             phosphorus_sum) = sums
+            return (sediment_sum + load['Sediment'],
+                    nitrogen_sum + load['TotalN'],
+                    phosphorus_sum + load['TotalP'])
+
+        return reduce(add_load, loads, (0, 0, 0))
+
+    def build_summary_loads(loads, area):
+        (sum_sed, sum_n, sum_p) = sum_loads(loads)
+        return {
+            'Source': 'Entire area',
+            'Area': area,
+            'Sediment': sum_sed,
+            'TotalN': sum_n,
+            'TotalP': sum_p,
+        }
+
+    def add_huc12(srat_huc12, aggregate):
+        area = huc12_gwlfe_results[srat_huc12['huc12']]['AreaTotal']
+        source_areas = gmss[srat_huc12['huc12']]['Area']
+        loads = [add_huc12_source(s, srat_huc12, source_areas, area)
+                 for s in aggregate['Loads']]
+        summary_loads = build_summary_loads(loads, area)
+        catchment_loads_template = catchment_template(settings.SRAT_KEYS)
+
+        # Build up the full AOI's values with the huc-12's
+        aggregate['SummaryLoads']['Area'] += area
+        aggregate['SummaryLoads']['Sediment'] += summary_loads['Sediment']
+        aggregate['SummaryLoads']['TotalN'] += summary_loads['TotalN']
+        aggregate['SummaryLoads']['TotalP'] += summary_loads['TotalP']
+
+        return {
+            'Loads': loads,
+            'SummaryLoads': summary_loads,
+            'Catchments': {
+                comid: format_catchment(result, catchment_loads_template)
+                for comid, result in srat_huc12['catchments'].items()},
+            'Raw': huc12_gwlfe_results[srat_huc12['huc12']]
+        }
+
+    aggregate = {
+        'Loads': [empty_source(source_name)
+                  for source_name in settings.SRAT_KEYS.keys()],
+        'SummaryLoads': empty_source('Entire area'),
+        # All gwlf-e results should have the same inputmod hash,
+        # so grab any of them
+        'inputmod_hash': next(iter(
+            huc12_gwlfe_results.values()))['inputmod_hash'],
+    }
+
+    aggregate['HUC12s'] = {huc12_id: add_huc12(result, aggregate)
+                           for huc12_id, result
+                           in srat_catchment_results['huc12s'].items()}
+
+    return aggregate
+
+
+class Command(BaseCommand):
+    help = ('Time formatting the SRAT Catchment API results of a large '
+            'synthetic subbasin run with loops, as format_subbasin used to, '
+            'and with arrays, as it does now, and check that both give the '
+            'same numbers')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--huc12s', type=int, default=300)
+        parser.add_argument('--catchments', type=int, default=20,
+                            help='Number of catchments in each HUC-12')
+        parser.add_argument('--number', type=int, default=3)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, **options):
+        args = synthetic_subbasin(options['huc12s'], options['catchments'])
+
+        if format_subbasin(*args) != format_subbasin_loops(*args):
+            raise CommandError('The formatted results differ')
+
+        times = [
+            min(timeit.repeat(lambda: fn(*args),
+                              number=options['number'],
+                              repeat=options['repeat'])) / options['number']
+            for fn in (format_subbasin_loops, format_subbasin)
+        ]
+
+        self.stdout.write(f'{options["huc12s"]} HUC-12s of '
+                          f'{options["catchments"]} catchments')
+        self.stdout.write(f'{"loops":>10} {"arrays":>10} {"speedup":>8}')
+        self.stdout.write(f'{times[0] * 1000:>8.2f}ms '
+                          f'{times[1] * 1000:>8.2f}ms '
+                          f'{times[0] / times[1]:>7.1f}x')
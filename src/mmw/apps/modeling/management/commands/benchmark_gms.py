@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import json
+import timeit
+
+from copy import deepcopy
+from os.path import join, dirname, abspath
+
+from django.core.management.base import BaseCommand
+
+from gwlfe import Parser
+
+from apps.modeling.tasks import to_data_model, to_gms_file
+
+
+def read_gms_file(mapshed_data):
+    """
+    What run_gwlfe used to do to get the GWLF-E data model
+    """
+    return Parser.GmsReader(to_gms_file(mapshed_data)).read()
+
+
+class Command(BaseCommand):
+    help = ('Time converting MapShed data to the GWLF-E data model through a '
+            'GMS file, as run_gwlfe used to, and directly, as it does now')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mapshed-data',
+                            default=join(dirname(abspath(__file__)),
+                                         'test_data/mapshed-dict.json'),
+                            help='JSON file of MapShed data')
+        parser.add_argument('--number', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, **options):
+        with open(options['mapshed_data']) as f:
+            mapshed_data = json.load(f)
+
+        # Each run is given its own copy, as both round the areas in place
+        copies = [deepcopy(mapshed_data)
+                  for _ in range(options['number'] * options['repeat'] * 2)]
+
+        times = [
+            min(timeit.repeat(lambda: fn(copies.pop()),
+                              number=options['number'],
+                              repeat=options['repeat'])) / options['number']
+            for fn in (read_gms_file, to_data_model)
+        ]
+
+        self.stdout.write(f'{"GMS file":>10} {"direct":>10} {"saved":>10}')
+        self.stdout.write(f'{times[0] * 1000:>8.1f}ms '
+                          f'{times[1] * 1000:>8.1f}ms '
+                          f'{(times[0] - times[1]) * 1000:>8.1f}ms')
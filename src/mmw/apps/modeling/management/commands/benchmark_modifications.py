@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import json
+import timeit
+
+from copy import deepcopy
+from os.path import join, dirname, abspath
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gwlfe import gwlfe
+
+from apps.modeling.calcs import apply_gwlfe_modifications
+from apps.modeling.mapshed.calcs import area_calculations
+from apps.modeling.tasks import to_data_model
+
+# Land cover and BMP modifications of a typical scenario
+MODIFICATIONS = [{
+    'Area__0': 15.305929733931002,
+    'Area__1': 4.141604516240153,
+    'Area__10': 1122.6449285434453,
+    'Area__11': 2639.642634937583,
+    'CN__1': 80.38481449550069,
+    'n26': 48.8561858590235,
+    'n65': 0.22,
+    'n73': 0.29,
+}]
+
+
+def apply_gwlfe_modifications_deepcopy(gms, modifications):
+    """
+    apply_gwlfe_modifications as it used to be, modifying a deep copy of gms
+    """
+    array_mods = []
+    key_mods = []
+    modified_gms = deepcopy(gms)
+
+    for mod in modifications:
+        for key, value in mod.items():
+            if '__' in key:
+                if key[:6] == 'Area__':
+                    gmskey, i = key.split('__')
+                    modified_gms[gmskey][int(i)] = value
+                else:
+                    array_mods.append({key: value})
+            else:
+                key_mods.append({key: value})
+
+    modified_gms = area_calculations(modified_gms['Area'], modified_gms)
+
+    for mod in array_mods:
+        for key, value in mod.items():
+            gmskey, i = key.split('__')
+            modified_gms[gmskey][int(i)] = value
+
+    for mod in key_mods:
+        modified_gms.update(mod)
+
+    return modified_gms
+
+
+class Command(BaseCommand):
+    help = ('Time applying the modifications of a scenario to MapShed data by '
+            'deep copying it, as apply_gwlfe_modifications used to, and by '
+            'copying only what is modified, as it does now, and check that '
+            'GWLF-E gives the same results for both')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mapshed-data',
+                            default=join(dirname(abspath(__file__)),
+                                         'test_data/mapshed-dict.json'),
+                            help='JSON file of MapShed data, by default of '
+                                 'an area with 30 years of weather')
+        parser.add_argument('--number', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, **options):
+        with open(options['mapshed_data']) as f:
+            gms = json.load(f)
+
+        expected = apply_gwlfe_modifications_deepcopy(gms, MODIFICATIONS)
+        actual = apply_gwlfe_modifications(gms, MODIFICATIONS)
+        if actual != expected:
+            raise CommandError('The modified MapShed data differ')
+
+        # to_data_model rounds the areas in place, so each gets a copy
+        expected_result, _ = gwlfe.run(to_data_model(deepcopy(expected)))
+        actual_result, _ = gwlfe.run(to_data_model(deepcopy(actual)))
+        if actual_result != expected_result:
+            raise CommandError('The GWLF-E results differ')
+
+        times = [
+            min(timeit.repeat(lambda: fn(gms, MODIFICATIONS),
+                              number=options['number'],
+                              repeat=options['repeat'])) / options['number']
+            for fn in (apply_gwlfe_modifications_deepcopy,
+                       apply_gwlfe_modifications)
+        ]
+
+        self.stdout.write(f'{gms["WxYrs"]} years of weather')
+        self.stdout.write(f'{"deep copy":>10} {"on write":>10} '
+                          f'{"speedup":>8}')
+        self.stdout.write(f'{times[0] * 1000:>8.2f}ms '
+                          f'{times[1] * 1000:>8.2f}ms '
+                          f'{times[0] / times[1]:>7.1f}x')
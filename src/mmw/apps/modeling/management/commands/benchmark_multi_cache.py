@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.modeling.geoprocessing import group_pending_operations
+
+
+class Command(BaseCommand):
+    help = ('Compare the geoprocessing work sent by `multi` for a partially '
+            'warm cache when re-sending whole shapes, as it used to, and '
+            'when sending only their uncached operations')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--opname', default='mapshed',
+                            help='Multi operation to simulate')
+        parser.add_argument('--shapes', type=int, default=50,
+                            help='Number of shapes in the request')
+        parser.add_argument('--evicted', type=float, nargs='+',
+                            default=[0.01, 0.05, 0.1, 0.25, 0.5],
+                            help='Fractions of cached results to evict')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, **options):
+        labels = [op['label'] for op in
+                  settings.GEOP['json'][options['opname']]['operations']]
+        shape_ids = [f'huc12__{i}' for i in range(options['shapes'])]
+        rng = random.Random(options['seed'])
+
+        self.stdout.write(f'{len(shape_ids)} shapes x {len(labels)} '
+                          f'operations of {options["opname"]}\n')
+        self.stdout.write(f'{"evicted":>8} {"whole shapes":>14} '
+                          f'{"uncached ops":>14} {"saved":>7} '
+                          f'{"requests":>9}')
+
+        for fraction in options['evicted']:
+            pending = {}
+            for shape_id in shape_ids:
+                missing = [label for label in labels
+                           if rng.random() < fraction]
+                if missing:
+                    pending[shape_id] = missing
+
+            whole = len(pending) * len(labels)
+            uncached = sum(len(missing) for missing in pending.values())
+            saved = 1 - uncached / whole if whole else 0
+            requests = len(group_pending_operations(pending))
+
+            self.stdout.write(f'{fraction:>8.0%} {whole:>14} {uncached:>14} '
+                              f'{saved:>7.0%} {requests:>9}')
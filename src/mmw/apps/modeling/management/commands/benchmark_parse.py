@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import random
+import timeit
+
+from ast import literal_eval as make_tuple
+
+from django.core.management.base import BaseCommand
+
+from apps.modeling.geoprocessing import parse, parse_histogram
+
+
+def parse_one_by_one(result):
+    return {make_tuple(key[4:]): val for key, val in result.items()}
+
+
+class Command(BaseCommand):
+    help = ('Time parsing geoprocessing results with `parse` and '
+            '`parse_histogram` against parsing each key with literal_eval')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[10, 100, 1000, 10000],
+                            help='Numbers of keys in the results')
+        parser.add_argument('--width', type=int, default=2,
+                            help='Number of classes in each key')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, **options):
+        rng = random.Random(options['seed'])
+        width = options['width']
+
+        self.stdout.write(f'{"keys":>8} {"literal_eval":>14} {"parse":>10} '
+                          f'{"histogram":>10} {"speedup":>8}')
+
+        for size in options['sizes']:
+            result = {}
+            while len(result) < size:
+                classes = ','.join(str(rng.randint(0, 99))
+                                   for _ in range(width))
+                result[f'List({classes})'] = rng.randint(1, 100000)
+
+            assert parse(result) == parse_one_by_one(result)
+
+            times = [
+                min(timeit.repeat(lambda: fn(result),
+                                  number=1, repeat=options['repeat']))
+                for fn in (parse_one_by_one, parse, parse_histogram)
+            ]
+
+            self.stdout.write(f'{size:>8} {times[0] * 1000:>12.2f}ms '
+                              f'{times[1] * 1000:>8.2f}ms '
+                              f'{times[2] * 1000:>8.2f}ms '
+                              f'{times[0] / times[1]:>7.1f}x')
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import random
+import timeit
+
+from collections import namedtuple
+
+import numpy
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from apps.modeling.mapshed.calcs import CM_PER_INCH, weather_data
+from apps.modeling.mapshed.weather import (WEATHER_SQL, MS_WEATHER_MEASURES,
+                                           read_weather, weather_store)
+
+WeatherStation = namedtuple('WeatherStation', ['station'])
+
+
+def weather_data_row_by_row(ws, begyear, endyear):
+    """
+    weather_data as it used to be, filling nested lists one day at a time.
+    """
+    def f_to_c(f):
+        return (f - 32) * 5.0 / 9.0
+
+    year_range = endyear - begyear + 1
+    stations = tuple([w.station for w in ws])
+    temps = {station_id: [[[0] * 31 for m in range(12)]
+                          for y in range(year_range)]
+             for station_id in stations}
+    prcps = {station_id: [[[0] * 31 for m in range(12)]
+                          for y in range(year_range)]
+             for station_id in stations}
+
+    for values, measure, convert in [
+            (temps, 'temp', f_to_c),
+            (prcps, 'prcp', lambda inches: inches * CM_PER_INCH)]:
+        with connection.cursor() as cursor:
+            cursor.execute(WEATHER_SQL, [stations,
+                                         MS_WEATHER_MEASURES[measure],
+                                         begyear, endyear])
+            for row in cursor.fetchall():
+                station = int(row[0])
+                year = int(row[1]) - begyear
+                month = int(row[2]) - 1
+                for day in range(31):
+                    values[station][year][month][day] = convert(
+                        float(row[day + 3]))
+
+    return temps, prcps
+
+
+class Command(BaseCommand):
+    help = ('Time reading the daily weather of MapShed and subbasin runs from '
+            'the weather store, from ms_weather, and from ms_weather one day '
+            'at a time, as weather_data used to. Requires the store to have '
+            'been built with `build_weather_store`.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stations', type=int, nargs='+', default=[2, 50],
+                            help='Numbers of stations to read, 2 for MapShed '
+                                 'and about 50 for a HUC-8 subbasin run')
+        parser.add_argument('--years', type=int, default=30,
+                            help='Number of years to read')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, **options):
+        store = weather_store()
+        if store is None:
+            raise CommandError('The weather store has not been built')
+
+        rng = random.Random(options['seed'])
+        begyear = store.begyear
+        endyear = min(store.endyear, begyear + options['years'] - 1)
+
+        self.stdout.write(f'{endyear - begyear + 1} years from {begyear}\n')
+        self.stdout.write(f'{"stations":>8} {"row by row":>12} '
+                          f'{"database":>10} {"store":>10} {"speedup":>8}')
+
+        for count in options['stations']:
+            ws = [WeatherStation(int(station)) for station in
+                  rng.sample(list(store.stations), count)]
+
+            expected = weather_data_row_by_row(ws, begyear, endyear)
+            actual = weather_data(ws, begyear, endyear)
+            for values, wanted in zip(actual, expected):
+                for station in wanted:
+                    numpy.testing.assert_allclose(values[station],
+                                                  wanted[station])
+
+            # What weather_data reads from ms_weather without the store
+            def from_database(ws, begyear, endyear):
+                return read_weather([w.station for w in ws], begyear, endyear)
+
+            times = [
+                min(timeit.repeat(lambda: fn(ws, begyear, endyear),
+                                  number=1, repeat=options['repeat']))
+                for fn in (weather_data_row_by_row, from_database,
+                           weather_data)
+            ]
+
+            self.stdout.write(f'{count:>8} {times[0] * 1000:>10.1f}ms '
+                              f'{times[1] * 1000:>8.1f}ms '
+                              f'{times[2] * 1000:>8.1f}ms '
+                              f'{times[0] / times[2]:>7.1f}x')
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from apps.modeling.mapshed.calcs import (CLIPPED_COUNTIES_SQL,
+                                         COUNTY_OVERLAPS_TABLE)
+
+# Columns of ms_county_animals used by `county_clip`
+COUNTY_COLUMNS = ['ag_ha', 'beef_ha', 'broiler_ha', 'dairy_ha', 'goat_ha',
+                  'sheep_ha', 'hog_ha', 'horse_ha', 'layer_ha', 'turkey_ha',
+                  'hp_ls', 'hp_c', 'hp_p', 'crop_ls', 'crop_c', 'crop_p']
+
+
+class Command(BaseCommand):
+    help = ('Build the table of the counties of ms_county_animals clipped to '
+            'each HUC-12, which MapShed reads for HUC-12 areas of interest '
+            'instead of clipping the counties itself. Rebuild it whenever '
+            'ms_county_animals or boundary_huc12 are reloaded, and restart '
+            'the workers to pick it up the first time.')
+
+    def handle(self, **options):
+        columns = ', '.join(['county_pct', 'aoi_pct'] + COUNTY_COLUMNS)
+        clipped_counties = CLIPPED_COUNTIES_SQL.format(
+            aoi='boundary_huc12.geom_detailed')
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {COUNTY_OVERLAPS_TABLE}')
+            cursor.execute(f'''
+                CREATE TABLE {COUNTY_OVERLAPS_TABLE} AS
+                SELECT boundary_huc12.id AS huc12_id, {columns}
+                FROM boundary_huc12
+                CROSS JOIN LATERAL {clipped_counties}
+                ''')
+            cursor.execute(f'CREATE INDEX {COUNTY_OVERLAPS_TABLE}_huc12_id '
+                           f'ON {COUNTY_OVERLAPS_TABLE} (huc12_id)')
+            cursor.execute(f'SELECT COUNT(DISTINCT huc12_id), COUNT(*) '
+                           f'FROM {COUNTY_OVERLAPS_TABLE}')
+            huc12s, overlaps = cursor.fetchone()
+
+        self.stdout.write(f'Built {COUNTY_OVERLAPS_TABLE} with {overlaps} '
+                          f'overlaps of {huc12s} HUC-12s with counties')
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import numpy
+
+from os.path import join
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from apps.modeling.mapshed.weather import (MEASURES, STORE_VERSION,
+                                           read_weather)
+
+
+class Command(BaseCommand):
+    help = ('Build the memory-mapped store of the daily weather in '
+            'ms_weather read by `apps.modeling.mapshed.calcs.weather_data`. '
+            'Rebuild it whenever ms_weather is reloaded, and restart the '
+            'workers to pick it up.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.WEATHER_STORE,
+                            help='Directory to write the store to')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of stations to read per query')
+
+    def handle(self, **options):
+        path = options['path']
+        batch_size = options['batch_size']
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT DISTINCT station FROM ms_weather '
+                           'ORDER BY station')
+            stations = [int(row[0]) for row in cursor.fetchall()]
+            cursor.execute('SELECT MIN(year), MAX(year) FROM ms_weather')
+            begyear, endyear = (int(year) for year in cursor.fetchone())
+
+        shape = (len(stations), endyear - begyear + 1, 12, 31)
+        os.makedirs(path, exist_ok=True)
+
+        self.stdout.write(f'Reading {len(stations)} stations from {begyear} '
+                          f'to {endyear}')
+
+        # Values are read as doubles, and stored as floats if that is exact,
+        # so that the store returns the same values as ms_weather
+        arrays = {measure: numpy.lib.format.open_memmap(
+                      join(path, f'{measure}.npy.tmp'), mode='w+',
+                      dtype=float, shape=shape)
+                  for measure in MEASURES}
+        exact = {measure: True for measure in MEASURES}
+
+        for start in range(0, len(stations), batch_size):
+            batch = stations[start:start + batch_size]
+            _, values = read_weather(batch, begyear, endyear)
+
+            for measure in MEASURES:
+                arrays[measure][start:start + len(batch)] = values[measure]
+                exact[measure] &= numpy.array_equal(
+                    values[measure].astype(numpy.float32), values[measure],
+                    equal_nan=True)
+
+        for measure, array in arrays.items():
+            array.flush()
+            tmp = join(path, f'{measure}.npy.tmp')
+
+            if exact[measure]:
+                narrowed = numpy.lib.format.open_memmap(
+                    f'{tmp}.float32', mode='w+', dtype=numpy.float32,
+                    shape=shape)
+                narrowed[:] = array
+                narrowed.flush()
+                os.replace(f'{tmp}.float32', tmp)
+
+            # Workers that mapped the previous files keep reading them
+            os.replace(tmp, join(path, f'{measure}.npy'))
+
+            dtype = 'float32' if exact[measure] else 'float64'
+            self.stdout.write(f'Wrote {measure} as {dtype}')
+
+        numpy.save(join(path, 'stations.npy'),
+                   numpy.array(stations, dtype=numpy.int64))
+
+        with open(join(path, 'meta.json.tmp'), 'w') as f:
+            json.dump({'version': STORE_VERSION,
+                       'begyear': begyear,
+                       'endyear': endyear}, f)
+        os.replace(join(path, 'meta.json.tmp'), join(path, 'meta.json'))
+
+        self.stdout.write(f'Built weather store in {path}')
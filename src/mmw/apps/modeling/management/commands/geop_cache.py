@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import re
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from django_redis import get_redis_connection
+
+from apps.modeling.geoprocessing import NAMESPACE_PREFIX
+
+NAMESPACED_KEY = re.compile(r'^geop_([0-9a-f]{12})__')
+LEGACY = 'legacy'
+
+
+class Command(BaseCommand):
+    help = ('Report the number of cached geoprocessing results in each cache '
+            'namespace, and evict those in stale namespaces, i.e. ones made '
+            'from layers or layer versions that are no longer configured in '
+            'settings.GEOP, as well as results cached before namespaces.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--evict', action='store_true',
+                            help='Delete the results in stale namespaces')
+        parser.add_argument('--namespace', action='append', default=[],
+                            help='Also consider this namespace stale. '
+                                 'May be given more than once.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of keys per SCAN and per pipeline '
+                                 'of deletes')
+
+    def handle(self, **options):
+        conn = get_redis_connection('default')
+        prefix = cache.make_key('')
+        batch_size = options['batch_size']
+
+        registry = read_registry(conn, prefix, batch_size)
+        stale = {namespace for namespace, layers in registry.items()
+                 if is_stale(layers)}
+        stale.update(options['namespace'])
+        stale.add(LEGACY)
+
+        counts = defaultdict(int)
+        evicted = 0
+        batch = []
+
+        for raw_key in conn.scan_iter(match=f'{prefix}geop_*',
+                                      count=batch_size):
+            key = raw_key.decode()[len(prefix):]
+
+            # Leases are short-lived, and registrations are handled below
+            if key.startswith(NAMESPACE_PREFIX) or key.endswith('__lease'):
+                continue
+
+            match = NAMESPACED_KEY.match(key)
+            namespace = match.group(1) if match else LEGACY
+            counts[namespace] += 1
+
+            if options['evict'] and namespace in stale:
+                batch.append(raw_key)
+                if len(batch) >= batch_size:
+                    evicted += delete(conn, batch)
+                    batch = []
+
+        if options['evict']:
+            if batch:
+                evicted += delete(conn, batch)
+
+            delete(conn, [cache.make_key(f'{NAMESPACE_PREFIX}{namespace}')
+                          for namespace in stale if namespace in registry])
+
+        for namespace in sorted(set(counts) | set(registry)):
+            if namespace in stale:
+                status = 'stale'
+            elif namespace in registry:
+                status = 'current'
+            else:
+                status = 'unregistered'
+
+            self.stdout.write(f'{namespace:<12} {status:<12} '
+                              f'{counts[namespace]:>10} keys  '
+                              f'{describe(registry.get(namespace, {}))}')
+
+        if options['evict']:
+            self.stdout.write(f'Evicted {evicted} keys')
+
+
+def read_registry(conn, prefix, batch_size):
+    """
+    Returns a dictionary of every registered namespace to the layers it was
+    made from. See `apps.modeling.geoprocessing.cache_namespace`.
+    """
+    keys = [raw_key.decode()[len(prefix):]
+            for raw_key in conn.scan_iter(
+                match=f'{prefix}{NAMESPACE_PREFIX}*', count=batch_size)]
+
+    return {key[len(NAMESPACE_PREFIX):]: layers
+            for key, layers in cache.get_many(keys).items()}
+
+
+def is_stale(layers):
+    """
+    Returns True if any layer token of a namespace is no longer configured,
+    has a different version, or if not overridden, a different layer.
+    """
+    for token, (layer, version, overridden) in layers.items():
+        # Layers named directly in an operation, rather than by token
+        if not token.startswith('__'):
+            continue
+
+        if token not in settings.GEOP['layers']:
+            return True
+
+        if version != settings.GEOP['layer_versions'].get(token, 0):
+            return True
+
+        if not overridden and layer != settings.GEOP['layers'][token]:
+            return True
+
+    return False
+
+
+def describe(layers):
+    return ' '.join(f'{token}={layer}@{version}{"*" if overridden else ""}'
+                    for token, (layer, version, overridden)
+                    in sorted(layers.items()))
+
+
+def delete(conn, keys):
+    pipeline = conn.pipeline(transaction=False)
+    for key in keys:
+        pipeline.delete(key)
+
+    return sum(pipeline.execute())
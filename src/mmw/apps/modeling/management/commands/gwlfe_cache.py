@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from apps.modeling.tasks import GWLFE_CACHE_HITS, GWLFE_CACHE_MISSES
+
+
+class Command(BaseCommand):
+    help = ('Report the number of GWLF-E runs whose results were found in the '
+            'cache, and of those that were not, since the counts were reset.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='Reset the counts after reporting them')
+
+    def handle(self, **options):
+        counts = cache.get_many([GWLFE_CACHE_HITS, GWLFE_CACHE_MISSES])
+        hits = counts.get(GWLFE_CACHE_HITS, 0)
+        misses = counts.get(GWLFE_CACHE_MISSES, 0)
+        rate = hits / (hits + misses) if hits + misses else 0
+
+        self.stdout.write(f'{hits} hits, {misses} misses, '
+                          f'{rate:.1%} hit rate')
+
+        if options['reset']:
+            cache.delete_many([GWLFE_CACHE_HITS, GWLFE_CACHE_MISSES])
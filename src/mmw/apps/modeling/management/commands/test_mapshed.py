@@ -1,7 +1,10 @@
 import unittest
 import json
 
+import numpy
+
 from os.path import join, dirname, abspath
+from uuid import uuid4
 
 from django.core.management.base import BaseCommand
 from django.test import tag
@@ -36,3 +39,35 @@ class TestMapshed(unittest.TestCase):
         diffs = list(diff(self.z, z, tolerance=1e-15))
 
         self.assertEqual(diffs, [])
+
+    @tag('mapshed')
+    def test_collect_data_with_query_pool(self):
+        # As for the HUC-12s of a subbasin chunk, sharing the connections
+        with tasks.QueryPool(tasks.QUERY_POOL_SIZE) as pool:
+            for _ in range(2):
+                z = tasks.collect_data(self.geop_results, self.geojson,
+                                       pool=pool)
+
+                diffs = list(diff(self.z, z, tolerance=1e-15))
+
+                self.assertEqual(diffs, [])
+
+    @tag('mapshed')
+    def test_subbasin_weather_without_cache(self):
+        # As for a subbasin chunk that runs after the shared weather has
+        # been evicted from the cache
+        ws, (temps, prcps) = tasks.nearest_weather(self.geojson, 1)
+        begyear = int(max([w.begyear for w in ws]))
+        endyear = int(min([w.endyear for w in ws]))
+
+        stations, weather = tasks.subbasin_weather(
+            f'subbasin_{uuid4()}', [('huc12__55174', 1, self.geojson)],
+            begyear, endyear)
+
+        self.assertEqual([row['station'] for row in stations[1]],
+                         [w.station for w in ws])
+        for w in ws:
+            numpy.testing.assert_array_equal(weather[w.station][0],
+                                             temps[w.station])
+            numpy.testing.assert_array_equal(weather[w.station][1],
+                                             prcps[w.station])
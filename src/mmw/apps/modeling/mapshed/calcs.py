@@ -11,6 +11,8 @@ from django.db import connection
 
 from django.contrib.gis.geos import GEOSGeometry
 
+from apps.modeling.mapshed.weather import read_weather, weather_store
+
 NRur = settings.GWLFE_DEFAULTS['NRur']
 NUM_WEATHER_STATIONS = settings.GWLFE_CONFIG['NumWeatherStations']
 KV_FACTOR = settings.GWLFE_CONFIG['KvFactor']
@@ -51,38 +53,46 @@ def nearest_weather_stations(shapes, n=NUM_WEATHER_STATIONS):
     """
     Given a list of geometries, returns a list of the n closest
     weather stations to each of them
+
+    All shapes are looked up in a single query, and only the stations found
+    nearest to each are transformed to measure their distance.
     """
 
-    subquery = '''
-          (SELECT %s watershed_id, station, location, meanrh, meanwind,
+    sql = '''
+          SELECT aoi.idx watershed_id, station, location, meanrh, meanwind,
                  meanprecip, begyear, endyear, eroscoeff, rain_cool,
                  rain_warm, etadj, grw_start, grw_end,
-                 ST_Distance(ST_Transform(geom, 5070),
-                             ST_Transform(
-                                ST_SetSRID(ST_GeomFromText(%s), 4326),
-                                           5070)) dist
-          FROM ms_weather_station
-          ORDER BY geom <-> ST_SetSRID(ST_GeomFromText(%s), 4326)
-          LIMIT %s)
+                 ST_Distance(ST_Transform(ws.geom, 5070), aoi.geom_5070) dist
+          FROM (SELECT idx, geom, ST_Transform(geom, 5070) geom_5070
+                FROM (SELECT idx, ewkb::geometry geom
+                      FROM unnest(%s::text[]) WITH ORDINALITY AS s(ewkb, idx)
+                     ) AS shapes
+               ) AS aoi
+          CROSS JOIN LATERAL (
+              SELECT *
+              FROM ms_weather_station
+              ORDER BY geom <-> aoi.geom
+              LIMIT %s
+          ) AS ws
+          ORDER BY aoi.idx, dist;
           '''
-    subqueries, params = [], []
+    watershed_ids, params = [], []
     for (_, watershed_id, aoi) in shapes:
-        subqueries.append(subquery)
-        geom = GEOSGeometry(aoi, srid=4326)
-        params.extend([watershed_id, geom.wkt, geom.wkt, n])
-
-    sql = ' UNION '.join(subqueries) + ';'
+        watershed_ids.append(watershed_id)
+        params.append(GEOSGeometry(aoi, srid=4326).hexewkb.decode())
 
     with connection.cursor() as cursor:
-        cursor.execute(sql, params)
+        cursor.execute(sql, [params, n])
 
         if cursor.rowcount == 0:
             raise Exception("No weather stations found.")
 
-        # Return all rows from cursor as namedtuple
+        # Return all rows from cursor as namedtuple, with the watershed id of
+        # the shape in place of its position in the list
         weather_station = namedtuple('WeatherStation',
                                      [col[0] for col in cursor.description])
-        return [weather_station(*row) for row in cursor.fetchall()]
+        return [weather_station(watershed_ids[row[0] - 1], *row[1:])
+                for row in cursor.fetchall()]
 
 
 def growing_season(ws):
@@ -156,54 +166,127 @@ def kv_coefficient(area_pcts, season):
     return kv
 
 
-def animal_energy_units(geom):
+# Sums over the counties of an area of interest of their animal populations,
+# weighted by the part of each county in it, and of their LS, C and P factors,
+# weighted by the part of it in each county. Counties are clipped to the area
+# of interest by `county_clip` below.
+COUNTY_CLIP_SUMS_SQL = '''
+          SELECT COALESCE(SUM(beef_ha * ag_ha * county_pct), 0.0) AS beef_cows,
+                 COALESCE(SUM(broiler_ha * ag_ha * county_pct), 0.0)
+                     AS broilers,
+                 COALESCE(SUM(dairy_ha * ag_ha * county_pct), 0.0)
+                     AS dairy_cows,
+                 COALESCE(SUM(goat_ha * ag_ha * county_pct), 0.0) +
+                 COALESCE(SUM(sheep_ha * ag_ha * county_pct), 0.0) AS sheep,
+                 COALESCE(SUM(hog_ha * ag_ha * county_pct), 0.0) AS hogs,
+                 COALESCE(SUM(horse_ha * ag_ha * county_pct), 0.0) AS horses,
+                 COALESCE(SUM(layer_ha * ag_ha * county_pct), 0.0) AS layers,
+                 COALESCE(SUM(turkey_ha * ag_ha * county_pct), 0.0)
+                     AS turkeys,
+                 COALESCE(SUM(hp_ls * aoi_pct), 0.0) AS hp_ls,
+                 COALESCE(SUM(hp_c * aoi_pct), 0.0) AS hp_c,
+                 COALESCE(SUM(hp_p * aoi_pct), 0.0) AS hp_p,
+                 COALESCE(SUM(crop_ls * aoi_pct), 0.0) AS crop_ls,
+                 COALESCE(SUM(crop_c * aoi_pct), 0.0) AS crop_c,
+                 COALESCE(SUM(crop_p * aoi_pct), 0.0) AS crop_p
+          FROM {clipped_counties}
+          '''
+
+# The counties clipped to the geometry aoi, with the part of each county in
+# it, and the part of it in each county
+CLIPPED_COUNTIES_SQL = '''
+          (SELECT clip_area / ST_Area(geom) AS county_pct,
+                  clip_area / ST_Area(aoi) AS aoi_pct,
+                  clipped_counties.*
+           FROM (SELECT ST_Area(ST_Intersection(geom, aoi)) AS clip_area,
+                        aoi,
+                        ms_county_animals.*
+                 FROM ms_county_animals,
+                      (SELECT {aoi} AS aoi) AS shape
+                 WHERE ST_Intersects(geom, aoi)) AS clipped_counties
+          ) AS clipped_counties_with_area
+          '''
+
+# Table of the counties clipped to each HUC-12, precomputed by
+# `./scripts/manage.sh build_county_overlaps`
+COUNTY_OVERLAPS_TABLE = 'ms_county_huc12'
+COUNTY_OVERLAPS_SQL = f'''
+          (SELECT *
+           FROM {COUNTY_OVERLAPS_TABLE}
+           WHERE huc12_id = %s) AS clipped_counties_with_area
+          '''
+
+ANIMAL_COLUMNS = ['beef_cows', 'broilers', 'dairy_cows', 'sheep', 'hogs',
+                  'horses', 'layers', 'turkeys']
+AG_LS_C_P_COLUMNS = ['hp_ls', 'hp_c', 'hp_p', 'crop_ls', 'crop_c', 'crop_p']
+
+Ag_LS_C_P = namedtuple('Ag_LS_C_P', AG_LS_C_P_COLUMNS)
+
+# Whether the county overlaps table exists. See `has_county_overlaps` below.
+_has_county_overlaps = None
+
+
+def county_clip(geom, wkaoi=None):
     """
-    Given a geometry, returns the total livestock and poultry AEUs within it
+    Given a geometry, clips the counties of ms_county_animals to it once,
+    and returns both the total livestock and poultry AEUs within it, and the
+    area-weighted average value of LS, C, and P factors for agricultural land
+    use types within it, namely Hay/Pasture and Cropland:
+
+        (ag_lscp, (livestock_aeu, poultry_aeu, population))
+
+    If the geometry is a HUC-12 with the given wkaoi, and the county overlaps
+    table has been built, the clipped counties are read from it instead.
 
     Original at Class1.vb@1.3.0:9230-9247
     """
-    sql = '''
-          WITH clipped_counties AS (
-              SELECT ST_Intersection(geom,
-                                     ST_SetSRID(ST_GeomFromText(%s),
-                                                4326)) AS geom_clipped,
-                     ms_county_animals.*
-              FROM ms_county_animals
-              WHERE ST_Intersects(geom,
-                                  ST_SetSRID(ST_GeomFromText(%s),
-                                             4326))
-          ), clipped_counties_with_area AS (
-              SELECT ST_Area(geom_clipped) / ST_Area(geom) AS clip_pct,
-                     clipped_counties.*
-              FROM clipped_counties
-          )
-          SELECT COALESCE(SUM(beef_ha * ag_ha * clip_pct), 0.0) AS beef_cows,
-                 COALESCE(SUM(broiler_ha * ag_ha * clip_pct), 0.0) AS broilers,
-                 COALESCE(SUM(dairy_ha * ag_ha * clip_pct), 0.0) AS dairy_cows,
-                 COALESCE(SUM(goat_ha * ag_ha * clip_pct), 0.0) +
-                 COALESCE(SUM(sheep_ha * ag_ha * clip_pct), 0.0) AS sheep,
-                 COALESCE(SUM(hog_ha * ag_ha * clip_pct), 0.0) AS hogs,
-                 COALESCE(SUM(horse_ha * ag_ha * clip_pct), 0.0) AS horses,
-                 COALESCE(SUM(layer_ha * ag_ha * clip_pct), 0.0) AS layers,
-                 COALESCE(SUM(turkey_ha * ag_ha * clip_pct), 0.0) AS turkeys
-          FROM clipped_counties_with_area;
-          '''
+    table, _, id = (wkaoi or '').partition('__')
+
+    if table == 'huc12' and has_county_overlaps():
+        sql = COUNTY_CLIP_SUMS_SQL.format(
+            clipped_counties=COUNTY_OVERLAPS_SQL)
+        params = [int(id)]
+    else:
+        sql = COUNTY_CLIP_SUMS_SQL.format(
+            clipped_counties=CLIPPED_COUNTIES_SQL.format(
+                aoi='ST_SetSRID(ST_GeomFromText(%s), 4326)'))
+        params = [geom.wkt]
 
     with connection.cursor() as cursor:
-        cursor.execute(sql, [geom.wkt, geom.wkt])
+        cursor.execute(sql, params)
 
         # Convert result to dictionary
         columns = [col[0] for col in cursor.description]
         values = cursor.fetchone()  # Only one row since aggregate query
-        population = dict(zip(columns, values))
-        livestock_aeu = round(sum(population[animal] *
-                                  WEIGHTOF[animal] / 1000
-                                  for animal in LIVESTOCK))
-        poultry_aeu = round(sum(population[animal] *
-                                WEIGHTOF[animal] / 1000
-                                for animal in POULTRY))
+        row = dict(zip(columns, values))
+
+    ag_lscp = Ag_LS_C_P(*[row[column] for column in AG_LS_C_P_COLUMNS])
+
+    population = {animal: row[animal] for animal in ANIMAL_COLUMNS}
+    livestock_aeu = round(sum(population[animal] *
+                              WEIGHTOF[animal] / 1000
+                              for animal in LIVESTOCK))
+    poultry_aeu = round(sum(population[animal] *
+                            WEIGHTOF[animal] / 1000
+                            for animal in POULTRY))
 
-        return livestock_aeu, poultry_aeu, population
+    return ag_lscp, (livestock_aeu, poultry_aeu, population)
+
+
+def has_county_overlaps():
+    """
+    Returns True if the county overlaps table has been built. Checked once
+    per process.
+    """
+    global _has_county_overlaps
+
+    if _has_county_overlaps is None:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT to_regclass(%s) IS NOT NULL',
+                           [COUNTY_OVERLAPS_TABLE])
+            _has_county_overlaps = cursor.fetchone()[0]
+
+    return _has_county_overlaps
 
 
 def manure_spread(aeu):
@@ -224,47 +307,6 @@ def manure_spread(aeu):
     return [n_spread] * num_land_uses, [p_spread] * num_land_uses
 
 
-def ag_ls_c_p(geom):
-    """
-    Given a geometry, calculates the area-weighted average value of LS, C, and
-    P factors for agriculatural land use tyeps within the geometry, namely
-    Hay/Pasture and Cropland.
-    """
-    sql = '''
-          WITH clipped_counties AS (
-              SELECT ST_Intersection(geom,
-                                     ST_SetSRID(ST_GeomFromText(%s),
-                                                4326)) AS geom_clipped,
-                     ms_county_animals.*
-              FROM ms_county_animals
-              WHERE ST_Intersects(geom,
-                                  ST_SetSRID(ST_GeomFromText(%s),
-                                             4326))
-          ), clipped_counties_with_area AS (
-              SELECT ST_Area(geom_clipped) /
-                     ST_Area(ST_SetSRID(ST_GeomFromText(%s),
-                                        4326)) AS clip_pct,
-                     clipped_counties.*
-              FROM clipped_counties
-          )
-          SELECT COALESCE(SUM(hp_ls * clip_pct), 0.0) AS hp_ls,
-                 COALESCE(SUM(hp_c * clip_pct), 0.0) AS hp_c,
-                 COALESCE(SUM(hp_p * clip_pct), 0.0) AS hp_p,
-                 COALESCE(SUM(crop_ls * clip_pct), 0.0) AS crop_ls,
-                 COALESCE(SUM(crop_c * clip_pct), 0.0) AS crop_c,
-                 COALESCE(SUM(crop_p * clip_pct), 0.0) AS crop_p
-          FROM clipped_counties_with_area;
-          '''
-
-    with connection.cursor() as cursor:
-        cursor.execute(sql, [geom.wkt, geom.wkt, geom.wkt])
-
-        ag_lscp = namedtuple('Ag_LS_C_P',
-                             [col[0] for col in cursor.description])
-
-        return ag_lscp(*(cursor.fetchone()))
-
-
 def ls_factors(lu_strms, total_strm_len, areas, avg_slope, ag_lscp):
     results = [0.0] * len(lu_strms)
     if 0 <= avg_slope <= 1.0:
@@ -410,70 +452,26 @@ def weather_data(ws, begyear, endyear):
     where `year` 0 corresponds to the first year in the range, 1 to the second,
     and so on; `month` 0 corresponds to January, 1 to February, and so on;
     `day` 0 corresponds to the 1st of the month, 1 to the 2nd, and so on.
+
+    The arrays are sliced from the memory-mapped weather store if it has been
+    built and has every station, and read from ms_weather otherwise. See
+    `apps.modeling.mapshed.weather`.
     """
-    # Utility function to convert Fahrenheit to Celsius
-    def f_to_c(f):
-        return (f - 32) * 5.0 / 9.0
-
-    temp_sql = '''
-               SELECT station, year,
-                   EXTRACT(MONTH FROM TO_DATE(month, 'MON')) AS month,
-                    "1",  "2",  "3",  "4",  "5",  "6",  "7",  "8",  "9", "10",
-                   "11", "12", "13", "14", "15", "16", "17", "18", "19", "20",
-                   "21", "22", "23", "24", "25", "26", "27", "28", "29", "30",
-                   "31"
-               FROM ms_weather
-               WHERE station IN %s
-                 AND measure IN ('TMax', 'TMin')
-                 AND year BETWEEN %s AND %s
-               ORDER BY year, month;
-               '''
-    prcp_sql = '''
-               SELECT station, year,
-                   EXTRACT(MONTH FROM TO_DATE(month, 'MON')) AS month,
-                    "1",  "2",  "3",  "4",  "5",  "6",  "7",  "8",  "9", "10",
-                   "11", "12", "13", "14", "15", "16", "17", "18", "19", "20",
-                   "21", "22", "23", "24", "25", "26", "27", "28", "29", "30",
-                   "31"
-               FROM ms_weather
-               WHERE station IN %s
-                 AND measure = 'Prcp'
-                 AND year BETWEEN %s AND %s
-               ORDER BY year, month;
-               '''
-
-    year_range = endyear - begyear + 1
-    stations = tuple([w.station for w in ws])
-    # For each station id, create a 3D array of 0s
-    # where each 0 is a placeholder for a temperature/precipitation
-    # value on a given year, month, day: array[year][month][day] = 0
-    temps = {station_id: [[[0] * 31 for m in range(12)]
-                          for y in range(year_range)]
-             for station_id in stations}
-    prcps = {station_id: [[[0] * 31 for m in range(12)]
-                          for y in range(year_range)]
-             for station_id in stations}
-    # Query the DB for daily temperatures for each weather station
-    with connection.cursor() as cursor:
-        cursor.execute(temp_sql, [stations, begyear, endyear])
-        for row in cursor.fetchall():
-            station = int(row[0])
-            year = int(row[1]) - begyear
-            month = int(row[2]) - 1
-            for day in range(31):
-                temps[station][year][month][day] = f_to_c(float(row[day + 3]))
-    # Query the DB for daily precipitation values for each weather station
-    with connection.cursor() as cursor:
-        cursor.execute(prcp_sql, [stations, begyear, endyear])
-        for row in cursor.fetchall():
-            station = int(row[0])
-            year = int(row[1]) - begyear
-            month = int(row[2]) - 1
-            for day in range(31):
-                prcp = float(row[day + 3]) * CM_PER_INCH
-                prcps[station][year][month][day] = prcp
-
-    return temps, prcps
+    stations = [w.station for w in ws]
+
+    store = weather_store()
+    if store is not None and store.covers(stations, begyear, endyear):
+        stations, arrays = store.read(stations, begyear, endyear)
+    else:
+        stations, arrays = read_weather(stations, begyear, endyear)
+
+    # Convert Fahrenheit to Celsius and inches to centimeters. Days without
+    # data are 0.
+    temps = numpy.nan_to_num((arrays['temp'].astype(float) - 32) * 5.0 / 9.0)
+    prcps = numpy.nan_to_num(arrays['prcp'].astype(float) * CM_PER_INCH)
+
+    return ({station: temps[idx] for idx, station in enumerate(stations)},
+            {station: prcps[idx] for idx, station in enumerate(stations)})
 
 
 def average_weather_data(wd):
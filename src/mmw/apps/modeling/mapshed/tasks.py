@@ -1,19 +1,30 @@
 # -*- coding: utf-8 -*-
+import numpy as np
+
+from collections import namedtuple
+from concurrent.futures import Future
 from copy import deepcopy
-from celery import shared_task
+from functools import partial
+from queue import SimpleQueue
+from threading import Thread
+from uuid import uuid4
+
+from celery import chord, shared_task
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 
 from django.contrib.gis.geos import GEOSGeometry
 
 from apps.modeling.calcs import get_layer_value
-from apps.modeling.geoprocessing import NOCACHE, multi, run, parse
+from apps.modeling.geoprocessing import (NOCACHE, multi, run, parse,
+                                         parse_histogram)
 from apps.modeling.mapshed.calcs import (day_lengths,
                                          nearest_weather_stations,
                                          growing_season,
                                          erosion_coeff,
                                          et_adjustment,
-                                         animal_energy_units,
-                                         ag_ls_c_p,
+                                         county_clip,
                                          ls_factors,
                                          p_factors,
                                          manure_spread,
@@ -40,11 +51,16 @@ ACRES_PER_SQM = 0.000247105
 HECTARES_PER_SQM = 0.0001
 SQKM_PER_SQM = 0.000001
 NO_LAND_COVER = 'NO_LAND_COVER'
+# Seconds to keep the weather shared by the chunks of a subbasin run
+SUBBASIN_WEATHER_TIMEOUT = 60 * 60
+# Threads, and database connections, to run the independent queries of
+# `collect_data` on. One for each of them.
+QUERY_POOL_SIZE = 4
 
 
 @shared_task
 def collect_data(geop_results, geojson, watershed_id=None, weather=None,
-                 layer_overrides={}):
+                 layer_overrides={}, wkaoi=None, pool=None):
     geop_result = {k: v for r in geop_results for k, v in r.items()}
 
     geom = GEOSGeometry(geojson, srid=4326)
@@ -58,11 +74,24 @@ def collect_data(geop_results, geojson, watershed_id=None, weather=None,
     # Statically calculated lookup values
     z['DayHrs'] = day_lengths(geom)
 
+    # Query the independent datasets concurrently
+    datasource = get_layer_value('__STREAMS__', layer_overrides)
+    queries = {
+        'county': partial(county_clip, geom, wkaoi),
+        'stream_length': partial(stream_length, geom, datasource),
+        'point_source': partial(point_source_discharge, geom, area,
+                                drb=geom.within(DRB)),
+    }
+    if weather is None:
+        queries['weather'] = partial(nearest_weather, geojson, watershed_id)
+
+    gathered = pool.gather(queries) if pool else gather(queries)
+
     # Data from the Weather Stations dataset
     if weather is not None:
         ws, wd = weather
     else:
-        ws = nearest_weather_stations([(None, watershed_id, geojson)])
+        ws, wd = gathered['weather']
 
     z['WeatherStations'] = [{'station': s.station,
                              'distance': s.dist} for s in ws]
@@ -75,11 +104,11 @@ def collect_data(geop_results, geojson, watershed_id=None, weather=None,
     z['WxYrs'] = z['WxYrEnd'] - z['WxYrBeg'] + 1
 
     # Data from the County Animals dataset
-    ag_lscp = ag_ls_c_p(geom)
+    ag_lscp, aeu = gathered['county']
     z['C'][0] = ag_lscp.hp_c
     z['C'][1] = ag_lscp.crop_c
 
-    livestock_aeu, poultry_aeu, population = animal_energy_units(geom)
+    livestock_aeu, poultry_aeu, population = aeu
     z['AEU'] = livestock_aeu / (area * ACRES_PER_SQM)
     z['n41j'] = livestock_aeu
     z['n41k'] = poultry_aeu
@@ -90,20 +119,17 @@ def collect_data(geop_results, geojson, watershed_id=None, weather=None,
     z['ManNitr'], z['ManPhos'] = manure_spread(z['AEU'])
 
     # Data from Streams dataset
-    datasource = get_layer_value('__STREAMS__', layer_overrides)
-    z['StreamLength'] = stream_length(geom, datasource) or 10  # Meters
-    z['n42b'] = round(z['StreamLength'] / 1000, 1)             # Kilometers
+    z['StreamLength'] = gathered['stream_length'] or 10  # Meters
+    z['n42b'] = round(z['StreamLength'] / 1000, 1)       # Kilometers
 
     # Data from Point Source Discharge dataset
-    n_load, p_load, discharge = point_source_discharge(geom, area,
-                                                       drb=geom.within(DRB))
+    n_load, p_load, discharge = gathered['point_source']
     z['PointNitr'] = n_load
     z['PointPhos'] = p_load
     z['PointFlow'] = discharge
 
     # Data from National Weather dataset
     if weather is None:
-        wd = weather_data(ws, z['WxYrBeg'], z['WxYrEnd'])
         temps_dict, prcps_dict = wd
         temps = average_weather_data(list(temps_dict.values()))
         prcps = average_weather_data(list(prcps_dict.values()))
@@ -179,6 +205,94 @@ def collect_data(geop_results, geojson, watershed_id=None, weather=None,
     return z
 
 
+def gather(queries):
+    """
+    Runs independent database queries concurrently, so that they take about
+    as long as the slowest one. Given a dictionary of names to functions,
+    returns a dictionary of names to their results.
+
+    To run the queries of many shapes, use one `QueryPool` for all of them
+    instead, to open its connections only once.
+    """
+    with QueryPool(len(queries)) as pool:
+        return pool.gather(queries)
+
+
+class QueryPool(object):
+    """
+    A fixed set of threads to run independent database queries on, each with
+    its own database connection, which is kept open from one query to the
+    next, and closed when the pool is. Use as a context manager:
+
+        with QueryPool(QUERY_POOL_SIZE) as pool:
+            for shape in shapes:
+                collect_data(..., pool=pool)
+    """
+    def __init__(self, size):
+        self.queue = SimpleQueue()
+        self.threads = [Thread(target=self._work, daemon=True)
+                        for _ in range(size)]
+
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _work(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+
+                future, query = item
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(query())
+                    except BaseException as exc:
+                        future.set_exception(exc)
+        finally:
+            connection.close()
+
+    def gather(self, queries):
+        """
+        Runs the queries concurrently, as `gather` does.
+        """
+        futures = {}
+        for name, query in queries.items():
+            futures[name] = Future()
+            self.queue.put((futures[name], query))
+
+        return {name: future.result() for name, future in futures.items()}
+
+    def close(self):
+        """
+        Waits for the queries that have been submitted, and closes the
+        threads' database connections.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+
+def nearest_weather(geojson, watershed_id=None):
+    """
+    Returns the nearest weather stations to the shape, and their weather
+    for the longest range of years they all have.
+    """
+    ws = nearest_weather_stations([(None, watershed_id, geojson)])
+    begyear = int(max([w.begyear for w in ws]))
+    endyear = int(min([w.endyear for w in ws]))
+
+    return ws, weather_data(ws, begyear, endyear)
+
+
 @shared_task(throws=Exception)
 def nlcd_streams(result):
     """
@@ -402,22 +516,14 @@ def nlcd_slope(result):
     if 'error' in result:
         raise Exception(f'[nlcd_slope] {result["error"]}')
 
-    result = parse(result)
-
-    ag_slope_3_count = 0
-    ag_slope_3_8_count = 0
-    ag_count = 0
-    total_count = 0
+    classes, counts = parse_histogram(result)
+    nlcd_code, slope = classes.reshape(-1, 2).T
+    ag = np.isin(nlcd_code, AG_NLCD_CODES)
 
-    for (nlcd_code, slope), count in result.items():
-        if nlcd_code in AG_NLCD_CODES:
-            if slope > 3:
-                ag_slope_3_count += count
-            if 3 < slope < 8:
-                ag_slope_3_8_count += count
-            ag_count += count
-
-        total_count += count
+    ag_slope_3_count = counts[ag & (slope > 3)].sum().item()
+    ag_slope_3_8_count = counts[ag & (slope > 3) & (slope < 8)].sum().item()
+    ag_count = counts[ag].sum().item()
+    total_count = counts.sum().item()
 
     # percent of AOI that is agricultural with slope > 3%
     # see Class1.vb#7223
@@ -534,8 +640,20 @@ def convert_data(payload, wkaoi):
     return data
 
 
-@shared_task
-def collect_subbasin(payload, shapes, layer_overrides={}):
+@shared_task(bind=True)
+def collect_subbasin(self, payload, shapes, layer_overrides={},
+                     chunk_size=None):
+    """
+    Collects the MapShed data of each HUC-12 in a subbasin run, in a chord of
+    `collect_subbasin_chunk` tasks for chunks of chunk_size HUC-12s, or
+    SUBBASIN_MAPSHED['chunk_size'] by default, whose results are merged in
+    order by `merge_subbasin_chunks`. See `subbasin_chord`.
+
+    Weather stations and their data, which neighbouring HUC-12s share, are
+    looked up once for all of them, and passed to the chunks by reference,
+    as the prefix of the cache keys they are stored under. Chunks look up
+    again whatever is no longer cached when they run. See `subbasin_weather`.
+    """
     # Gather weather stations and their data
     # collectively to avoid re-reading stations
     # that are shared across huc-12s
@@ -549,23 +667,130 @@ def collect_subbasin(payload, shapes, layer_overrides={}):
     huc12_ws = [w._replace(begyear=begyear)._replace(endyear=endyear)
                 for w in huc12_ws]
     # Gather the temp and prcp values for each unique weather stations
-    unique_wd = weather_data(unique_ws, begyear, endyear)
+    temps, prcps = weather_data(unique_ws, begyear, endyear)
+
+    # Share the stations of each huc-12, and the data of each station
+    key = f'subbasin_{self.request.id or uuid4()}'
+    stations = {}
+    for w in huc12_ws:
+        stations.setdefault(w.watershed_id, []).append(w._asdict())
+
+    shared = {f'{key}__stations': stations}
+    shared.update({f'{key}__weather__{station}': (temps[station],
+                                                  prcps[station])
+                   for station in temps})
+    cache.set_many(shared, SUBBASIN_WEATHER_TIMEOUT)
+
+    return self.replace(subbasin_chord(payload, shapes, key, begyear,
+                                       endyear, layer_overrides,
+                                       list(shared), chunk_size))
+
+
+def subbasin_chord(payload, shapes, key, begyear, endyear, layer_overrides,
+                   shared, chunk_size=None):
+    """
+    Returns the chord of `collect_subbasin`, which builds the GMS data for
+    each chunk of HUC-12s in parallel, and merges them, deleting the shared
+    cache keys.
+    """
+    chunk_size = chunk_size or settings.SUBBASIN_MAPSHED['chunk_size']
+    chunks = [shapes[x:x + chunk_size]
+              for x in range(0, len(shapes), chunk_size)]
+
+    return chord(
+        [collect_subbasin_chunk.s(subbasin_payload(payload, chunk), chunk,
+                                  key, begyear, endyear, layer_overrides)
+         for chunk in chunks],
+        merge_subbasin_chunks.s(shared))
+
+
+@shared_task
+def collect_subbasin_chunk(payload, shapes, key, begyear, endyear,
+                           layer_overrides={}):
+    """
+    Collects the MapShed data of a chunk of the HUC-12s of a subbasin run,
+    with the weather shared by `collect_subbasin` under the key prefix, for
+    the years from begyear to endyear.
+    """
+    stations, weather = subbasin_weather(key, shapes, begyear, endyear)
 
     # Get the stations and averaged tmp/prcp data for a specific huc-12
     def get_weather(watershed_id):
-        ws = [w for w in huc12_ws if w.watershed_id == watershed_id]
-        stations = [w.station for w in ws]
-        temps_by_station = [unique_wd[0][station] for station in stations]
-        prcps_by_station = [unique_wd[1][station] for station in stations]
-        return (ws, (average_weather_data(temps_by_station),
-                     average_weather_data(prcps_by_station)))
-    # Build the GMS data for each huc-12
-    return [
-        collect_data(convert_data(payload, wkaoi), aoi, watershed_id,
-                     get_weather(watershed_id),
-                     layer_overrides=layer_overrides)
-        for (wkaoi, watershed_id, aoi) in shapes
-    ]
+        rows = stations[watershed_id]
+        weather_station = namedtuple('WeatherStation', rows[0].keys())
+        ws = [weather_station(**row) for row in rows]
+        wd = [weather[w.station] for w in ws]
+        return (ws, (average_weather_data([temps for temps, _ in wd]),
+                     average_weather_data([prcps for _, prcps in wd])))
+
+    with QueryPool(QUERY_POOL_SIZE) as pool:
+        return [
+            collect_data(convert_data(payload, wkaoi), aoi, watershed_id,
+                         get_weather(watershed_id),
+                         layer_overrides=layer_overrides, wkaoi=wkaoi,
+                         pool=pool)
+            for (wkaoi, watershed_id, aoi) in shapes
+        ]
+
+
+def subbasin_weather(key, shapes, begyear, endyear):
+    """
+    Returns the weather stations of each of the HUC-12 shapes, as lists of
+    dictionaries by watershed id, and the temperatures and precipitation of
+    those stations by station id, shared by `collect_subbasin` under the key
+    prefix.
+
+    Whatever is no longer cached, because it expired or was evicted before a
+    chunk ran, or was retried, is looked up again for the same years, so the
+    chunk gets the same weather either way.
+    """
+    stations = cache.get(f'{key}__stations') or {}
+    if any(watershed_id not in stations for (_, watershed_id, _) in shapes):
+        stations = {}
+        for w in nearest_weather_stations(shapes):
+            w = w._replace(begyear=begyear)._replace(endyear=endyear)
+            stations.setdefault(w.watershed_id, []).append(w._asdict())
+
+    rows = {row['station']: row
+            for (_, watershed_id, _) in shapes
+            for row in stations[watershed_id]}
+    cached = cache.get_many([f'{key}__weather__{station}'
+                             for station in rows])
+    weather = {station: cached[f'{key}__weather__{station}']
+               for station in rows
+               if f'{key}__weather__{station}' in cached}
+
+    missing = [row for station, row in rows.items() if station not in weather]
+    if missing:
+        weather_station = namedtuple('WeatherStation', missing[0].keys())
+        temps, prcps = weather_data([weather_station(**row)
+                                     for row in missing], begyear, endyear)
+        weather.update({station: (temps[station], prcps[station])
+                        for station in temps})
+
+    return stations, weather
+
+
+@shared_task
+def merge_subbasin_chunks(chunks, keys):
+    """
+    Merges the results of each `collect_subbasin_chunk` into one list, in
+    the order of the HUC-12s, and deletes the weather they shared.
+    """
+    cache.delete_many(keys)
+
+    return [result for chunk in chunks for result in chunk]
+
+
+def subbasin_payload(payload, shapes):
+    """
+    Returns the part of the `multi` result for the subbasins with the given
+    shapes, or the whole result if it is an error.
+    """
+    if 'error' in payload:
+        return payload
+
+    return {wkaoi: payload[wkaoi] for (wkaoi, _, _) in shapes}
 
 
 def geoprocessing_chains(aoi, wkaoi, errback):
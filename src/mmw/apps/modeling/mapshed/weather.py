@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import numpy
+
+from os.path import join
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the layout of the store changes, so that stores built by older
+# versions are ignored until they are rebuilt
+STORE_VERSION = 1
+
+# Daily values are stored as read from ms_weather, in °F and inches, in
+# arrays of shape (station, year, month, day) named after their measure.
+# Days without a row in ms_weather are NaN.
+MEASURES = ('temp', 'prcp')
+
+WEATHER_SQL = '''
+              SELECT station, year,
+                  EXTRACT(MONTH FROM TO_DATE(month, 'MON')) AS month,
+                   "1",  "2",  "3",  "4",  "5",  "6",  "7",  "8",  "9", "10",
+                  "11", "12", "13", "14", "15", "16", "17", "18", "19", "20",
+                  "21", "22", "23", "24", "25", "26", "27", "28", "29", "30",
+                  "31"
+              FROM ms_weather
+              WHERE station IN %s
+                AND measure IN %s
+                AND year BETWEEN %s AND %s
+              ORDER BY year, month;
+              '''
+
+# ms_weather measures of each stored measure
+MS_WEATHER_MEASURES = {
+    'temp': ('TMax', 'TMin'),
+    'prcp': ('Prcp',),
+}
+
+# The memory-mapped store of this process. See `weather_store` below.
+_store = None
+
+
+def read_weather(stations, begyear, endyear):
+    """
+    Reads the daily weather of the given stations between the given years,
+    inclusive, from ms_weather. Returns the sorted station ids, and a
+    dictionary of arrays for each of MEASURES, like those of the store.
+
+    As the previous reader did, TMax and TMin rows of the same month are read
+    into the same cells, and the later one in the results is kept.
+    """
+    stations = sorted(set(stations))
+    shape = (len(stations), endyear - begyear + 1, 12, 31)
+    arrays = {}
+
+    for measure in MEASURES:
+        with connection.cursor() as cursor:
+            cursor.execute(WEATHER_SQL, [tuple(stations),
+                                         MS_WEATHER_MEASURES[measure],
+                                         begyear, endyear])
+            rows = numpy.array(cursor.fetchall(), dtype=float)
+
+        values = numpy.full(shape, numpy.nan)
+
+        if len(rows):
+            cells = numpy.ravel_multi_index((
+                numpy.searchsorted(stations, rows[:, 0]),
+                rows[:, 1].astype(int) - begyear,
+                rows[:, 2].astype(int) - 1,
+            ), shape[:3])
+
+            # Keep the last row of each cell
+            _, last = numpy.unique(cells[::-1], return_index=True)
+            last = len(cells) - 1 - last
+            values.reshape(-1, 31)[cells[last]] = rows[last, 3:]
+
+        arrays[measure] = values
+
+    return stations, arrays
+
+
+class WeatherStore(object):
+    """
+    Daily weather of every station in ms_weather, memory-mapped from the
+    files written by `./scripts/manage.sh build_weather_store`, so that
+    workers share a single copy of it in the page cache.
+    """
+    def __init__(self, path):
+        with open(join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        if meta['version'] != STORE_VERSION:
+            raise ValueError(f'Weather store version {meta["version"]} is '
+                             f'not {STORE_VERSION}')
+
+        self.begyear = meta['begyear']
+        self.endyear = meta['endyear']
+        self.stations = numpy.load(join(path, 'stations.npy'))
+        self.arrays = {measure: numpy.load(join(path, f'{measure}.npy'),
+                                           mmap_mode='r')
+                       for measure in MEASURES}
+
+        shape = (len(self.stations), self.endyear - self.begyear + 1, 12, 31)
+        for measure, array in self.arrays.items():
+            if array.shape != shape:
+                raise ValueError(f'Weather store {measure} has shape '
+                                 f'{array.shape} instead of {shape}')
+
+    def covers(self, stations, begyear, endyear):
+        """
+        Returns True if the store has every station for the given years.
+        """
+        if begyear < self.begyear or endyear > self.endyear:
+            return False
+
+        idx = numpy.searchsorted(self.stations, stations)
+        return bool(numpy.all(idx < len(self.stations)) and
+                    numpy.all(self.stations[numpy.minimum(
+                        idx, len(self.stations) - 1)] == stations))
+
+    def read(self, stations, begyear, endyear):
+        """
+        Returns the same as `read_weather`, sliced from the store.
+        """
+        stations = sorted(set(stations))
+        idx = numpy.searchsorted(self.stations, stations)
+        years = slice(begyear - self.begyear, endyear - self.begyear + 1)
+
+        return stations, {measure: array[idx, years]
+                          for measure, array in self.arrays.items()}
+
+
+def weather_store():
+    """
+    Returns the weather store at settings.WEATHER_STORE, loading it the first
+    time, or None if it has not been built.
+    """
+    global _store
+
+    if _store is None:
+        try:
+            _store = WeatherStore(settings.WEATHER_STORE)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(f'Ignoring weather store: {e}')
+            return None
+
+    return _store
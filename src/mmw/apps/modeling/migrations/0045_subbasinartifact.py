@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_job_on_delete'),
+        ('modeling', '0044_project_weather_simulations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubbasinArtifact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='The HUC-12 id, or the key of the shared weather series', max_length=255)),
+                ('data', models.BinaryField(help_text='zlib compressed JSON of the MapShed data or weather')),
+                ('job', models.ForeignKey(help_text='The subbasin MapShed job these results are a part of.', on_delete=django.db.models.deletion.CASCADE, related_name='subbasin_artifacts', to='core.job', to_field='uuid')),
+            ],
+            options={
+                'unique_together': {('job', 'key')},
+            },
+        ),
+    ]
@@ -230,3 +230,26 @@ class Scenario(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+class SubbasinArtifact(models.Model):
+    """
+    The MapShed data of one HUC-12 of a subbasin MapShed job, or one weather
+    series shared by its HUC-12s, stored apart from the job's result so that
+    subbasin GWLF-E tasks only read the HUC-12s they run.
+    """
+
+    class Meta:
+        unique_together = ('job', 'key')
+
+    job = models.ForeignKey(
+        Job,
+        to_field='uuid',
+        related_name='subbasin_artifacts',
+        on_delete=models.CASCADE,
+        help_text='The subbasin MapShed job these results are a part of.')
+    key = models.CharField(
+        max_length=255,
+        help_text='The HUC-12 id, or the key of the shared weather series')
+    data = models.BinaryField(
+        help_text='zlib compressed JSON of the MapShed data or weather')
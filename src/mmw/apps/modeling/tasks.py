@@ -1,21 +1,39 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
 import requests
 import json
+import resource
+import time
+import zlib
+
+import numpy as np
 
-from ast import literal_eval as make_tuple
 from requests.exceptions import ConnectionError, Timeout
 from io import StringIO
-from functools import reduce
+from importlib import metadata
+from numbers import Number
 
+from billiard import Pool
 from celery import shared_task
 
 from django.conf import settings
+from django.core.cache import cache
 
 from mmw.settings import layer_classmaps
 
 from apps.core.models import Job
-from apps.modeling.calcs import apply_subbasin_gwlfe_modifications
+from apps.modeling.calcs import (apply_gwlfe_modifications,
+                                 apply_subbasin_gwlfe_modifications,
+                                 count_workers,
+                                 load_subbasin_gmss,
+                                 record_gwlfe_seconds,
+                                 resolve_subbasin_weather,
+                                 share_subbasin_weather,
+                                 store_subbasin_artifacts,
+                                 subbasin_pool_processes,
+                                 )
+from apps.modeling.geoprocessing import parse_histogram
 from apps.modeling.tr55.utils import (aoi_resolution,
                                       precipitation,
                                       apply_modifications_to_census,
@@ -29,6 +47,18 @@ logger = logging.getLogger(__name__)
 KG_PER_POUND = 0.453592
 CM_PER_INCH = 2.54
 
+# Cached GWLF-E results are keyed by the version that computed them
+GWLFE_VERSION = metadata.version('gwlf-e')
+GWLFE_CACHE_HITS = 'gwlfe_cache_hits'
+GWLFE_CACHE_MISSES = 'gwlfe_cache_misses'
+
+# Load types of GWLF-E results, and the prefixes of their SRAT keys
+LOAD_TYPES = ['TotalN', 'TotalP', 'Sediment']
+SRAT_LOAD_PREFIXES = ['tnload', 'tpload', 'tssload']
+
+# Percentiles of GWLF-E results summarized by sensitivity analyses
+GWLFE_SENSITIVITY_PERCENTILES = [5, 25, 50, 75, 95]
+
 
 def format_quality(model_output):
     measures = ['Total Suspended Solids',
@@ -97,50 +127,45 @@ def format_for_srat(huc12_id, model_output):
 
 
 def format_subbasin(huc12_gwlfe_results, srat_catchment_results, gmss):
-    def empty_source(s):
-        return {'Source': s,
-                'TotalN': 0, 'TotalP': 0, 'Sediment': 0,
-                'Area': 0}
-
-    def add_huc12_source(source, srat_huc12, source_areas, total_area):
-        source_name = source['Source']
-        source_key = settings.SRAT_KEYS[source_name]
-        total_n = srat_huc12.get('tnload_' + source_key, 0)
-        total_p = srat_huc12.get('tpload_' + source_key, 0)
-        sediment = srat_huc12.get('tssload_' + source_key, 0)
-
-        normalizing_areas = settings.SUBBASIN_SOURCE_NORMALIZING_AREAS
-        source_area_idxs = normalizing_areas.get(source_name, None)
-        area = sum([source_areas[i] for i in source_area_idxs]) \
-            if source_area_idxs else total_area
-
-        source['TotalN'] += total_n
-        source['TotalP'] += total_p
-        source['Sediment'] += sediment
-        source['Area'] += area
-
-        return {
-            'Source': source_name,
-            'TotalN': total_n,
-            'TotalP': total_p,
-            'Sediment': sediment,
-            'Area': area,
-        }
-
-    def format_catchment(srat_catchment, loads_template):
-        for key, value in srat_catchment.items():
-            # A sample load source key is 'tnload_hp'.
-            # The first half 'tnload' indicates which kinds of loads
-            # The second half 'hp' is the acronym of the source of loads
-            # Sometimes the first half has underscores, like 'tn_conc_ptsource'
-            split_at = key.rfind('_')
-            if split_at > -1:
-                load_type = key[0:split_at]
-                load_source = key[split_at:]
-                for load in loads_template:
-                    if load_source == settings.SRAT_KEYS[load['Source']]:
-                        add_load_by_key(load_type, value, load)
+    """
+    Given the GWLF-E results of each HUC-12 of a subbasin run, the SRAT
+    Catchment API results for them, and their MapShed data, returns the
+    loads of each HUC-12 and its catchments, and their totals.
 
+    The loads of every HUC-12, source and type are summed as arrays. They
+    are summed in order, as running totals were, so the numbers are the
+    same to the last digit.
+    """
+    sources = list(settings.SRAT_KEYS.keys())
+    normalizing_areas = settings.SUBBASIN_SOURCE_NORMALIZING_AREAS
+    srat_huc12s = list(srat_catchment_results['huc12s'].values())
+    huc12_ids = [srat_huc12['huc12'] for srat_huc12 in srat_huc12s]
+
+    # Loads of each HUC-12 x source x load type, which SRAT may leave out
+    loads = np.array([[[srat_huc12.get(f'{prefix}_{settings.SRAT_KEYS[s]}', 0)
+                        for prefix in SRAT_LOAD_PREFIXES]
+                       for s in sources]
+                      for srat_huc12 in srat_huc12s], dtype=float)
+    loads = loads.reshape(len(srat_huc12s), len(sources), len(LOAD_TYPES))
+
+    # Areas of each HUC-12 x source, those of the land uses in its 'Area'
+    # array, or if it has none, the HUC-12's total area
+    total_areas = np.array([huc12_gwlfe_results[huc12_id]['AreaTotal']
+                            for huc12_id in huc12_ids], dtype=float)
+    land_areas = np.array([gmss[huc12_id]['Area'] for huc12_id in huc12_ids],
+                          dtype=float)
+    areas = np.stack([sum_in_order(land_areas[:, normalizing_areas[s]],
+                                   axis=1)
+                      if normalizing_areas.get(s) else total_areas
+                      for s in sources], axis=1)
+
+    summary_loads = sum_in_order(loads, axis=1)
+
+    def load(source, values, area):
+        return {'Source': source, **dict(zip(LOAD_TYPES, values)),
+                'Area': area}
+
+    def format_catchment(srat_catchment, catchment_loads):
         return {
             'TotalLoadingRates': {
                 'TotalN': srat_catchment['tnloadrate_total'],
@@ -152,88 +177,65 @@ def format_subbasin(huc12_gwlfe_results, srat_catchment_results, gmss):
                 'TotalP': srat_catchment['tploadrate_conc'],
                 'Sediment': srat_catchment['tssloadrate_conc'],
             },
-            'Loads': loads_template
-        }
-
-    def add_load_by_key(load_type, value, load):
-        type_mapping = {
-            'tpload': 'TotalP',
-            'tnload': 'TotalN',
-            'tssload': 'Sediment'
+            'Loads': catchment_loads
         }
 
-        if load_type in type_mapping:
-            load[type_mapping[load_type]] = value
+    def format_huc12(srat_huc12, huc12_loads, huc12_areas, summary_values,
+                     area):
+        summary = dict(zip(LOAD_TYPES, summary_values))
 
-        return load
+        # Catchment loads by source were never matched to SRAT's keys, which
+        # kept their underscore, so they are zeros, shared by the catchments
+        catchment_loads = [{'Source': source,
+                            'TotalN': 0, 'TotalP': 0, 'Sediment': 0}
+                           for source in sources]
 
-    def catchment_template(keys_template):
-        return [{
-            'Source': key_name,
-            'TotalN': 0,
-            'TotalP': 0,
-            'Sediment': 0
-        } for key_name in keys_template.keys()]
-
-    def sum_loads(loads):
-        def add_load(sums, load):
-            (sediment_sum,
-             nitrogen_sum,
-             phosphorus_sum) = sums
-            return (sediment_sum + load['Sediment'],
-                    nitrogen_sum + load['TotalN'],
-                    phosphorus_sum + load['TotalP'])
-
-        return reduce(add_load, loads, (0, 0, 0))
-
-    def build_summary_loads(loads, area):
-        (sum_sed, sum_n, sum_p) = sum_loads(loads)
         return {
-            'Source': 'Entire area',
-            'Area': area,
-            'Sediment': sum_sed,
-            'TotalN': sum_n,
-            'TotalP': sum_p,
-        }
-
-    def add_huc12(srat_huc12, aggregate):
-        area = huc12_gwlfe_results[srat_huc12['huc12']]['AreaTotal']
-        source_areas = gmss[srat_huc12['huc12']]['Area']
-        loads = [add_huc12_source(s, srat_huc12, source_areas, area)
-                 for s in aggregate['Loads']]
-        summary_loads = build_summary_loads(loads, area)
-        catchment_loads_template = catchment_template(settings.SRAT_KEYS)
-
-        # Build up the full AOI's values with the huc-12's
-        aggregate['SummaryLoads']['Area'] += area
-        aggregate['SummaryLoads']['Sediment'] += summary_loads['Sediment']
-        aggregate['SummaryLoads']['TotalN'] += summary_loads['TotalN']
-        aggregate['SummaryLoads']['TotalP'] += summary_loads['TotalP']
-
-        return {
-            'Loads': loads,
-            'SummaryLoads': summary_loads,
+            'Loads': [load(source, values, source_area)
+                      for source, values, source_area
+                      in zip(sources, huc12_loads, huc12_areas)],
+            'SummaryLoads': {
+                'Source': 'Entire area',
+                'Area': area,
+                'Sediment': summary['Sediment'],
+                'TotalN': summary['TotalN'],
+                'TotalP': summary['TotalP'],
+            },
             'Catchments': {
-                comid: format_catchment(result, catchment_loads_template)
+                comid: format_catchment(result, catchment_loads)
                 for comid, result in srat_huc12['catchments'].items()},
             'Raw': huc12_gwlfe_results[srat_huc12['huc12']]
         }
 
-    aggregate = {
-        'Loads': [empty_source(source_name)
-                  for source_name in settings.SRAT_KEYS.keys()],
-        'SummaryLoads': empty_source('Entire area'),
+    huc12s = zip(srat_catchment_results['huc12s'].keys(), srat_huc12s,
+                 loads.tolist(), areas.tolist(), summary_loads.tolist(),
+                 total_areas.tolist())
+
+    return {
+        'Loads': [load(source, values, area)
+                  for source, values, area
+                  in zip(sources,
+                         sum_in_order(loads, axis=0).tolist(),
+                         sum_in_order(areas, axis=0).tolist())],
+        'SummaryLoads': load('Entire area',
+                             sum_in_order(summary_loads, axis=0).tolist(),
+                             sum_in_order(total_areas, axis=0).item()),
         # All gwlf-e results should have the same inputmod hash,
         # so grab any of them
         'inputmod_hash': next(iter(
             huc12_gwlfe_results.values()))['inputmod_hash'],
+        'HUC12s': {huc12_id: format_huc12(*huc12)
+                   for huc12_id, *huc12 in huc12s},
     }
 
-    aggregate['HUC12s'] = {huc12_id: add_huc12(result, aggregate)
-                           for huc12_id, result
-                           in srat_catchment_results['huc12s'].items()}
 
-    return aggregate
+def sum_in_order(values, axis):
+    """
+    Sums an array along an axis one value after another, like Python's sum,
+    rather than pairwise, like numpy's, so that the sums are the same as
+    running totals.
+    """
+    return np.cumsum(values, axis=axis).take(-1, axis=axis)
 
 
 @shared_task(throws=Exception)
@@ -248,19 +250,27 @@ def nlcd_soil(result):
     dist = {}
     total_count = 0
 
-    for key, count in result.items():
-        # Extract (3, 4) from "List(3,4)"
-        (n, s) = make_tuple(key[4:])
-        # Map [NODATA, ad, bd] to c, [cd] to d
-        s2 = 3 if s in [settings.NODATA, 5, 6] else 4 if s == 7 else s
-        # Only count those values for which we have mappings
-        if n in layer_classmaps.NLCD and s2 in layer_classmaps.SOIL:
-            total_count += count
-            label = '{soil}:{nlcd}'.format(soil=layer_classmaps.SOIL[s2][0],
-                                           nlcd=layer_classmaps.NLCD[n][0])
-            dist[label] = {'cell_count': (
-                count + (dist[label]['cell_count'] if label in dist else 0)
-            )}
+    # Extract [[3, 4], ...] from {"List(3,4)": ...}
+    classes, _ = parse_histogram(result, values=False)
+    nlcd, soil = classes.reshape(-1, 2).T
+    # Map [NODATA, ad, bd] to c, [cd] to d
+    soil = np.where(np.isin(soil, [settings.NODATA, 5, 6]), 3,
+                    np.where(soil == 7, 4, soil))
+    # Only count those values for which we have mappings
+    mapped = np.flatnonzero(np.isin(nlcd, list(layer_classmaps.NLCD)) &
+                            np.isin(soil, list(layer_classmaps.SOIL)))
+
+    counts = list(result.values())
+    for i, n, s2 in zip(mapped.tolist(),
+                        nlcd[mapped].tolist(),
+                        soil[mapped].tolist()):
+        count = counts[i]
+        total_count += count
+        label = '{soil}:{nlcd}'.format(soil=layer_classmaps.SOIL[s2][0],
+                                       nlcd=layer_classmaps.NLCD[n][0])
+        dist[label] = {'cell_count': (
+            count + (dist[label]['cell_count'] if label in dist else 0)
+        )}
 
     return {
         'cell_count': total_count,
@@ -366,24 +376,46 @@ def run_tr55(censuses, aoi, model_input, cached_aoi_census=None):
 
 
 @shared_task
-def run_gwlfe(model_input, inputmod_hash, watershed_id=None):
+def run_gwlfe(model_input, inputmod_hash, watershed_id=None,
+              record_seconds=True, cache_result=True):
     """
     Given a model_input resulting from a MapShed run, converts that dictionary
-    to an intermediate GMS file representation, which is then parsed by GWLF-E
-    to create the final data model z. We run GWLF-E on this final data model
-    and return the results.
-
-    This intermediate GMS file representation needs to be created because most
-    of GWLF-E logic is written to handle GMS files, and to support dictionaries
-    directly we would have to replicate all that logic. Thus, it is easier to
-    simply create a GMS file and have it read that.
+    to the final data model z that GWLF-E would parse from its GMS file. We run
+    GWLF-E on this final data model and return the results.
+
+    Most of GWLF-E logic is written to handle GMS files, and to support
+    dictionaries directly we would have to replicate all that logic. Thus,
+    `to_data_model` passes the values of the GMS file from the GWLF-E writer
+    to its reader, without formatting and parsing them as text.
+
+    As GWLF-E always gives the same results for the same input, they are
+    cached by `gwlfe_cache_key` for settings.GWLFE_CACHE_TIMEOUT seconds,
+    unless cache_result is False because the input is unlikely to be run
+    again, like the random samples of a sensitivity analysis. The time it
+    takes to run is recorded with `record_gwlfe_seconds`, unless
+    record_seconds is False because the caller records it.
     """
-    output = to_gms_file(model_input)
+    timeout = settings.GWLFE_CACHE_TIMEOUT
+    key = gwlfe_cache_key(model_input) if timeout and cache_result else None
+    cached = cache.get(key) if key else None
+
+    if cached is not None:
+        count_gwlfe_cache(GWLFE_CACHE_HITS)
+        result = json.loads(zlib.decompress(cached))
+    else:
+        start = time.perf_counter()
+        z = to_data_model(model_input)
+        result, _ = gwlfe.run(z)
+
+        # Measured to size the chunks of later subbasin runs and sweeps
+        if record_seconds:
+            record_gwlfe_seconds(time.perf_counter() - start, z.WxYrs)
+
+        if key:
+            count_gwlfe_cache(GWLFE_CACHE_MISSES)
+            cache.set(key, zlib.compress(json.dumps(result).encode()),
+                      timeout)
 
-    reader = Parser.GmsReader(output)
-    z = reader.read()
-
-    result, _ = gwlfe.run(z)
     result['inputmod_hash'] = inputmod_hash
     result['watershed_id'] = watershed_id
 
@@ -394,17 +426,125 @@ def run_gwlfe(model_input, inputmod_hash, watershed_id=None):
 def run_subbasin_gwlfe_chunks(mapshed_job_uuid, modifications,
                               total_stream_lengths, inputmod_hash,
                               watershed_ids):
-    mapshed_job = Job.objects.get(uuid=mapshed_job_uuid)
-    model_input = json.loads(mapshed_job.result)
+    count_workers()
+
+    model_input = load_subbasin_gmss(mapshed_job_uuid, watershed_ids)
+    start = time.perf_counter()
+
+    runs = [(model_input[watershed_id], modifications, total_stream_lengths,
+             inputmod_hash, watershed_id)
+            for watershed_id in watershed_ids]
+    processes = subbasin_pool_processes(len(runs))
+
+    # GWLF-E is CPU bound, so the sub-basins of a chunk are run in a pool of
+    # processes, which billiard, unlike multiprocessing, can start from
+    # within a Celery worker process. Results are in the order of the runs.
+    if processes > 1:
+        memory_mb = settings.SUBBASIN_GWLFE['pool_memory_mb']
+        with Pool(processes, initializer=limit_memory,
+                  initargs=(memory_mb,)) as pool:
+            results = pool.map(run_subbasin_gwlfe, runs, chunksize=1)
+    else:
+        results = [run_subbasin_gwlfe(run) for run in runs]
+
+    seconds = time.perf_counter() - start
+    logger.info('Ran GWLF-E on a chunk of %d sub-basins in %.2fs with %d '
+                'processes', len(watershed_ids), seconds, processes)
+
+    # Measured as the time each sub-basin took in one process, including
+    # those whose results were cached, to size the chunks of later runs
+    record_gwlfe_seconds(seconds * processes / len(runs),
+                         max(gms['WxYrs'] for gms in model_input.values()))
+
+    return results
+
+
+def run_subbasin_gwlfe(run):
+    """
+    Given a tuple of a sub-basin's MapShed data, the modifications, total
+    stream lengths and inputmod_hash of its subbasin run, and its id, runs
+    GWLF-E on it. Takes one argument so it can be mapped over a pool.
+    """
+    gms, modifications, total_stream_lengths, inputmod_hash, watershed_id = run
+
+    return run_gwlfe(apply_subbasin_gwlfe_modifications(gms, modifications,
+                                                        total_stream_lengths),
+                     inputmod_hash,
+                     watershed_id,
+                     record_seconds=False)
+
+
+def limit_memory(megabytes):
+    """
+    Limits the address space of the current process to the given number of
+    megabytes, so that runaway inputs raise a MemoryError instead of
+    exhausting the worker's memory. Does nothing when 0.
+    """
+    if megabytes:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS,
+                           (megabytes * 1024 * 1024, hard))
+
+
+@shared_task
+def run_gwlfe_variants(model_input, modifications, variants, inputmod_hash,
+                       samples=False):
+    """
+    Given a model_input resulting from a MapShed run, modifications to apply
+    to it, and a dictionary of variant names to further modifications, runs
+    GWLF-E on each variant and returns a dictionary of their results.
+
+    If samples is True, the variants are random samples to be summarized by
+    `summarize_gwlfe_samples`. Their results are not cached, as they are
+    unlikely to be run again, and are returned as the first one, to use as
+    a template, and a list of the numbers of each, from `gwlfe_numbers`.
+    """
+    count_workers()
+
+    results = {
+        name: run_gwlfe(apply_gwlfe_modifications(
+                            model_input, modifications + variant_mods),
+                        inputmod_hash,
+                        cache_result=not samples)
+        for name, variant_mods in variants.items()
+    }
+
+    if not samples:
+        return results
+
+    return {
+        'template': next(iter(results.values())),
+        'numbers': [gwlfe_numbers(result) for result in results.values()],
+    }
+
+
+@shared_task
+def merge_gwlfe_variants(variant_results):
+    """
+    Merges the results of `run_gwlfe_variants` tasks into one dictionary
+    """
+    return {name: result
+            for results in variant_results
+            for name, result in results.items()}
+
+
+@shared_task
+def summarize_gwlfe_samples(sample_results, seed):
+    """
+    Given the results of `run_gwlfe_variants` tasks run with samples=True,
+    and the seed the samples were drawn with, returns the percentiles of each
+    output across the samples.
+    """
+    numbers = [row for chunk in sample_results for row in chunk['numbers']]
+    template = sample_results[0]['template']
 
-    return [
-        run_gwlfe(apply_subbasin_gwlfe_modifications(model_input[watershed_id],
-                                                     modifications,
-                                                     total_stream_lengths),
-                  inputmod_hash,
-                  watershed_id)
-        for watershed_id in watershed_ids
-    ]
+    return {
+        'seed': seed,
+        'samples': len(numbers),
+        'percentiles': GWLFE_SENSITIVITY_PERCENTILES,
+        **numbers_percentiles(template, numbers,
+                              GWLFE_SENSITIVITY_PERCENTILES),
+    }
 
 
 @shared_task
@@ -436,8 +576,8 @@ def run_srat(watersheds, mapshed_job_uuid):
         raise Exception('SRAT Catchment API did not return JSON')
 
     try:
-        mapshed_job = Job.objects.get(uuid=mapshed_job_uuid)
-        gmss = json.loads(mapshed_job.result)
+        # Only the Area of each subbasin is used, so its weather is not read
+        gmss = load_subbasin_gmss(mapshed_job_uuid, weather=False)
         result = format_subbasin(watersheds, srat_catchment_result, gmss)
     except KeyError as e:
         raise Exception('SRAT Catchment API returned malformed result: %s' % e)
@@ -455,7 +595,27 @@ def subbasin_results_to_dict(subbasin_results):
     popped_key_results = [popped_key_result(r) for chunk in subbasin_results
                           for r in chunk] if is_chunked else \
                          [popped_key_result(r) for r in subbasin_results]
-    return dict(popped_key_results)
+    results = dict(popped_key_results)
+
+    # Store the weather of MapShed results, shared by neighbouring subbasins,
+    # once. GWLF-E results have none.
+    if all('Temp' in result for result in results.values()):
+        return share_subbasin_weather(results)
+
+    return results
+
+
+@shared_task
+def store_subbasin_mapshed_artifacts(job_id):
+    """
+    Stores the SubbasinArtifacts of a subbasin MapShed job, once its result
+    has been saved, for the GWLF-E jobs run on it. See
+    `store_subbasin_artifacts`.
+    """
+    job = Job.objects.get(id=job_id)
+
+    store_subbasin_artifacts(job.uuid,
+                             resolve_subbasin_weather(json.loads(job.result)))
 
 
 def to_gms_file(mapshed_data):
@@ -473,3 +633,156 @@ def to_gms_file(mapshed_data):
     output.seek(0)
 
     return output
+
+
+def gwlfe_cache_key(model_input):
+    """
+    Returns the cache key of the GWLF-E results of the given model input,
+    made from a hash of it and the version of GWLF-E
+    """
+    digest = hashlib.sha256(json.dumps(model_input, sort_keys=True)
+                            .encode()).hexdigest()
+
+    return f'gwlfe_{GWLFE_VERSION}__{digest}'
+
+
+def count_gwlfe_cache(counter):
+    """
+    Increments the given counter of GWLF-E cache hits or misses, reported by
+    `./scripts/manage.sh gwlfe_cache`
+    """
+    cache.add(counter, 0, None)
+    try:
+        cache.incr(counter)
+    except ValueError:
+        # Evicted since it was added
+        pass
+
+
+def to_data_model(mapshed_data):
+    """
+    Given a dictionary of MapShed data, returns the same GWLF-E data model
+    as reading the GMS file from `to_gms_file` does
+    """
+    mapshed_areas = [round(a, 1) for a in mapshed_data['Area']]
+    mapshed_data['Area'] = mapshed_areas
+
+    pre_z = Parser.DataModel(mapshed_data)
+    writer = GmsRowWriter()
+    writer.write(pre_z)
+
+    return GmsRowReader(writer.rows).read()
+
+
+class GmsRowWriter(Parser.GmsWriter):
+    """
+    A GMS writer that keeps the values of each row, instead of writing them
+    as CSV
+    """
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append([self.serialize_value(col) for col in row])
+
+
+class GmsRowReader(Parser.GmsReader):
+    """
+    A GMS reader of the rows kept by a GmsRowWriter. Numbers are read as is,
+    and other values as the CSV text they would have been written as, so that
+    it returns the same data model as reading that text.
+    """
+    def __init__(self, rows):
+        self.fp = (
+            (value, line_no, col_no)
+            for line_no, row in enumerate(rows, 1)
+            for col_no, value in enumerate(row + [Parser.EOL], 1)
+        )
+
+    def next(self, typ):
+        value, line_no, col_no = next(self.fp)
+
+        # float('1.5') == float(1.5) and int('1') == int(1), but other casts,
+        # like int('1.5'), must be given the text to fail or succeed the same
+        if not (type(value) is int and typ in (int, float) or
+                type(value) is float and typ is float):
+            value = csv_text(value)
+
+        if callable(typ):
+            try:
+                return typ(value)
+            except ValueError:
+                logger.error('Unexpected token at Line {} Column {}'
+                             .format(line_no, col_no))
+                raise
+
+        if typ != value:
+            raise ValueError('Expected "{}" but got "{}" at Line {} Column {}'
+                             .format(typ, value, line_no, col_no))
+
+        return value
+
+
+def csv_text(value):
+    """
+    Returns the text a CSV writer writes for the given value
+    """
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return float.__repr__(value)
+    return str(value)
+
+
+def gwlfe_percentiles(results, percentiles):
+    """
+    Given a list of GWLF-E results, returns a result of the same shape, with
+    each number replaced by the list of its given percentiles across results.
+    Other values, like the names of sources, are taken from the first result.
+    """
+    return numbers_percentiles(results[0],
+                               [gwlfe_numbers(r) for r in results],
+                               percentiles)
+
+
+def numbers_percentiles(template, numbers, percentiles):
+    """
+    Given a GWLF-E result, and a list of the `gwlfe_numbers` of results of
+    the same shape, returns the template with each number replaced by the
+    list of its given percentiles across them.
+    """
+    values = np.percentile(np.array(numbers, dtype=float).reshape(
+        len(numbers), -1), percentiles, axis=0).T.tolist()
+
+    return fill_gwlfe_numbers(template, iter(values))
+
+
+def gwlfe_numbers(result):
+    """
+    Returns the list of numbers in a GWLF-E result, in the order they are
+    replaced by `fill_gwlfe_numbers`
+    """
+    if isinstance(result, dict):
+        return [n for value in result.values() for n in gwlfe_numbers(value)]
+    if isinstance(result, list):
+        return [n for value in result for n in gwlfe_numbers(value)]
+    if isinstance(result, Number) and not isinstance(result, bool):
+        return [result]
+
+    return []
+
+
+def fill_gwlfe_numbers(result, values):
+    """
+    Returns a copy of a GWLF-E result with each of its numbers replaced by
+    the next of the values, in the order of `gwlfe_numbers`
+    """
+    if isinstance(result, dict):
+        return {key: fill_gwlfe_numbers(value, values)
+                for key, value in result.items()}
+    if isinstance(result, list):
+        return [fill_gwlfe_numbers(value, values) for value in result]
+    if isinstance(result, Number) and not isinstance(result, bool):
+        return next(values)
+
+    return result
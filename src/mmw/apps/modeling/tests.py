@@ -1,18 +1,36 @@
 # -*- coding: utf-8 -*-
+import gzip
+import json
+import math
 import os
+import random
+import time
+import numpy
+
+from collections import defaultdict
+from copy import deepcopy
+from functools import partial, reduce
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from threading import Barrier, Thread
+from unittest.mock import patch
 
 from celery import chain, shared_task
+from gwlfe import Parser
 
 from rest_framework.test import APIClient
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.gis.geos import Polygon
+from django.db import connection
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.utils.timezone import now
 
 from apps.core.models import Job, JobStatus
-from apps.modeling import tasks, views
+from apps.modeling import calcs, geoprocessing, tasks, tiling, views
+from apps.modeling.mapshed import tasks as mapshed_tasks, weather
 from apps.modeling.models import Scenario, WeatherType
 
 
@@ -34,6 +52,324 @@ def get_test_histogram():
     }]
 
 
+class FakeGeoprocessingService(object):
+    """
+    Serves the geoprocessing service's endpoints on a local port, answering
+    each request with `respond(endpoint, body)`, which returns a status code
+    and a response to encode as JSON, or bytes to send as they are. Received
+    requests are kept in `requests` as (endpoint, body) tuples.
+
+    Use as a context manager, with `self.settings(GEOP=service.geop())`.
+    """
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+
+    def __enter__(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                endpoint = self.path.strip('/')
+                body = json.loads(body)
+                service.requests.append((endpoint, body))
+
+                status, response = service.respond(endpoint, body)
+                if not isinstance(response, bytes):
+                    response = json.dumps(response).encode('utf-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def geop(self, **overrides):
+        return dict(settings.GEOP, host='127.0.0.1',
+                    port=str(self.server.server_port), **overrides)
+
+
+class FakeRedis(object):
+    """
+    The lists and values of a Redis connection used by `batched_run`, kept
+    in memory. When `blpop` finds an empty list, `on_block` is called with
+    the connection, to stand in for the other tasks of a batch, before the
+    list is popped. The timeout of each `blpop` is kept in `timeouts`.
+    """
+    def __init__(self, on_block=None):
+        self.lists = defaultdict(list)
+        self.values = {}
+        self.on_block = on_block
+        self.timeouts = []
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+    def rpush(self, key, value):
+        self.lists[key].append(value)
+        return len(self.lists[key])
+
+    def lrange(self, key, start, end):
+        return list(self.lists[key])
+
+    def lrem(self, key, count, value):
+        if value in self.lists[key]:
+            self.lists[key].remove(value)
+            return 1
+        return 0
+
+    def blpop(self, key, timeout=0):
+        self.timeouts.append(timeout)
+        if not self.lists[key] and self.on_block:
+            self.on_block(self)
+        if self.lists[key]:
+            return key, self.lists[key].pop(0)
+        return None
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def delete(self, key):
+        return int(self.lists.pop(key, None) is not None or
+                   self.values.pop(key, None) is not None)
+
+    def expire(self, key, seconds):
+        return True
+
+
+class FakeRedisPipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return call
+
+    def execute(self):
+        return [getattr(self.conn, name)(*args, **kwargs)
+                for name, args, kwargs in self.calls]
+
+
+def multi_response(endpoint, body):
+    """
+    Responds to /multi requests with a count of 2 for every shape and
+    operation, as doubles, like the geoprocessing service.
+    """
+    return 200, {shape['id']: {op['label']: {'List(1)': 2.0}
+                               for op in body['operations']}
+                 for shape in body['shapes']}
+
+
+# Loads SRAT does not return, as format_for_srat does not send them
+NO_SEDIMENT_SOURCES = ['farman', 'subsurface', 'septics', 'pointsource']
+
+
+def synthetic_subbasin(huc12_count, catchment_count, seed=0):
+    """
+    Returns GWLF-E results, SRAT Catchment API results and MapShed data of a
+    subbasin run with the given numbers of HUC-12s and catchments in each,
+    filled with random loads and areas
+    """
+    rng = random.Random(seed)
+    gwlfe_results = {}
+    srat_huc12s = {}
+    gmss = {}
+
+    for h in range(huc12_count):
+        huc12_id = f'0204020{h:05d}'
+        gmss[huc12_id] = {'Area': [rng.uniform(0, 5000) for _ in range(16)]}
+        gwlfe_results[huc12_id] = {'AreaTotal': sum(gmss[huc12_id]['Area']),
+                                   'inputmod_hash': 'synthetic'}
+
+        srat_huc12 = {'huc12': huc12_id, 'catchments': {}}
+        for key in settings.SRAT_KEYS.values():
+            srat_huc12[f'tnload_{key}'] = rng.uniform(0, 1e5)
+            srat_huc12[f'tpload_{key}'] = rng.uniform(0, 1e4)
+            if key not in NO_SEDIMENT_SOURCES:
+                srat_huc12[f'tssload_{key}'] = rng.uniform(0, 1e7)
+
+        for c in range(catchment_count):
+            catchment = {f'{load}_{key}': rng.uniform(0, 1e3)
+                         for load in ['tnload', 'tpload', 'tssload',
+                                      'tn_conc', 'tp_conc', 'tss_conc']
+                         for key in settings.SRAT_KEYS.values()}
+            for load in ['tnloadrate', 'tploadrate', 'tssloadrate']:
+                catchment[f'{load}_total'] = rng.uniform(0, 1e4)
+                catchment[f'{load}_conc'] = rng.uniform(0, 100)
+            srat_huc12['catchments'][str(4781000 + h * catchment_count + c)] \
+                = catchment
+
+        srat_huc12s[huc12_id] = srat_huc12
+
+    return gwlfe_results, {'huc12s': srat_huc12s}, gmss
+
+
+def format_subbasin_loops(huc12_gwlfe_results, srat_catchment_results,
+                          gmss):
+    """
+    format_subbasin as it used to be, with loops over every HUC-12, source
+    and catchment
+    """
+    def empty_source(s):
+        return {'Source': s,
+                'TotalN': 0, 'TotalP': 0, 'Sediment': 0,
+                'Area': 0}
+
+    def add_huc12_source(source, srat_huc12, source_areas, total_area):
+        source_name = source['Source']
+        source_key = settings.SRAT_KEYS[source_name]
+        total_n = srat_huc12.get('tnload_' + source_key, 0)
+        total_p = srat_huc12.get('tpload_' + source_key, 0)
+        sediment = srat_huc12.get('tssload_' + source_key, 0)
+
+        normalizing_areas = settings.SUBBASIN_SOURCE_NORMALIZING_AREAS
+        source_area_idxs = normalizing_areas.get(source_name, None)
+        area = sum([source_areas[i] for i in source_area_idxs]) \
+            if source_area_idxs else total_area
+
+        source['TotalN'] += total_n
+        source['TotalP'] += total_p
+        source['Sediment'] += sediment
+        source['Area'] += area
+
+        return {
+            'Source': source_name,
+            'TotalN': total_n,
+            'TotalP': total_p,
+            'Sediment': sediment,
+            'Area': area,
+        }
+
+    def format_catchment(srat_catchment, loads_template):
+        for key, value in srat_catchment.items():
+            # A sample load source key is 'tnload_hp'.
+            # The first half 'tnload' indicates which kinds of loads
+            # The second half 'hp' is the acronym of the source of loads
+            # Sometimes the first half has underscores, like 'tn_conc_ptsource'
+            split_at = key.rfind('_')
+            if split_at > -1:
+                load_type = key[0:split_at]
+                load_source = key[split_at:]
+                for load in loads_template:
+                    if load_source == settings.SRAT_KEYS[load['Source']]:
+                        add_load_by_key(load_type, value, load)
+
+        return {
+            'TotalLoadingRates': {
+                'TotalN': srat_catchment['tnloadrate_total'],
+                'TotalP': srat_catchment['tploadrate_total'],
+                'Sediment': srat_catchment['tssloadrate_total'],
+            },
+            'LoadingRateConcentrations': {
+                'TotalN': srat_catchment['tnloadrate_conc'],
+                'TotalP': srat_catchment['tploadrate_conc'],
+                'Sediment': srat_catchment['tssloadrate_conc'],
+            },
+            'Loads': loads_template
+        }
+
+    def add_load_by_key(load_type, value, load):
+        type_mapping = {
+            'tpload': 'TotalP',
+            'tnload': 'TotalN',
+            'tssload': 'Sediment'
+        }
+
+        if load_type in type_mapping:
+            load[type_mapping[load_type]] = value
+
+        return load
+
+    def catchment_template(keys_template):
+        return [{
+            'Source': key_name,
+            'TotalN': 0,
+            'TotalP': 0,
+            'Sediment': 0
+        } for key_name in keys_template.keys()]
+
+    def sum_loads(loads):
+        def add_load(sums, load):
+            (sediment_sum,
+             nitrogen_sum,
+             phosphorus_sum) = sums
+            return (sediment_sum + load['Sediment'],
+                    nitrogen_sum + load['TotalN'],
+                    phosphorus_sum + load['TotalP'])
+
+        return reduce(add_load, loads, (0, 0, 0))
+
+    def build_summary_loads(loads, area):
+        (sum_sed, sum_n, sum_p) = sum_loads(loads)
+        return {
+            'Source': 'Entire area',
+            'Area': area,
+            'Sediment': sum_sed,
+            'TotalN': sum_n,
+            'TotalP': sum_p,
+        }
+
+    def add_huc12(srat_huc12, aggregate):
+        area = huc12_gwlfe_results[srat_huc12['huc12']]['AreaTotal']
+        source_areas = gmss[srat_huc12['huc12']]['Area']
+        loads = [add_huc12_source(s, srat_huc12, source_areas, area)
+                 for s in aggregate['Loads']]
+        summary_loads = build_summary_loads(loads, area)
+        catchment_loads_template = catchment_template(settings.SRAT_KEYS)
+
+        # Build up the full AOI's values with the huc-12's
+        aggregate['SummaryLoads']['Area'] += area
+        aggregate['SummaryLoads']['Sediment'] += summary_loads['Sediment']
+        aggregate['SummaryLoads']['TotalN'] += summary_loads['TotalN']
+        aggregate['SummaryLoads']['TotalP'] += summary_loads['TotalP']
+
+        return {
+            'Loads': loads,
+            'SummaryLoads': summary_loads,
+            'Catchments': {
+                comid: format_catchment(result, catchment_loads_template)
+                for comid, result in srat_huc12['catchments'].items()},
+            'Raw': huc12_gwlfe_results[srat_huc12['huc12']]
+        }
+
+    aggregate = {
+        'Loads': [empty_source(source_name)
+                  for source_name in settings.SRAT_KEYS.keys()],
+        'SummaryLoads': empty_source('Entire area'),
+        # All gwlf-e results should have the same inputmod hash,
+        # so grab any of them
+        'inputmod_hash': next(iter(
+            huc12_gwlfe_results.values()))['inputmod_hash'],
+    }
+
+    aggregate['HUC12s'] = {huc12_id: add_huc12(result, aggregate)
+                           for huc12_id, result
+                           in srat_catchment_results['huc12s'].items()}
+
+    return aggregate
+
+
 class ExerciseGeoprocessing(TestCase):
     def test_census(self):
         histogram = [{
@@ -131,6 +467,589 @@ class ExerciseGeoprocessing(TestCase):
         actual = tasks.nlcd_soil_tr55(histogram)
         self.assertEqual(actual, expected)
 
+    def test_parse(self):
+        result = {
+            'List(11, 1)': 434,
+            'List(-2147483648,2)': 5,
+            'List(21,4)': 1,
+        }
+
+        self.assertEqual(geoprocessing.parse(result), {
+            (11, 1): 434,
+            (-2147483648, 2): 5,
+            (21, 4): 1,
+        })
+
+        classes, counts = geoprocessing.parse_histogram(result)
+        self.assertEqual(classes.tolist(),
+                         [[11, 1], [-2147483648, 2], [21, 4]])
+        self.assertEqual(counts.tolist(), [434, 5, 1])
+
+        # Single values are not tuples
+        self.assertEqual(geoprocessing.parse({'List(0)': 2.5}), {0: 2.5})
+
+        # Keys of different lengths are parsed one at a time
+        self.assertEqual(geoprocessing.parse({'List(1,2)': 1, 'List(3)': 2}),
+                         {(1, 2): 1, 3: 2})
+        with self.assertRaises(ValueError):
+            geoprocessing.parse_histogram({'List(1,2)': 1, 'List(3)': 2})
+
+    def test_split_into_tiles(self):
+        x, y = tiling.GRID_ORIGIN
+        # 70km x 40km, starting in the middle of a tile
+        box = Polygon.from_bbox((x + 15000, y - 55000, x + 85000, y - 15000))
+        box.srid = 5070
+        aoi = box.transform(4326, clone=True).json
+
+        tiles = tiling.split_into_tiles(aoi, 30000)
+
+        # Spans 3 x 2 tiles of the grid
+        self.assertEqual(len(tiles), 6)
+        self.assertAlmostEqual(sum(area for _, area in tiles) / box.area, 1,
+                               places=6)
+
+    def test_merge_tiles(self):
+        operations = [
+            {'name': 'RasterGroupedCount', 'label': 'gwn',
+             'rasters': ['__GWN__']},
+            {'name': 'RasterGroupedAverage', 'label': 'avg_awc',
+             'targetRaster': '__AWC__', 'rasters': ['__GWN__']},
+            {'name': 'RasterGroupedAverage', 'label': 'slope',
+             'targetRaster': '__SLOPE__', 'rasters': []},
+        ]
+        tiled = tiling.tile_operations(operations)
+
+        self.assertEqual([op['label'] for op in tiled],
+                         ['gwn', 'avg_awc', 'avg_awc__weights', 'slope'])
+
+        tile_results = [
+            {
+                'gwn': {'List(1)': 10.0, 'List(2)': 30.0},
+                'avg_awc': {'List(1)': 2.0, 'List(2)': 4.0},
+                'avg_awc__weights': {'List(1)': 10.0, 'List(2)': 30.0},
+                'slope': {'List(0)': 5.0},
+            },
+            {
+                'gwn': {'List(2)': 10.0},
+                'avg_awc': {'List(2)': 8.0},
+                'avg_awc__weights': {'List(2)': 10.0},
+                'slope': {'List(0)': 2.0},
+            },
+        ]
+        areas = [1000.0, 3000.0]
+
+        merged = {op['label']: tiling.merge_tiles(op, tile_results, areas)
+                  for op in operations}
+
+        self.assertEqual(merged, {
+            'gwn': {'List(1)': 10.0, 'List(2)': 40.0},
+            'avg_awc': {'List(1)': 2.0, 'List(2)': 5.0},
+            'slope': {'List(0)': 2.75},
+        })
+
+    def test_run_input_to_multi_operation(self):
+        aoi = json.dumps({'type': 'Polygon', 'coordinates': []})
+        run_input = dict(settings.GEOP['json']['nlcd_ara']['input'],
+                         polygon=[aoi])
+
+        self.assertTrue(geoprocessing.is_batchable(run_input))
+        self.assertEqual(
+            geoprocessing.multi_operation('nlcd_ara', run_input),
+            {
+                'name': 'RasterGroupedCount',
+                'label': 'nlcd_ara',
+                'rasters': ['__LAND__', '__ARA__'],
+            })
+
+        # Multiple polygons, vectors and summaries are not supported by multi
+        self.assertFalse(geoprocessing.is_batchable(
+            dict(run_input, polygon=[aoi, aoi])))
+        self.assertFalse(geoprocessing.is_batchable(
+            dict(run_input, vector=[None])))
+        self.assertFalse(geoprocessing.is_batchable(
+            dict(settings.GEOP['json']['terrain']['input'], polygon=[aoi])))
+
+    def test_multi_submits_only_uncached_operations(self):
+        shape = {'id': 'huc12__1', 'shape': json.dumps({
+            'type': 'Polygon',
+            'coordinates': [[[-75.1, 39.9], [-75.0, 39.9], [-75.0, 40.0],
+                             [-75.1, 40.0], [-75.1, 39.9]]],
+        })}
+        operations = settings.GEOP['json']['climate']['operations']
+        cached_op = operations[0]
+        namespace = geoprocessing.cache_namespace(cached_op, {})
+        cached_key = f'geop_{namespace}__huc12__1__{cached_op["label"]}'
+
+        with self.settings(**LOCMEM_CACHE_OVERRIDES):
+            from django.core.cache import cache
+            cache.clear()
+            cache.set(cached_key, {'List(1)': 7.0})
+
+            with FakeGeoprocessingService(multi_response) as service:
+                with self.settings(GEOP=service.geop()):
+                    result = geoprocessing.multi.apply(
+                        ('climate', [shape], None)).get()
+
+        # The cached operation is left out of the request
+        self.assertEqual(len(service.requests), 1)
+        endpoint, payload = service.requests[0]
+        self.assertEqual(endpoint, 'multi')
+        self.assertEqual([s['id'] for s in payload['shapes']], ['huc12__1'])
+        self.assertEqual(sorted(op['label'] for op in payload['operations']),
+                         sorted(op['label'] for op in operations[1:]))
+
+        # and merged with the fetched ones into the full result
+        self.assertEqual(result, {'huc12__1': dict(
+            {op['label']: {'List(1)': 2.0} for op in operations[1:]},
+            **{cached_op['label']: {'List(1)': 7.0}})})
+
+    def test_can_rollup(self):
+        # Roll-up is opt-in
+        self.assertFalse(geoprocessing.can_rollup('huc8__1',
+                                                  'RasterGroupedCount'))
+
+        with self.settings(GEOP=dict(settings.GEOP, rollup=True)):
+            self.assertTrue(geoprocessing.can_rollup('huc8__1',
+                                                     'RasterGroupedCount'))
+            self.assertTrue(geoprocessing.can_rollup('huc10__1',
+                                                     'RasterGroupedCount'))
+
+            # HUC-12s are the leaves, and only counts can be summed
+            self.assertFalse(geoprocessing.can_rollup('huc12__1',
+                                                      'RasterGroupedCount'))
+            self.assertFalse(geoprocessing.can_rollup('huc8__1',
+                                                      'RasterGroupedAverage'))
+            self.assertFalse(geoprocessing.can_rollup(None,
+                                                      'RasterGroupedCount'))
+
+
+LOCMEM_CACHE_OVERRIDES = {
+    'CACHES': {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+}
+
+
+@override_settings(**LOCMEM_CACHE_OVERRIDES)
+class GeoprocessingCacheTestCase(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        self.cache = cache
+        self.cache.clear()
+
+    def test_lease_is_exclusive_until_released(self):
+        key = 'geop_huc12__1__nlcd_soil'
+
+        self.assertTrue(geoprocessing.acquire_lease(key, 'task-a'))
+        self.assertFalse(geoprocessing.acquire_lease(key, 'task-b'))
+
+        # Owners, such as retried tasks, can re-acquire their own leases
+        self.assertTrue(geoprocessing.acquire_lease(key, 'task-a'))
+
+        # Only the owner can release a lease
+        geoprocessing.release_lease(key, 'task-b')
+        self.assertFalse(geoprocessing.acquire_lease(key, 'task-b'))
+
+        geoprocessing.release_lease(key, 'task-a')
+        self.assertTrue(geoprocessing.acquire_lease(key, 'task-b'))
+
+    def test_circuit_breaker_opens_and_probes(self):
+        breaker = dict(settings.GEOP, breaker_min_requests=4,
+                       breaker_failure_rate=0.5, breaker_cooldown=30,
+                       breaker_window=3600)
+
+        with override_settings(GEOP=breaker):
+            for failed in [False, True, False]:
+                geoprocessing.breaker_record(probe=False, failed=failed)
+            self.assertEqual(geoprocessing.breaker_status()['state'],
+                             'closed')
+
+            geoprocessing.breaker_record(probe=False, failed=True)
+            self.assertEqual(geoprocessing.breaker_status()['state'], 'open')
+
+            with self.assertRaises(geoprocessing.GeoprocessingUnavailable):
+                geoprocessing.breaker_admit()
+
+            # After the cooldown, one probe at a time is let through
+            self.cache.set(geoprocessing.BREAKER_KEY, 0, None)
+            self.assertEqual(geoprocessing.breaker_status()['state'],
+                             'half-open')
+            self.assertTrue(geoprocessing.breaker_admit())
+            with self.assertRaises(geoprocessing.GeoprocessingUnavailable):
+                geoprocessing.breaker_admit()
+
+            geoprocessing.breaker_record(probe=True, failed=False)
+            self.assertEqual(geoprocessing.breaker_status()['state'],
+                             'closed')
+            self.assertFalse(geoprocessing.breaker_admit())
+
+    def test_failed_probe_keeps_circuit_breaker_open(self):
+        # Responses the client cannot parse are not the service's errors,
+        # but a probe that gets one has not shown that it has recovered
+        def respond(endpoint, body):
+            return 200, b'{"result": '
+
+        self.cache.set(geoprocessing.BREAKER_KEY, 0, None)
+
+        with FakeGeoprocessingService(respond) as service:
+            with self.settings(GEOP=service.geop(breaker_cooldown=30)):
+                with self.assertRaises(Exception) as raised:
+                    geoprocessing.geoprocess('run', {'input': {}})
+                self.assertNotIsInstance(
+                    raised.exception,
+                    (geoprocessing.GeoprocessingError,
+                     geoprocessing.GeoprocessingUnavailable))
+
+                self.assertEqual(len(service.requests), 1)
+                self.assertEqual(geoprocessing.breaker_status()['state'],
+                                 'open')
+                with self.assertRaises(
+                        geoprocessing.GeoprocessingUnavailable):
+                    geoprocessing.geoprocess('run', {'input': {}})
+
+    def test_geometry_hash_ignores_representation(self):
+        square = {
+            'type': 'Polygon',
+            'coordinates': [[[-75.1, 39.9], [-75.0, 39.9], [-75.0, 40.0],
+                             [-75.1, 40.0], [-75.1, 39.9]]],
+        }
+        # Clockwise, starting elsewhere, with extra precision and a
+        # repeated vertex, as a MultiPolygon string
+        same_square = json.dumps({
+            'type': 'MultiPolygon',
+            'coordinates': [[[[-75.0, 40.0], [-75.0, 39.9000000001],
+                              [-75.0, 39.9], [-75.1, 39.9], [-75.1, 40.0],
+                              [-75.0, 40.0]]]],
+        })
+        other_square = {
+            'type': 'Polygon',
+            'coordinates': [[[-75.1, 39.9], [-75.0, 39.9], [-75.0, 40.1],
+                             [-75.1, 40.1], [-75.1, 39.9]]],
+        }
+
+        self.assertEqual(geoprocessing.geometry_hash(square),
+                         geoprocessing.geometry_hash(same_square))
+        self.assertNotEqual(geoprocessing.geometry_hash(square),
+                            geoprocessing.geometry_hash(other_square))
+
+        self.assertEqual(geoprocessing.content_id([square]),
+                         geoprocessing.content_id([same_square]))
+        self.assertNotEqual(geoprocessing.content_id([square]),
+                            geoprocessing.content_id([square],
+                                                     {'vector': [None]}))
+
+    def test_cache_namespace_follows_layers_used(self):
+        nlcd_soil = settings.GEOP['json']['nlcd_soil']['input']
+        gwn = settings.GEOP['json']['gwn']['input']
+        land_2011 = {'__LAND__': 'nlcd-2011-30m-epsg5070-512-int8'}
+
+        namespace = geoprocessing.cache_namespace(nlcd_soil, {})
+
+        self.assertEqual(namespace,
+                         geoprocessing.cache_namespace(nlcd_soil, {}))
+        self.assertNotEqual(namespace,
+                            geoprocessing.cache_namespace(nlcd_soil,
+                                                          land_2011))
+
+        # Bumping a layer's version only affects operations that use it
+        gwn_namespace = geoprocessing.cache_namespace(gwn, {})
+        versions = dict(settings.GEOP, layer_versions={'__LAND__': 1})
+        with override_settings(GEOP=versions):
+            self.assertNotEqual(namespace,
+                                geoprocessing.cache_namespace(nlcd_soil, {}))
+            self.assertEqual(gwn_namespace,
+                             geoprocessing.cache_namespace(gwn, {}))
+
+    def test_group_pending_operations(self):
+        pending = {
+            'huc12__1': ['nlcd_soil', 'gwn'],
+            'huc12__2': ['gwn'],
+            'huc12__3': ['nlcd_soil', 'gwn'],
+            'nocache': ['nlcd_soil', 'gwn', 'slope'],
+        }
+
+        self.assertEqual(geoprocessing.group_pending_operations(pending), [
+            (('nlcd_soil', 'gwn'), ['huc12__1', 'huc12__3']),
+            (('gwn',), ['huc12__2']),
+            (('nlcd_soil', 'gwn', 'slope'), ['nocache']),
+        ])
+
+    def test_await_results_returns_published_and_skips_dropped(self):
+        published = 'geop_huc12__1__nlcd_soil'
+        dropped = 'geop_huc12__1__gwn'
+
+        self.cache.set(published, {'List(1,2)': 3})
+
+        self.assertEqual(geoprocessing.await_results([published, dropped]),
+                         {published: {'List(1,2)': 3}})
+
+    def test_await_results_stops_at_the_deadline(self):
+        key = 'geop_huc12__1__nlcd_soil'
+
+        # Held by a task that is taking too long, or has died
+        self.assertTrue(geoprocessing.acquire_lease(key, 'task-a'))
+
+        with self.settings(GEOP=dict(settings.GEOP, lease_wait=0.5)):
+            started = time.monotonic()
+            self.assertEqual(geoprocessing.await_results([key]), {})
+            self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_run_is_retried_instead_of_computing_awaited_result(self):
+        aoi = {
+            'type': 'Polygon',
+            'coordinates': [[[-75.1, 39.9], [-75.0, 39.9], [-75.0, 40.0],
+                             [-75.1, 40.0], [-75.1, 39.9]]],
+        }
+        namespace = geoprocessing.cache_namespace(
+            settings.GEOP['json']['nlcd_soil']['input'], {})
+        key = f'geop_{namespace}__huc12__1__nlcd_soil'
+
+        self.assertTrue(geoprocessing.acquire_lease(key, 'task-a'))
+
+        with FakeGeoprocessingService(
+                lambda endpoint, body: (200, {'result': {'List(1)': 2}})
+        ) as service:
+            with self.settings(GEOP=service.geop(lease_wait=0.1,
+                                                 batch_window=0,
+                                                 retry_backoff=0)):
+                result = geoprocessing.run.apply(
+                    ('nlcd_soil', {'polygon': [aoi]}),
+                    {'wkaoi': 'huc12__1'}).get()
+
+                # Every retry waited for the lease holder, and none of them
+                # duplicated its request
+                self.assertIn('Timed out waiting', result['error'])
+                self.assertEqual(service.requests, [])
+
+                # Once the lease is free, the task computes the result
+                geoprocessing.release_lease(key, 'task-a')
+                result = geoprocessing.run.apply(
+                    ('nlcd_soil', {'polygon': [aoi]}),
+                    {'wkaoi': 'huc12__1'}).get()
+
+        self.assertEqual(result, {'List(1)': 2})
+        self.assertEqual(len(service.requests), 1)
+        self.assertEqual(self.cache.get(key), {'List(1)': 2})
+
+    def batch(self, run_input):
+        operation = geoprocessing.multi_operation('nlcd_soil', run_input)
+        batch = f'geop_batch_{geoprocessing.digest(operation)[:12]}'
+        return operation, batch
+
+    def test_batch_leader_submits_queued_shapes(self):
+        run_input = dict(settings.GEOP['json']['nlcd_soil']['input'],
+                         polygon=['{"type": "Polygon"}'])
+        _, batch = self.batch(run_input)
+
+        # Another task joined the batch before the window closed
+        conn = FakeRedis()
+        conn.rpush(f'{batch}__queue', json.dumps(['other', 'shape']))
+
+        with FakeGeoprocessingService(multi_response) as service:
+            with self.settings(GEOP=service.geop(batch_window=0.01)), \
+                    patch.object(geoprocessing, 'get_redis_connection',
+                                 lambda alias: conn):
+                result = geoprocessing.batched_run('nlcd_soil', run_input)
+
+        self.assertEqual(result, {'List(1)': 2})
+        self.assertEqual(len(service.requests), 1)
+        self.assertEqual(service.requests[0][0], 'multi')
+        self.assertEqual(len(service.requests[0][1]['shapes']), 2)
+
+        # The other task's result is published for it as a /run result
+        self.assertEqual(
+            json.loads(conn.lists['geop_batch_result_other'][0]),
+            {'result': {'List(1)': 2}})
+        self.assertNotIn(f'{batch}__queue', conn.lists)
+        self.assertNotIn(f'{batch}__leader', conn.values)
+
+    def test_batch_follower_receives_result(self):
+        run_input = dict(settings.GEOP['json']['nlcd_soil']['input'],
+                         polygon=['{"type": "Polygon"}'])
+        operation, batch = self.batch(run_input)
+
+        def leader(conn):
+            entries = [json.loads(e) for e in conn.lists[f'{batch}__queue']]
+            conn.delete(f'{batch}__queue')
+            geoprocessing._submit_batch(conn, operation, entries)
+
+        conn = FakeRedis(on_block=leader)
+        conn.set(f'{batch}__leader', 'other')
+
+        with FakeGeoprocessingService(multi_response) as service:
+            with self.settings(GEOP=service.geop(batch_window=0.01)), \
+                    patch.object(geoprocessing, 'get_redis_connection',
+                                 lambda alias: conn):
+                result = geoprocessing.batched_run('nlcd_soil', run_input)
+
+        self.assertEqual(result, {'List(1)': 2})
+        self.assertEqual(len(service.requests), 1)
+
+    def test_batch_follower_times_out(self):
+        run_input = dict(settings.GEOP['json']['nlcd_soil']['input'],
+                         polygon=['{"type": "Polygon"}'])
+        _, batch = self.batch(run_input)
+
+        # The leader died without taking the batch
+        conn = FakeRedis()
+        conn.set(f'{batch}__leader', 'other')
+
+        with FakeGeoprocessingService(multi_response) as service:
+            with self.settings(GEOP=service.geop(batch_window=0.01)), \
+                    patch.object(geoprocessing, 'get_redis_connection',
+                                 lambda alias: conn):
+                with self.assertRaisesMessage(Exception, 'timed out'):
+                    geoprocessing.batched_run('nlcd_soil', run_input)
+
+        # The wait is bounded by the leader's and by our own time limit, and
+        # no request of our own is made after it
+        self.assertEqual(conn.timeouts, [
+            math.floor(geoprocessing.batch_wait_budget(0.01))])
+        self.assertLess(conn.timeouts[0], settings.TASK_REQUEST_TIMEOUT +
+                        geoprocessing.BATCH_LEADER_GRACE)
+        self.assertEqual(conn.lists[f'{batch}__queue'], [])
+        self.assertEqual(service.requests, [])
+
+    def rollup_setup(self):
+        run_input = dict(settings.GEOP['json']['nlcd_soil']['input'],
+                         polygon=['{"type": "Polygon"}'])
+        operation = geoprocessing.multi_operation('nlcd_soil', run_input)
+        children = [('huc12__1', '020401010101', '{"type": "Polygon"}'),
+                    ('huc12__2', '020401010102', '{"type": "Polygon"}')]
+        keys = {'nlcd_soil': 'geop_ns__huc8__9__nlcd_soil'}
+
+        return operation, children, keys
+
+    def test_rollup_needs_enough_cached_children(self):
+        operation, children, keys = self.rollup_setup()
+
+        self.cache.set('geop_ns__huc12__1__nlcd_soil', {'List(1)': 3})
+
+        with FakeGeoprocessingService(multi_response) as service:
+            with self.settings(GEOP=service.geop(rollup_min_cached=0.75)):
+                self.assertIsNone(geoprocessing.rollup_children(
+                    'huc8__9', children, [operation], keys))
+
+        self.assertEqual(service.requests, [])
+
+    def test_rollup_sums_and_caches_children(self):
+        operation, children, keys = self.rollup_setup()
+
+        # Cached by `multi`, with counts as doubles
+        self.cache.set('geop_ns__huc12__1__nlcd_soil',
+                       {'List(1)': 3.0, 'List(2)': 1.0})
+
+        with FakeGeoprocessingService(multi_response) as service:
+            with self.settings(GEOP=service.geop(rollup_min_cached=0.5)):
+                rolled = geoprocessing.rollup_children(
+                    'huc8__9', children, [operation], keys)
+
+        self.assertEqual(rolled, {'nlcd_soil': {'List(1)': 5, 'List(2)': 1}})
+        self.assertIsInstance(rolled['nlcd_soil']['List(1)'], int)
+
+        # Only the missing child is submitted, and it is cached as `run`
+        # would cache it, with counts as integers
+        self.assertEqual(len(service.requests), 1)
+        self.assertEqual([shape['id']
+                          for shape in service.requests[0][1]['shapes']],
+                         ['huc12__2'])
+        cached = self.cache.get('geop_ns__huc12__2__nlcd_soil')
+        self.assertEqual(cached, {'List(1)': 2})
+        self.assertIsInstance(cached['List(1)'], int)
+
+    def test_client_stats_count_requests(self):
+        def respond(endpoint, body):
+            if body.get('fail'):
+                return 400, {'error': 'Bad request'}
+            return 200, {'result': {'List(1)': 2}}
+
+        with FakeGeoprocessingService(respond) as service:
+            with self.settings(GEOP=service.geop(stats_log_interval=1)):
+                before = geoprocessing.client_stats().get(
+                    'run', {'requests': 0, 'errors': 0, 'bytes_sent': 0})
+
+                with self.assertLogs(geoprocessing.logger, 'INFO') as logs:
+                    self.assertEqual(
+                        geoprocessing.geoprocess('run', {'input': {}}),
+                        {'List(1)': 2})
+                    with self.assertRaises(geoprocessing.GeoprocessingError):
+                        geoprocessing.geoprocess('run', {'fail': True})
+
+                after = geoprocessing.client_stats()['run']
+
+        self.assertEqual(len(service.requests), 2)
+        self.assertEqual(after['requests'], before['requests'] + 2)
+        self.assertEqual(after['errors'], before['errors'] + 1)
+        self.assertGreater(after['bytes_sent'], before['bytes_sent'])
+        self.assertGreater(after['max_seconds'], 0)
+        self.assertIn(f'{after["requests"]} requests', logs.output[-1])
+
+
+class WeatherStoreTestCase(TestCase):
+    def test_store_covers_and_reads_stations(self):
+        with TemporaryDirectory() as path:
+            shape = (3, 4, 12, 31)
+            numpy.save(os.path.join(path, 'stations.npy'),
+                       numpy.array([3, 5, 9]))
+            for measure in weather.MEASURES:
+                numpy.save(os.path.join(path, f'{measure}.npy'),
+                           numpy.arange(numpy.prod(shape),
+                                        dtype=numpy.float32).reshape(shape))
+            with open(os.path.join(path, 'meta.json'), 'w') as f:
+                json.dump({'version': weather.STORE_VERSION,
+                           'begyear': 2000,
+                           'endyear': 2003}, f)
+
+            store = weather.WeatherStore(path)
+
+            self.assertTrue(store.covers([9, 3], 2001, 2003))
+            self.assertFalse(store.covers([4], 2001, 2002))
+            self.assertFalse(store.covers([10], 2001, 2002))
+            self.assertFalse(store.covers([3], 1999, 2002))
+
+            stations, arrays = store.read([9, 3, 9], 2001, 2002)
+
+            self.assertEqual(stations, [3, 9])
+            self.assertEqual(arrays['temp'].shape, (2, 2, 12, 31))
+            numpy.testing.assert_array_equal(
+                arrays['prcp'][1], store.arrays['prcp'][2, 1:3])
+
+
+class QueryPoolTestCase(TestCase):
+    def test_gather_runs_queries_concurrently(self):
+        # Each query waits for the others, so they must run at once
+        barrier = Barrier(3, timeout=5)
+
+        def query(name):
+            barrier.wait()
+            return name
+
+        queries = {name: partial(query, name) for name in ['a', 'b', 'c']}
+
+        self.assertEqual(mapshed_tasks.gather(queries),
+                         {'a': 'a', 'b': 'b', 'c': 'c'})
+
+    def test_query_pool_reuses_connections(self):
+        def backend_pid():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_backend_pid()')
+                return cursor.fetchone()[0]
+
+        with mapshed_tasks.QueryPool(1) as pool:
+            pids = {pool.gather({'pid': backend_pid})['pid']
+                    for _ in range(3)}
+
+            with self.assertRaises(ZeroDivisionError):
+                pool.gather({'error': lambda: 1 / 0})
+
+            # Errors are raised in the caller, and the thread carries on
+            pids.add(pool.gather({'pid': backend_pid})['pid'])
+
+        self.assertEqual(len(pids), 1)
+        self.assertFalse(any(thread.is_alive() for thread in pool.threads))
+
 
 CELERY_TEST_OVERRIDES = {
     'task_always_eager': True,
@@ -489,6 +1408,371 @@ class TaskRunnerTestCase(TestCase):
                             else False for t in needed_tasks]),
                         'missing necessary job in chain')
 
+    def test_subbasin_results_share_weather(self):
+        def gms(watershed_id, stations, temp):
+            return {
+                'watershed_id': watershed_id,
+                'WeatherStations': [{'station': s, 'distance': 1.0}
+                                    for s in stations],
+                'Temp': [[[temp] * 31] * 12],
+                'Prec': [[[0.5] * 31] * 12],
+                'Area': [1.0],
+            }
+
+        results = [gms('a', [1, 2], 3.0), gms('b', [1, 2], 3.0),
+                   gms('c', [2, 3], 4.0), gms('d', [2, 3], 5.0)]
+        expected = {r['watershed_id']: {k: v for k, v in r.items()
+                                        if k != 'watershed_id'}
+                    for r in deepcopy(results)}
+
+        shared = tasks.subbasin_results_to_dict(results)
+
+        self.assertEqual(len(shared[calcs.SHARED_WEATHER]), 3)
+        self.assertEqual(shared['a']['WeatherKey'], shared['b']['WeatherKey'])
+        self.assertNotIn('Temp', shared['a'])
+        self.assertEqual(calcs.resolve_subbasin_weather(
+            json.loads(json.dumps(shared))), expected)
+
+        # Other results are left as is
+        self.assertEqual(calcs.resolve_subbasin_weather(expected), expected)
+
+    @override_settings(SUBBASIN_MAPSHED=dict(settings.SUBBASIN_MAPSHED,
+                                             chunk_size=2))
+    def test_subbasin_chord(self):
+        shapes = [(f'huc12__{i}', i, '{}') for i in range(5)]
+        payload = {wkaoi: {'nlcd_soil': {}} for (wkaoi, _, _) in shapes}
+        shared = ['subbasin_x__stations', 'subbasin_x__weather__1']
+
+        subbasin = mapshed_tasks.subbasin_chord(payload, shapes, 'subbasin_x',
+                                                2000, 2010, {}, shared)
+
+        chunks = [task.args for task in subbasin.tasks]
+        self.assertEqual([list(args[1]) for args in chunks],
+                         [shapes[0:2], shapes[2:4], shapes[4:]])
+        self.assertEqual(chunks[2][0], {'huc12__4': {'nlcd_soil': {}}})
+
+        # The years are passed along, to look up the weather again if it is
+        # no longer cached
+        self.assertEqual(tuple(chunks[0][2:5]), ('subbasin_x', 2000, 2010))
+        self.assertEqual(subbasin.body.task,
+                         mapshed_tasks.merge_subbasin_chunks.name)
+        self.assertEqual(tuple(subbasin.body.args), (shared,))
+
+    @override_settings(**LOCMEM_CACHE_OVERRIDES)
+    def test_merge_subbasin_chunks(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        shared = {'subbasin_x__stations': {1: []},
+                  'subbasin_x__weather__1': ([1.0], [0.5])}
+        cache.set_many(shared)
+
+        merged = mapshed_tasks.merge_subbasin_chunks(
+            [[{'watershed_id': 1}, {'watershed_id': 2}],
+             [{'watershed_id': 3}]], list(shared))
+
+        self.assertEqual([gms['watershed_id'] for gms in merged], [1, 2, 3])
+        self.assertEqual(cache.get_many(list(shared)), {})
+
+    @override_settings(**LOCMEM_CACHE_OVERRIDES)
+    def test_subbasin_weather_is_shared_through_cache(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        def station(id):
+            return {'station': id, 'begyear': 2000, 'endyear': 2001}
+
+        stations = {1: [station(7)], 2: [station(7), station(8)]}
+        cache.set_many({'subbasin_x__stations': stations,
+                        'subbasin_x__weather__7': ([7.0], [0.7]),
+                        'subbasin_x__weather__8': ([8.0], [0.8])})
+
+        # Only what is missing from the cache is looked up again, and the
+        # database has no weather stations to look up here
+        self.assertEqual(
+            mapshed_tasks.subbasin_weather(
+                'subbasin_x', [('huc12__2', 2, '{}')], 2000, 2001),
+            (stations, {7: ([7.0], [0.7]), 8: ([8.0], [0.8])}))
+
+    def test_subbasin_artifacts(self):
+        def gms(temp):
+            return {'WeatherStations': [{'station': 1, 'distance': 1.0}],
+                    'Temp': [[[temp] * 31] * 12],
+                    'Prec': [[[0.5] * 31] * 12],
+                    'Area': [1.0]}
+
+        gmss = {'a': gms(3.0), 'b': gms(3.0), 'c': gms(4.0)}
+        job = Job.objects.create(uuid='c3f7ea4c-6ef4-4c43-9d56-8c1a0c0b16a4',
+                                 created_at=now(), result=json.dumps(gmss),
+                                 status=JobStatus.COMPLETE)
+
+        # Jobs without artifacts are read from their result
+        self.assertEqual(calcs.load_subbasin_gmss(job.uuid, ['b']),
+                         {'b': gmss['b']})
+
+        job.result = ''
+        job.save()
+        calcs.store_subbasin_artifacts(job.uuid, gmss)
+        calcs.store_subbasin_artifacts(job.uuid, gmss)
+
+        self.assertEqual(job.subbasin_artifacts.count(), 5)
+        self.assertEqual(calcs.load_subbasin_gmss(job.uuid, ['a', 'c']),
+                         {'a': gmss['a'], 'c': gmss['c']})
+        self.assertEqual(calcs.load_subbasin_gmss(job.uuid), gmss)
+
+        areas = calcs.load_subbasin_gmss(job.uuid, weather=False)
+        self.assertEqual(sorted(areas), ['a', 'b', 'c'])
+        self.assertNotIn('Temp', areas['a'])
+        self.assertEqual(areas['c']['Area'], [1.0])
+
+    def test_subbasin_artifacts_are_stored_after_result(self):
+        def gms(watershed_id, temp):
+            return {'watershed_id': watershed_id,
+                    'WeatherStations': [{'station': 1, 'distance': 1.0}],
+                    'Temp': [[[temp] * 31] * 12],
+                    'Prec': [[[0.5] * 31] * 12],
+                    'Area': [1.0]}
+
+        results = [gms('a', 3.0), gms('b', 3.0)]
+        expected = {r['watershed_id']: {k: v for k, v in r.items()
+                                        if k != 'watershed_id'}
+                    for r in deepcopy(results)}
+        job = Job.objects.create(
+            uuid='5b2f0c7e-4f5e-4a47-8c59-27a2b3fe0e61', created_at=now(),
+            result=json.dumps(tasks.subbasin_results_to_dict(results)),
+            status=JobStatus.COMPLETE)
+
+        # As linked to saving the result of a subbasin MapShed job
+        tasks.store_subbasin_mapshed_artifacts(job.id)
+
+        self.assertEqual(job.subbasin_artifacts.count(), 3)
+
+        job.result = ''
+        job.save()
+        self.assertEqual(calcs.load_subbasin_gmss(job.uuid), expected)
+
+    def test_to_data_model(self):
+        fixtures = [
+            'management/commands/test_data/mapshed-dict.json',
+            '../geoprocessing_api/tests/gwlfe-prepare-huc12__55174.json',
+        ]
+
+        for fixture in fixtures:
+            path = os.path.join(os.path.dirname(__file__), fixture)
+            with open(path) as f:
+                gms = json.load(f)
+
+            expected = Parser.GmsReader(
+                tasks.to_gms_file(deepcopy(gms))).read()
+            actual = tasks.to_data_model(deepcopy(gms))
+
+            self.assertEqual(sorted(vars(actual)), sorted(vars(expected)))
+            for field, value in vars(expected).items():
+                self.assertIs(type(getattr(actual, field)), type(value),
+                              field)
+                numpy.testing.assert_array_equal(getattr(actual, field),
+                                                 value, err_msg=field)
+
+    @override_settings(**LOCMEM_CACHE_OVERRIDES)
+    def test_gwlfe_results_are_cached(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        path = os.path.join(os.path.dirname(__file__), 'management/commands/'
+                            'test_data/mapshed-dict.json')
+        with open(path) as f:
+            gms = json.load(f)
+
+        result = tasks.run_gwlfe(deepcopy(gms), 'a', 'huc12')
+        cached = tasks.run_gwlfe(deepcopy(gms), 'b')
+
+        self.assertEqual(cache.get(tasks.GWLFE_CACHE_MISSES), 1)
+        self.assertEqual(cache.get(tasks.GWLFE_CACHE_HITS), 1)
+        self.assertEqual(cached['inputmod_hash'], 'b')
+        self.assertIsNone(cached['watershed_id'])
+        self.assertEqual(cached['meta'], result['meta'])
+        self.assertEqual(cached['Loads'], result['Loads'])
+
+        # Any change to the input is another key
+        key = tasks.gwlfe_cache_key(gms)
+        gms['n42b'] += 1
+        self.assertNotEqual(tasks.gwlfe_cache_key(gms), key)
+
+    @override_settings(**LOCMEM_CACHE_OVERRIDES)
+    def test_gwlfe_samples_are_summarized_from_numbers(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        path = os.path.join(os.path.dirname(__file__), 'management/commands/'
+                            'test_data/mapshed-dict.json')
+        with open(path) as f:
+            gms = json.load(f)
+
+        variants = {str(i): [{'RecessionCoef': gms['RecessionCoef'] * f}]
+                    for i, f in enumerate([0.8, 0.9, 1.1, 1.2])}
+        chunks = [tasks.run_gwlfe_variants(gms, [], {name: variants[name]},
+                                           'a', samples=True)
+                  for name in variants]
+
+        # Sample results are neither cached nor sent whole
+        self.assertIsNone(cache.get(tasks.GWLFE_CACHE_MISSES))
+        self.assertEqual(set(chunks[0]), {'template', 'numbers'})
+
+        results = tasks.run_gwlfe_variants(gms, [], variants, 'a')
+        self.assertEqual(cache.get(tasks.GWLFE_CACHE_MISSES), 4)
+
+        summary = tasks.summarize_gwlfe_samples(chunks, 1)
+        self.assertEqual(summary['samples'], 4)
+        expected = tasks.gwlfe_percentiles(
+            list(results.values()), tasks.GWLFE_SENSITIVITY_PERCENTILES)
+        self.assertEqual(summary['Loads'], expected['Loads'])
+        self.assertEqual(summary['MeanFlow'], expected['MeanFlow'])
+
+    @override_settings(SUBBASIN_GWLFE=dict(settings.SUBBASIN_GWLFE,
+                                           max_chunk_seconds=60,
+                                           max_chunks=16))
+    def test_subbasin_chunk_size(self):
+        # One chunk per worker process
+        self.assertEqual(calcs.subbasin_chunk_size(40, 1, 8), 5)
+        # Evened out when they don't divide
+        self.assertEqual(calcs.subbasin_chunk_size(10, 1, 4), 3)
+        self.assertEqual(calcs.subbasin_chunk_size(9, 1, 4), 3)
+        # Split further when chunks would take too long
+        self.assertEqual(calcs.subbasin_chunk_size(40, 20, 2), 3)
+        # But never into too many chunks
+        self.assertEqual(calcs.subbasin_chunk_size(160, 60, 200), 10)
+        self.assertEqual(calcs.subbasin_chunk_size(1, 100, 8), 1)
+        # Less so when each worker runs its chunk in a pool of processes
+        self.assertEqual(calcs.subbasin_chunk_size(40, 20, 2, 4), 10)
+
+    @override_settings(**LOCMEM_CACHE_OVERRIDES)
+    def test_workers_are_counted_by_workers(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        config = dict(settings.SUBBASIN_GWLFE, concurrency=3,
+                      pool_processes=2, inspect_timeout=5)
+
+        with self.settings(SUBBASIN_GWLFE=config):
+            # Requests only read the counts, without waiting for workers
+            started = time.monotonic()
+            self.assertEqual(calcs.worker_concurrency(), (3, 2))
+            self.assertLess(time.monotonic() - started, 1)
+
+        # As counted by a worker, when none reply
+        with self.settings(SUBBASIN_GWLFE=dict(config, inspect_timeout=0,
+                                               pool_processes=4)):
+            calcs.count_workers()
+            self.assertEqual(calcs.worker_concurrency(), (3, 4))
+
+        # Workers count again only after the concurrency_timeout
+        with self.settings(SUBBASIN_GWLFE=dict(config, inspect_timeout=0,
+                                               concurrency=5)):
+            calcs.count_workers()
+            self.assertEqual(calcs.worker_concurrency(), (3, 4))
+
+    @override_settings(SUBBASIN_GWLFE=dict(settings.SUBBASIN_GWLFE,
+                                           pool_processes=0,
+                                           concurrency=2))
+    def test_subbasin_pool_processes(self):
+        cpus = os.cpu_count()
+        self.assertEqual(calcs.subbasin_pool_processes(1000),
+                         max(cpus // 2, 1))
+        self.assertEqual(calcs.subbasin_pool_processes(1), 1)
+
+        with self.settings(SUBBASIN_GWLFE=dict(settings.SUBBASIN_GWLFE,
+                                               pool_processes=3)):
+            self.assertEqual(calcs.subbasin_pool_processes(8), 3)
+            self.assertEqual(calcs.subbasin_pool_processes(2), 2)
+
+    def test_subbasin_gwlfe_chunks_run_in_pool(self):
+        path = os.path.join(os.path.dirname(__file__), 'management/commands/'
+                            'test_data/mapshed-dict.json')
+        with open(path) as f:
+            gms = json.load(f)
+
+        gmss = {'a': gms, 'b': dict(gms, RecessionCoef=0.2),
+                'c': dict(gms, n42b=gms['n42b'] * 2)}
+        job = Job.objects.create(uuid='7ad8a1c4-1b6e-4bd7-8f6e-2a9c3f1d5e07',
+                                 created_at=now(), result=json.dumps(gmss),
+                                 status=JobStatus.COMPLETE)
+        args = (job.uuid, [{'n43': 2.0}], calcs.sum_subbasin_stream_lengths(
+            gmss), 'hash', ['c', 'a', 'b'])
+
+        def run_chunk(pool_processes):
+            with self.settings(SUBBASIN_GWLFE=dict(
+                    settings.SUBBASIN_GWLFE, pool_processes=pool_processes)):
+                return tasks.run_subbasin_gwlfe_chunks(*args)
+
+        pooled = run_chunk(3)
+        self.assertEqual([r['watershed_id'] for r in pooled], ['c', 'a', 'b'])
+        self.assertEqual(pooled, run_chunk(1))
+
+        # The chunk's time is recorded to size later chunks
+        with self.settings(**LOCMEM_CACHE_OVERRIDES):
+            from django.core.cache import cache
+            cache.clear()
+
+            run_chunk(2)
+            self.assertGreater(cache.get(calcs.SECONDS_PER_YEAR_KEY), 0)
+
+    def test_format_subbasin(self):
+        args = synthetic_subbasin(huc12_count=200, catchment_count=10)
+        result = tasks.format_subbasin(*args)
+
+        self.assertEqual(result, format_subbasin_loops(*args))
+        self.assertEqual(len(result['HUC12s']), 200)
+
+        # Sums are exact, not only close
+        huc12 = next(iter(result['HUC12s'].values()))
+        self.assertEqual(huc12['SummaryLoads']['TotalN'],
+                         sum(load['TotalN'] for load in huc12['Loads']))
+        self.assertEqual(result['SummaryLoads']['Area'],
+                         sum(h['SummaryLoads']['Area']
+                             for h in result['HUC12s'].values()))
+
+    def test_gwlfe_samples_are_deterministic(self):
+        gms = {'RecessionCoef': 0.1, 'CN': [70.0, 80.0], 'KF': [0.2, 0.4]}
+        parameters = {
+            'RecessionCoef': {'distribution': 'uniform',
+                              'low': 0.05, 'high': 0.15},
+            'CN__1': {'distribution': 'normal', 'loc': 1, 'scale': 0.1,
+                      'relative': True},
+            'KF': {'distribution': 'triangular', 'left': 0.5, 'mode': 1,
+                   'right': 1.5, 'relative': True},
+        }
+
+        samples = calcs.gwlfe_samples(gms, parameters, 20, 42)
+        self.assertEqual(len(samples), 20)
+        self.assertEqual(samples, calcs.gwlfe_samples(
+            gms, dict(reversed(parameters.items())), 20, 42))
+        self.assertNotEqual(samples,
+                            calcs.gwlfe_samples(gms, parameters, 20, 43))
+
+        for sample in samples:
+            self.assertTrue(0.05 <= sample['RecessionCoef'] <= 0.15)
+            # Relative samples scale the value they replace
+            factor = sample['KF'][0] / 0.2
+            self.assertAlmostEqual(sample['KF'][1], 0.4 * factor)
+            self.assertTrue(0.5 <= factor <= 1.5)
+            self.assertNotEqual(sample['CN__1'], 80.0)
+
+    def test_gwlfe_percentiles(self):
+        results = [{
+            'inputmod_hash': 'a',
+            'MeanFlow': float(i),
+            'monthly': [{'AvRunoff': 2.0 * i}],
+            'Loads': [{'Source': 'Hay/Pasture', 'TotalN': 100.0 - i}],
+        } for i in range(101)]
+
+        self.assertEqual(tasks.gwlfe_percentiles(results, [5, 50, 95]), {
+            'inputmod_hash': 'a',
+            'MeanFlow': [5.0, 50.0, 95.0],
+            'monthly': [{'AvRunoff': [10.0, 100.0, 190.0]}],
+            'Loads': [{'Source': 'Hay/Pasture',
+                       'TotalN': [5.0, 50.0, 95.0]}],
+        })
+
 
 class APIAccessTestCase(TestCase):
 
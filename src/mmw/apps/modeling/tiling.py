@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from math import floor
+
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Polygon
+
+# Origin and cell size, in meters, of the CONUS Albers (EPSG:5070) grid of
+# the NLCD and the other 30m rasters. Tiles are aligned to it, so that every
+# cell falls in exactly one tile.
+GRID_ORIGIN = (-2493045.0, 3310005.0)
+CELL_SIZE = 30
+
+# Operations whose results are histograms that can be added across tiles
+ADDITIVE_OPERATIONS = {'RasterGroupedCount', 'RasterLinesJoin'}
+
+# Suffix of the label of the RasterGroupedCount operation added alongside a
+# grouped RasterGroupedAverage, whose counts weigh the averages of each tile
+WEIGHTS_SUFFIX = '__weights'
+
+
+def aoi_area(geojson):
+    """
+    Returns the area of a LatLng GeoJSON geometry in square meters.
+    """
+    return GEOSGeometry(geojson, srid=4326).transform(5070, clone=True).area
+
+
+def split_into_tiles(geojson, tile_size):
+    """
+    Splits a LatLng GeoJSON polygon into tiles of a square grid in CONUS
+    Albers, aligned to the 30m raster grid, with sides of tile_size meters
+    rounded to a whole number of cells.
+
+    Returns a list of (geojson, area) for each non-empty tile, where geojson
+    is the part of the polygon in the tile in LatLng, and area is its area in
+    square meters.
+
+    Since tile edges fall on cell edges, the geoprocessing service counts
+    each cell of a 30m raster, by its center, in exactly one tile.
+    """
+    geom = GEOSGeometry(geojson, srid=4326).transform(5070, clone=True)
+    prepared = geom.prepared
+    size = max(1, round(tile_size / CELL_SIZE)) * CELL_SIZE
+    xmin, ymin, xmax, ymax = geom.extent
+
+    def aligned(value, origin):
+        return origin + floor((value - origin) / size) * size
+
+    tiles = []
+
+    x = aligned(xmin, GRID_ORIGIN[0])
+    while x < xmax:
+        y = aligned(ymin, GRID_ORIGIN[1])
+        while y < ymax:
+            box = Polygon.from_bbox((x, y, x + size, y + size))
+            box.srid = 5070
+
+            if prepared.contains(box):
+                tile = box
+            elif prepared.intersects(box):
+                tile = _polygonal(geom.intersection(box))
+            else:
+                tile = None
+
+            if tile is not None:
+                tiles.append((tile.transform(4326, clone=True).json,
+                              tile.area))
+
+            y += size
+        x += size
+
+    return tiles
+
+
+def _polygonal(geom):
+    """
+    Returns the polygons in the geometry, dropping any points or lines where
+    it only touches a tile, or None if there are none.
+    """
+    if geom.geom_type in ('Polygon', 'MultiPolygon'):
+        return None if geom.empty else geom
+
+    polygons = [g for g in geom
+                if g.geom_type == 'Polygon' and not g.empty]
+    if not polygons:
+        return None
+
+    return MultiPolygon(polygons, srid=geom.srid)
+
+
+def tile_operations(operations):
+    """
+    Returns the operations to run on each tile to compute the given ones.
+
+    Grouped RasterGroupedAverage operations get a RasterGroupedCount of
+    their groups, labeled with WEIGHTS_SUFFIX, which weighs each tile's
+    averages when merging them. Ungrouped ones are weighed by tile area.
+    """
+    tiled = []
+
+    for op in operations:
+        tiled.append(op)
+
+        if op['name'] == 'RasterGroupedAverage' and op['rasters']:
+            tiled.append({
+                'name': 'RasterGroupedCount',
+                'label': f'{op["label"]}{WEIGHTS_SUFFIX}',
+                'rasters': op['rasters'],
+            })
+
+    return tiled
+
+
+def merge_tiles(operation, tile_results, areas):
+    """
+    Merges the results of an operation over each tile of a shape into its
+    result over the whole shape.
+
+    tile_results is a list of the results of `tile_operations` for each tile,
+    like {'{{ label }}': {'List(1,2)': 3.0}}, and areas a list of the tiles'
+    areas. Histograms of additive operations are summed, which is exact.
+    Averages are weighted by the count of their group in each tile, or the
+    area of the tile if they are not grouped, which is exact where the target
+    raster has data.
+    """
+    label = operation['label']
+
+    if operation['name'] in ADDITIVE_OPERATIONS:
+        merged = {}
+        for results in tile_results:
+            for key, count in results.get(label, {}).items():
+                merged[key] = merged.get(key, 0) + count
+        return merged
+
+    if operation['name'] != 'RasterGroupedAverage':
+        raise Exception(f'Cannot merge tiles of {operation["name"]}')
+
+    totals = {}
+    weights = {}
+    for results, area in zip(tile_results, areas):
+        counts = results.get(f'{label}{WEIGHTS_SUFFIX}')
+        for key, average in results.get(label, {}).items():
+            weight = counts.get(key, 0) if counts is not None else area
+            totals[key] = totals.get(key, 0) + average * weight
+            weights[key] = weights.get(key, 0) + weight
+
+    return {key: totals[key] / weights[key] if weights[key] else 0.0
+            for key in totals}
@@ -52,6 +52,8 @@ from apps.modeling.calcs import (get_layer_shape,
                                  boundary_search_context,
                                  split_into_huc12s,
                                  sum_subbasin_stream_lengths,
+                                 resolve_subbasin_weather,
+                                 subbasin_gwlfe_chunks,
                                  get_weather_modifications,
                                  get_weather_simulation_for_project,
                                  get_available_simulations_for_aoi,
@@ -468,7 +470,7 @@ def start_gwlfe(request, format=None):
 
     if mapshed_job_uuid:
         mapshed_job = get_object_or_404(Job, uuid=mapshed_job_uuid)
-        model_input = json.loads(mapshed_job.result)
+        model_input = resolve_subbasin_weather(json.loads(mapshed_job.result))
     else:
         model_input = json.loads(request.POST.get('model_input'))
 
@@ -515,14 +517,13 @@ def _initiate_gwlfe_job_chain(model_input, modifications,
 
 def _initiate_subbasin_gwlfe_job_chain(model_input, mapshed_job_uuid,
                                        modifications, inputmod_hash,
-                                       job_id, chunk_size=8):
+                                       job_id):
     errback = save_job_error.s(job_id)
 
     # Split the sub-basin ids into a list of lists. (We'll refer to
-    # each inner list as a "chunk")
-    watershed_ids = list(model_input.keys())
-    watershed_id_chunks = [watershed_ids[x:x+chunk_size]
-                           for x in range(0, len(watershed_ids), chunk_size)]
+    # each inner list as a "chunk".) Chunks are sized by the measured
+    # GWLF-E runtime of sub-basins and the number of workers.
+    watershed_id_chunks = subbasin_gwlfe_chunks(model_input)
 
     stream_lengths = sum_subbasin_stream_lengths(model_input)
 
@@ -607,10 +608,13 @@ def _initiate_subbasin_mapshed_job_chain(mapshed_input, job_id):
     if not huc12s:
         raise EmptyResultSet('No subbasins found')
 
+    # Once saved, the result is also stored by sub-basin, so that each GWLF-E
+    # task run on it reads only the sub-basins of its chunk
     job_chain = (multi_subbasin(area_of_interest, huc12s, layer_overrides) |
                  collect_subbasin.s(huc12s, layer_overrides=layer_overrides) |
                  tasks.subbasin_results_to_dict.s() |
-                 save_job_result.s(job_id, mapshed_input))
+                 save_job_result.s(job_id, mapshed_input).set(
+                     link=tasks.store_subbasin_mapshed_artifacts.si(job_id)))
 
     return job_chain.apply_async(link_error=errback)
 
@@ -625,7 +629,8 @@ def _initiate_mapshed_job_chain(mapshed_input, job_id):
     job_chain = (
         multi_mapshed(area_of_interest, wkaoi, layer_overrides) |
         convert_data.s(wkaoi) |
-        collect_data.s(area_of_interest, layer_overrides=layer_overrides) |
+        collect_data.s(area_of_interest, layer_overrides=layer_overrides,
+                       wkaoi=wkaoi) |
         save_job_result.s(job_id, mapshed_input))
 
     return chain(job_chain).apply_async(link_error=errback)
@@ -748,7 +753,7 @@ def _construct_tr55_job_chain(model_input, job_id):
 def subbasins_detail(request):
     mapshed_job_uuid = request.query_params.get('mapshed_job_uuid')
     mapshed_job = Job.objects.get(uuid=mapshed_job_uuid)
-    gmss = json.loads(mapshed_job.result)
+    gmss = resolve_subbasin_weather(json.loads(mapshed_job.result))
     if gmss:
         huc12s = get_huc12s(gmss.keys())
         return Response(huc12s)
@@ -889,7 +894,7 @@ def get_job(request, job_uuid, format=None):
 
     # Parse results to json if it is valid json
     try:
-        result = json.loads(job.result)
+        result = resolve_subbasin_weather(json.loads(job.result))
     except ValueError:
         result = job.result
 
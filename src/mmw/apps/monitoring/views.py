@@ -7,6 +7,8 @@ from django.db import connections
 
 from mmw.middleware import bypass_middleware
 
+from apps.modeling.geoprocessing import breaker_status
+
 import uuid
 
 
@@ -17,7 +19,13 @@ def health_check(request):
     for check in [_check_cache, _check_database]:
         response.update(check())
 
-    if all([x[0]['default']['ok'] for x in response.values()]):
+    healthy = all([x[0]['default']['ok'] for x in response.values()])
+
+    # An unavailable geoprocessing service is reported, but does not make
+    # this instance unhealthy
+    response.update(_check_geoprocessing())
+
+    if healthy:
         return JsonResponse(response, status=status.HTTP_200_OK)
     else:
         return JsonResponse(response,
@@ -62,3 +70,24 @@ def _check_database(database='default'):
         }
 
     return {'databases': [response]}
+
+
+def _check_geoprocessing():
+    try:
+        breaker = breaker_status()
+
+        response = {
+            'default': {
+                'ok': breaker['state'] != 'open',
+                'breaker': breaker,
+            },
+        }
+    except Exception as e:
+        response = {
+            'default': {
+                'ok': False,
+                'msg': str(e)
+            },
+        }
+
+    return {'geoprocessing': [response]}
@@ -462,6 +462,47 @@ SRAT_CATCHMENT_API = {
                            'ERROR: Could not get SRAT Catchment API Key'),
 }
 
+# Subbasin GWLF-E Settings
+SUBBASIN_GWLFE = {
+    # Worker processes to spread chunks of HUC-12s over. The workers count
+    # themselves every concurrency_timeout seconds, waiting up to
+    # inspect_timeout seconds for each other to reply. Until then, or if none
+    # reply, or inspect_timeout is 0, concurrency is used instead.
+    'concurrency': int(environ.get('MMW_SUBBASIN_GWLFE_CONCURRENCY', 2)),
+    'inspect_timeout': float(environ.get(
+        'MMW_SUBBASIN_GWLFE_INSPECT_TIMEOUT', 0.5)),
+    'concurrency_timeout': int(environ.get(
+        'MMW_SUBBASIN_GWLFE_CONCURRENCY_TIMEOUT', 600)),
+    # Seconds GWLF-E takes per weather year of a HUC-12, until measured
+    'seconds_per_year': float(environ.get(
+        'MMW_SUBBASIN_GWLFE_SECONDS_PER_YEAR', 0.1)),
+    # Chunks are kept shorter than max_chunk_seconds, and fewer than
+    # max_chunks, as each takes time to submit while the request waits
+    'max_chunk_seconds': float(environ.get(
+        'MMW_SUBBASIN_GWLFE_MAX_CHUNK_SECONDS', 60)),
+    'max_chunks': int(environ.get('MMW_SUBBASIN_GWLFE_MAX_CHUNKS', 16)),
+    # Processes each chunk runs its HUC-12s in. When 0, the CPUs are shared
+    # between the concurrency worker processes. When 1, HUC-12s are run one
+    # at a time in the worker process. Each pool process may use up to
+    # pool_memory_mb megabytes of address space, or any amount when 0.
+    'pool_processes': int(environ.get(
+        'MMW_SUBBASIN_GWLFE_POOL_PROCESSES', 0)),
+    'pool_memory_mb': int(environ.get(
+        'MMW_SUBBASIN_GWLFE_POOL_MEMORY_MB', 4096)),
+}
+
+# Subbasin MapShed Settings
+SUBBASIN_MAPSHED = {
+    # HUC-12s to collect the MapShed data of in each task
+    'chunk_size': int(environ.get('MMW_SUBBASIN_MAPSHED_CHUNK_SIZE', 8)),
+}
+
+# Seconds to cache GWLF-E results for, by their input and the version of
+# GWLF-E. Caching is off when 0. The least recently used results are evicted
+# first when Redis is configured with maxmemory-policy allkeys-lru.
+GWLFE_CACHE_TIMEOUT = int(environ.get('MMW_GWLFE_CACHE_TIMEOUT',
+                                      30 * 24 * 60 * 60))
+
 # Drexel Fast Zonal API Settings
 DREXEL_FAST_ZONAL_API = {
     'url': environ.get('MMW_DREXEL_FAST_ZONAL_API_URL',
@@ -470,13 +511,75 @@ DREXEL_FAST_ZONAL_API = {
              'corridors', 'corridors_np', 'corridors_osi'],
 }
 
+# Directory of the memory-mapped daily weather of ms_weather, written by
+# `./scripts/manage.sh build_weather_store`. Read from the database if absent.
+WEATHER_STORE = environ.get('MMW_WEATHER_STORE', '/var/cache/mmw/weather/')
+
 # Geoprocessing Settings
 GEOP = {
     'cache': bool(int(environ.get('MMW_GEOPROCESSING_CACHE', 1))),
     'host': environ.get('MMW_GEOPROCESSING_HOST', 'localhost'),
     'port': environ.get('MMW_GEOPROCESSING_PORT', '8090'),
+    # Maximum number of pooled keep-alive connections per worker process
+    'pool_size': int(environ.get('MMW_GEOPROCESSING_POOL_SIZE', 10)),
+    # Each worker process logs its request counters for an endpoint every
+    # stats_log_interval requests to it. Logging is off when 0.
+    'stats_log_interval': int(environ.get(
+        'MMW_GEOPROCESSING_STATS_LOG_INTERVAL', 100)),
+    # Gzip request bodies. The service must accept Content-Encoding: gzip.
+    'gzip': bool(int(environ.get('MMW_GEOPROCESSING_GZIP', 0))),
+    # Seconds a task may hold the lease on computing an uncached result
+    # before others can compute it themselves. Tasks waiting for it are
+    # retried after lease_wait seconds, well within their own time limit.
+    'lease_timeout': int(environ.get('MMW_GEOPROCESSING_LEASE_TIMEOUT',
+                                     TASK_REQUEST_TIMEOUT)),
+    'lease_wait': float(environ.get('MMW_GEOPROCESSING_LEASE_WAIT',
+                                    TASK_REQUEST_TIMEOUT // 4)),
+    # Seconds to collect batchable /run requests for one /multi request.
+    # Batching is off when 0. A typical value is 0.05.
+    'batch_window': float(environ.get('MMW_GEOPROCESSING_BATCH_WINDOW', 0)),
+    # Seconds of their time limit that tasks waiting for a batch keep to clean
+    # up and fail when its result does not arrive
+    'batch_margin': int(environ.get('MMW_GEOPROCESSING_BATCH_MARGIN', 10)),
+    # Seconds to wait before the first retry of a request that failed to
+    # reach the service, doubling with each retry up to the maximum
+    'retry_backoff': float(environ.get('MMW_GEOPROCESSING_RETRY_BACKOFF', 1)),
+    'retry_backoff_max': float(environ.get(
+        'MMW_GEOPROCESSING_RETRY_BACKOFF_MAX', 30)),
+    # The circuit breaker opens when at least breaker_failure_rate of the
+    # requests in a window of breaker_window seconds fail, once there have
+    # been breaker_min_requests, and probes again after breaker_cooldown
+    'breaker_window': int(environ.get('MMW_GEOPROCESSING_BREAKER_WINDOW', 60)),
+    'breaker_min_requests': int(environ.get(
+        'MMW_GEOPROCESSING_BREAKER_MIN_REQUESTS', 20)),
+    'breaker_failure_rate': float(environ.get(
+        'MMW_GEOPROCESSING_BREAKER_FAILURE_RATE', 0.5)),
+    'breaker_cooldown': int(environ.get(
+        'MMW_GEOPROCESSING_BREAKER_COOLDOWN', 30)),
+    # Shapes larger than tile_threshold m² are split into tiles of tile_size
+    # meters, sent tile_batch_size at a time in up to tile_concurrency
+    # parallel requests. Tiling is off when the threshold is 0, as it is by
+    # default: the tiles of a shape share the time limit of one task.
+    'tile_threshold': float(environ.get('MMW_GEOPROCESSING_TILE_THRESHOLD',
+                                        0)),
+    'tile_size': int(environ.get('MMW_GEOPROCESSING_TILE_SIZE', 30000)),
+    'tile_batch_size': int(environ.get('MMW_GEOPROCESSING_TILE_BATCH_SIZE',
+                                       8)),
+    'tile_concurrency': int(environ.get('MMW_GEOPROCESSING_TILE_CONCURRENCY',
+                                        4)),
+    # Counts over HUC-8s and HUC-10s are summed from those of their HUC-12s,
+    # over their detailed shapes, when rollup is on and at least
+    # rollup_min_cached of them are cached.
+    'rollup': bool(int(environ.get('MMW_GEOPROCESSING_ROLLUP', 0))),
+    'rollup_min_cached': float(environ.get(
+        'MMW_GEOPROCESSING_ROLLUP_MIN_CACHED', 0.5)),
+    # Seconds to cache results for areas of interest that are not well-known
+    'shape_cache_timeout': int(environ.get(
+        'MMW_GEOPROCESSING_SHAPE_CACHE_TIMEOUT', 7 * 24 * 60 * 60)),
     'args': 'context=geoprocessing&appName=geoprocessing-%s&classPath=org.wikiwatershed.mmw.geoprocessing.MapshedJob' % environ.get('MMW_GEOPROCESSING_VERSION', '0.1.0'),  # NOQA
-    # Clear all cached geop_ values when changing this
+    # Cached geop_ values are namespaced by the layers they were computed
+    # from, so changes here take effect without clearing the cache. Evict
+    # the old entries with `./scripts/manage.sh geop_cache --evict`.
     # https://github.com/WikiWatershed/model-my-watershed#caching
     'layers': {
         '__ARA__': 'ara-30m-epsg5070-512',
@@ -493,6 +596,9 @@ GEOP = {
         '__SOILP__': 'soilpallland2-epsg5070',
         '__STREAMS__': 'nhdhr',
     },
+    # Bump a layer's version here when its data is replaced without renaming
+    # it, e.g. '__LAND__': 1, to move its cached values to a new namespace
+    'layer_versions': {},
     'json': {
         'nlcd_ara': {
             'input': {
@@ -956,6 +1062,14 @@ GEOP = {
     }
 }
 
+# Tasks in a batch must have some of their time limit left to wait for it
+if GEOP['batch_window'] and (CELERY_TASK_TIME_LIMIT - GEOP['batch_window'] -
+                             GEOP['batch_margin']) < 1:
+    raise ImproperlyConfigured(
+        'MMW_GEOPROCESSING_BATCH_WINDOW and MMW_GEOPROCESSING_BATCH_MARGIN '
+        'must leave at least a second of the task time limit of '
+        f'{CELERY_TASK_TIME_LIMIT} seconds')
+
 # UI ("CLIENT APP") USER CONFIGURATION
 CLIENT_APP_USERNAME = 'mmw|client_app_user'
 CLIENT_APP_USER_PASSWORD = environ.get('MMW_CLIENT_APP_USER_PASSWORD', 'mmw')
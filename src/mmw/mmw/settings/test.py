@@ -15,6 +15,9 @@ CACHES = {
     }
 }
 
+# Don't wait for workers to reply to be counted
+SUBBASIN_GWLFE = dict(SUBBASIN_GWLFE, inspect_timeout=0)  # NOQA
+
 SELENIUM_DEFAULT_BROWSER = 'firefox'
 SELENIUM_TEST_COMMAND_OPTIONS = {'pattern': 'uitest*.py'}
 